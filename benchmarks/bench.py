@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+"""Benchmarks rshell against a simulated board (see simboard.py).
+
+   Measures the connect latency, the overhead of a remote call, cp upload
+   and download throughput for various buffer sizes, ls -l on a large
+   directory and the time rsync takes to work out that nothing has changed.
+   The host CPU used by the transfer loops themselves is also measured
+   without a board, using a loopback device.
+
+   The results are printed (or written to --output) as JSON, so that runs
+   from different commits can be compared using --compare:
+
+       python3 -m benchmarks.bench --output before.json
+       git checkout my-branch
+       python3 -m benchmarks.bench --compare before.json
+"""
+
+import argparse
+import binascii
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import rshell.main as rshell
+except ImportError as err:
+    print('sys.path =', sys.path)
+    raise err
+
+from benchmarks.simboard import SimBoard
+
+
+def git_commit():
+    """Returns the commit that the benchmarks are being run against."""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))
+                                       ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def connect(board):
+    """Connects rshell to the simulated board, dropping any other boards."""
+    with rshell.DEV_LOCK:
+        for dev in rshell.DEVS:
+            dev.close()
+        del rshell.DEVS[:]
+        rshell.DEFAULT_DEV = None
+    if not rshell.connect_serial(board.port):
+        raise RuntimeError('Unable to connect to {}'.format(board.port))
+    return rshell.DEFAULT_DEV
+
+
+def timed(func, *args, **kwargs):
+    """Calls func, returning the elapsed wall time and host CPU time."""
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start, time.process_time() - start_cpu
+
+
+def bench_connect(board, repeat):
+    times = [timed(connect, board)[0] for _ in range(repeat)]
+    return {'median_s': statistics.median(times), 'min_s': min(times)}
+
+
+def bench_remote(board, calls):
+    dev = connect(board)
+    elapsed, cpu = timed(lambda: [dev.remote_eval(rshell.get_mode, '/flash')
+                                  for _ in range(calls)])
+    return {'calls': calls,
+            'ms_per_call': elapsed * 1000 / calls,
+            'host_cpu_ms_per_call': cpu * 1000 / calls}
+
+
+def bench_cp(board, work_dir, size_kb, buffer_sizes):
+    connect(board)
+    src_filename = os.path.join(work_dir, 'upload.dat')
+    dst_filename = os.path.join(work_dir, 'download.dat')
+    with open(src_filename, 'wb') as src_file:
+        src_file.write(os.urandom(size_kb * 1024))
+    results = {}
+    save_buffer_size = rshell.BUFFER_SIZE
+    try:
+        for buffer_size in buffer_sizes:
+            rshell.BUFFER_SIZE = buffer_size
+            up, up_cpu = timed(rshell.cp, src_filename, '/flash/bench.dat')
+            down, down_cpu = timed(rshell.cp, '/flash/bench.dat', dst_filename)
+            with open(src_filename, 'rb') as src_file, open(dst_filename, 'rb') as dst_file:
+                if src_file.read() != dst_file.read():
+                    raise RuntimeError('cp with buffer size {} corrupted the file'.format(buffer_size))
+            mbytes = size_kb / 1024.0
+            results[str(buffer_size)] = {
+                'upload_kb_s': size_kb / up,
+                'download_kb_s': size_kb / down,
+                'upload_host_cpu_s_per_mb': up_cpu / mbytes,
+                'download_host_cpu_s_per_mb': down_cpu / mbytes,
+            }
+    finally:
+        rshell.BUFFER_SIZE = save_buffer_size
+    return results
+
+
+class LoopbackDevice(object):
+    """Stands in for a board when measuring the host side of the transfer
+       loops on their own. Every read of one byte is an ACK, and other reads
+       are satisfied from data.
+    """
+
+    def __init__(self, data=b'', has_buffer=True):
+        self.data = memoryview(data)
+        self.has_buffer = has_buffer
+        self.offset = 0
+        self.timeout = 1
+
+    def read(self, num_bytes):
+        return b'\x06' * num_bytes
+
+    def readinto(self, buf):
+        num_bytes = len(buf)
+        buf[:] = self.data[self.offset:self.offset + num_bytes]
+        self.offset += num_bytes
+        return num_bytes
+
+    def write(self, buf):
+        return len(buf)
+
+
+def bench_xfer_loop(size_kb, buffer_size):
+    """Measures the host CPU used per MB by the upload and download loops,
+       without a board (or the serial port) being involved.
+    """
+    data = os.urandom(size_kb * 1024)
+    mbytes = size_kb / 1024.0
+    results = {}
+    save_buffer_size = rshell.BUFFER_SIZE
+    try:
+        rshell.BUFFER_SIZE = buffer_size
+        for has_buffer in (True, False):
+            wire = data if has_buffer else binascii.hexlify(data)
+            _, send_cpu = timed(rshell.send_file_to_remote, LoopbackDevice(has_buffer=has_buffer),
+                                io.BytesIO(data), 'unused', len(data))
+            _, recv_cpu = timed(rshell.recv_file_from_remote,
+                                LoopbackDevice(wire, has_buffer=has_buffer),
+                                'unused', io.BytesIO(), len(data))
+            results['binary' if has_buffer else 'ascii'] = {
+                'send_host_cpu_s_per_mb': send_cpu / mbytes,
+                'recv_host_cpu_s_per_mb': recv_cpu / mbytes,
+            }
+    finally:
+        rshell.BUFFER_SIZE = save_buffer_size
+    return results
+
+
+def bench_ls(board, num_files):
+    connect(board)
+    dirname = board.host_path('/flash/many')
+    os.makedirs(dirname, exist_ok=True)
+    for idx in range(num_files):
+        with open(os.path.join(dirname, 'log%05d.txt' % idx), 'w') as file:
+            file.write('x' * (idx % 100))
+    output = io.StringIO()
+    shell = rshell.Shell(stdout=output)
+    elapsed, cpu = timed(shell.cmdloop, 'ls -l /flash/many')
+    lines = output.getvalue().count('\n')
+    if lines != num_files:
+        raise RuntimeError('ls -l printed {} lines, expected {}'.format(lines, num_files))
+    return {'files': num_files, 'seconds': elapsed, 'host_cpu_s': cpu}
+
+
+def bench_rsync(board, work_dir, num_dirs, files_per_dir):
+    connect(board)
+    src_dir = os.path.join(work_dir, 'tree')
+    for dir_idx in range(num_dirs):
+        dirname = os.path.join(src_dir, 'dir%02d' % dir_idx)
+        os.makedirs(dirname)
+        for file_idx in range(files_per_dir):
+            with open(os.path.join(dirname, 'file%02d.py' % file_idx), 'w') as file:
+                file.write('print(%d)\n' % file_idx)
+    quiet = lambda *args: None
+    sync, _ = timed(rshell.rsync, src_dir, '/flash/tree', mirror=True, dry_run=False,
+                    print_func=quiet, recursed=False, sync_hidden=False)
+    plan, cpu = timed(rshell.rsync, src_dir, '/flash/tree', mirror=True, dry_run=True,
+                      print_func=quiet, recursed=False, sync_hidden=False)
+    return {'files': num_dirs * files_per_dir, 'initial_sync_s': sync,
+            'plan_s': plan, 'plan_host_cpu_s': cpu}
+
+
+def flatten(results, prefix=''):
+    """Flattens nested results into {'a.b.c': value}."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new):
+    """Prints the change in each measurement between two sets of results."""
+    old_flat = flatten(old['results'])
+    new_flat = flatten(new['results'])
+    print('Comparing {} with {}'.format(old.get('commit'), new.get('commit')))
+    width = max(len(key) for key in new_flat)
+    for key in sorted(new_flat):
+        if key in old_flat and old_flat[key]:
+            change = (new_flat[key] - old_flat[key]) * 100.0 / old_flat[key]
+            print('{:<{}} {:12.4f} {:12.4f} {:+8.1f}%'.format(
+                key, width, old_flat[key], new_flat[key], change))
+        else:
+            print('{:<{}} {:>12} {:12.4f}'.format(key, width, '-', new_flat[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks rshell using a simulated board.')
+    parser.add_argument('--baud', type=int, default=None,
+                        help='emulate the bandwidth of a UART (default: unthrottled)')
+    parser.add_argument('--buffer-sizes', default='32,128,512,2048',
+                        help='comma separated BUFFER_SIZE values to use for cp')
+    parser.add_argument('--size', type=int, default=256,
+                        help='size in KB of the file used for cp')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='number of files in the directory used for ls -l')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of times to repeat short measurements')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--compare', help='compare against the results in this file')
+    args = parser.parse_args()
+
+    rshell.QUIET = True
+    rshell.ASCII_XFER = False
+    rshell.cur_dir = os.getcwd()
+
+    work_dir = tempfile.mkdtemp(prefix='rshell-bench-')
+    results = {}
+    results['xfer_loop'] = bench_xfer_loop(4096, 512)
+    try:
+        with SimBoard(baud=args.baud) as board:
+            results['connect'] = bench_connect(board, args.repeat)
+            results['remote'] = bench_remote(board, args.repeat * 20)
+            results['cp'] = bench_cp(board, work_dir, args.size,
+                                     [int(size) for size in args.buffer_sizes.split(',')])
+            results['ls_long'] = bench_ls(board, args.files)
+            results['rsync'] = bench_rsync(board, work_dir, 10, 20)
+            with rshell.DEV_LOCK:
+                for dev in rshell.DEVS:
+                    dev.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'baud': args.baud,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print('')
+    if args.compare:
+        with open(args.compare) as old_file:
+            compare(json.load(old_file), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+"""Simulated MicroPython board which speaks the raw REPL over a pty.
+
+   The board runs the snippets that rshell sends using the host python, but
+   with sys, os, time and friends replaced by small MicroPython-like stand-ins
+   so that the board's filesystem lives in a host directory.
+
+   Run it directly to get a board that rshell can connect to:
+
+       python3 -m benchmarks.simboard
+       rshell --port /dev/pts/N
+"""
+
+import binascii
+import builtins
+import collections
+import hashlib
+import os
+import pty
+import select
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import tty
+
+RAW_BANNER = b'raw REPL; CTRL-B to exit\r\n'
+FRIENDLY_BANNER = b'\r\nMicroPython v1.22.0 on 2024-01-01; simboard with CPython\r\n>>> '
+
+UnameResult = collections.namedtuple('UnameResult',
+                                     'sysname nodename release version machine')
+
+
+class BoardTTY(object):
+    """Reads and writes the master side of the pty, optionally throttled to
+       emulate the bandwidth of a UART.
+    """
+
+    def __init__(self, fd, baud=None):
+        self.fd = fd
+        self.byte_time = 10.0 / baud if baud else 0
+        # Set by micropython.kbd_intr, and reset for each command
+        self.interrupt_char = b'\x03'
+
+    def read(self, num_bytes=1, timeout=None):
+        if timeout is not None:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                return b''
+        try:
+            data = os.read(self.fd, num_bytes)
+        except OSError:
+            # The host side of the pty was closed.
+            raise EOFError
+        if self.byte_time:
+            time.sleep(len(data) * self.byte_time)
+        return data
+
+    def read_input(self, num_bytes=1):
+        """Reads data for sys.stdin. Like MicroPython, receiving the
+           interrupt character raises KeyboardInterrupt.
+        """
+        data = self.read(num_bytes)
+        if self.interrupt_char is not None and self.interrupt_char in data:
+            raise KeyboardInterrupt
+        return data
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.byte_time:
+            time.sleep(len(data) * self.byte_time)
+        view = memoryview(data)
+        while len(view):
+            written = os.write(self.fd, view)
+            view = view[written:]
+
+
+class StdinBuffer(object):
+
+    def __init__(self, tty):
+        self.tty = tty
+
+    def read(self, num_bytes=1):
+        return self.tty.read_input(num_bytes)
+
+    def readinto(self, buf, num_bytes=None):
+        if num_bytes is None:
+            num_bytes = len(buf)
+        data = self.tty.read_input(num_bytes)
+        buf[0:len(data)] = data
+        return len(data)
+
+
+class Stdin(object):
+
+    def __init__(self, tty):
+        self.tty = tty
+        self.buffer = StdinBuffer(tty)
+
+    def read(self, num_bytes=1):
+        return str(self.tty.read_input(num_bytes), 'latin-1')
+
+    def readinto(self, buf, num_bytes=None):
+        return self.buffer.readinto(buf, num_bytes)
+
+    def fileno(self):
+        return self.tty.fd
+
+
+class StdoutBuffer(object):
+
+    def __init__(self, tty):
+        self.tty = tty
+
+    def write(self, data):
+        self.tty.write(bytes(data))
+        return len(data)
+
+
+class Stdout(object):
+    """MicroPython translates \\n into \\r\\n on its console."""
+
+    def __init__(self, tty):
+        self.tty = tty
+        self.buffer = StdoutBuffer(tty)
+
+    def write(self, data):
+        if not isinstance(data, str):
+            data = str(data, 'latin-1')
+        self.tty.write(data.replace('\n', '\r\n'))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class Module(object):
+    """Attribute bag used for the fake MicroPython modules."""
+
+    def __init__(self, module_name, **attrs):
+        self.__name__ = module_name
+        self.__dict__.update(attrs)
+
+
+class SimFile(object):
+    """MicroPython files accept both str and bytes no matter what the mode."""
+
+    def __init__(self, file, binary):
+        self.file = file
+        self.binary = binary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+    def __iter__(self):
+        for line in self.file:
+            yield line if self.binary else str(line, 'utf-8')
+
+    def read(self, num_bytes=-1):
+        data = self.file.read(num_bytes)
+        return data if self.binary else str(data, 'utf-8')
+
+    def readline(self):
+        line = self.file.readline()
+        return line if self.binary else str(line, 'utf-8')
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class SimFS(object):
+    """Maps board paths onto a host directory."""
+
+    def __init__(self, root, fat=True):
+        self.root = root
+        self.cwd = '/'
+        self.fat = fat
+
+    def host_path(self, path):
+        path = str(path)
+        if not path.startswith('/'):
+            path = self.cwd.rstrip('/') + '/' + path
+        parts = []
+        for part in path.split('/'):
+            if part in ('', '.'):
+                continue
+            if part == '..':
+                if parts:
+                    parts.pop()
+                continue
+            parts.append(part)
+        return os.path.join(self.root, *parts)
+
+    def stat(self, path):
+        st = os.stat(self.host_path(path))
+        mode = 0x4000 if (st.st_mode & 0o170000) == 0o040000 else 0x8000
+        size = 0 if mode == 0x4000 else st.st_size
+        return (mode, 0, 0, 0, 0, 0, size,
+                int(st.st_atime), int(st.st_mtime), int(st.st_ctime))
+
+    def listdir(self, path=''):
+        return sorted(os.listdir(self.host_path(path or self.cwd)))
+
+    def ilistdir(self, path=''):
+        dirname = (path or self.cwd).rstrip('/')
+        for name in self.listdir(path):
+            stat = self.stat(dirname + '/' + name)
+            yield (name, stat[0], 0, stat[6])
+
+    def mkdir(self, path):
+        os.mkdir(self.host_path(path))
+
+    def rmdir(self, path):
+        os.rmdir(self.host_path(path))
+
+    def remove(self, path):
+        host_path = self.host_path(path)
+        if os.path.isdir(host_path):
+            raise OSError(21, 'EISDIR')
+        os.remove(host_path)
+
+    def rename(self, old, new):
+        if self.fat and os.path.exists(self.host_path(new)):
+            # FAT refuses to rename over an existing file.
+            raise OSError(17, 'EEXIST')
+        os.rename(self.host_path(old), self.host_path(new))
+
+    def statvfs(self, path):
+        st = os.statvfs(self.host_path(path))
+        return (st.f_bsize, st.f_frsize, st.f_blocks, st.f_bfree, st.f_bavail,
+                st.f_files, st.f_ffree, st.f_favail, st.f_flag, st.f_namemax)
+
+    def chdir(self, path):
+        host_path = self.host_path(path)
+        if not os.path.isdir(host_path):
+            raise OSError(2, 'ENOENT')
+        rel_path = os.path.relpath(host_path, self.root)
+        self.cwd = '/' if rel_path == '.' else '/' + rel_path
+
+    def getcwd(self):
+        return self.cwd
+
+
+class SimBoard(object):
+    """A fake MicroPython board on the slave side of a pty."""
+
+    def __init__(self, root=None, root_dirs=('flash', 'sd'), baud=None,
+                 mem_free=100000, sysname='simboard', fat=True):
+        self.owns_root = root is None
+        self.root = root or tempfile.mkdtemp(prefix='simboard-')
+        for root_dir in root_dirs:
+            os.makedirs(os.path.join(self.root, root_dir), exist_ok=True)
+        self.fs = SimFS(self.root, fat=fat)
+        self.mem_free = mem_free
+        self.sysname = sysname
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        self.tty = BoardTTY(self.master_fd, baud)
+        self.stdin = Stdin(self.tty)
+        self.stdout = Stdout(self.tty)
+        self.running = False
+        self.thread = None
+        self.namespace = None
+        self.soft_reset()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='SimBoard')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        for fd in (self.slave_fd, self.master_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if self.owns_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def host_path(self, path):
+        """Returns the host filename which backs a board filename."""
+        return self.fs.host_path(path)
+
+    # ----- Fake MicroPython modules -----
+
+    def make_modules(self):
+        board = self
+        fs = self.fs
+
+        def print_exception(err, file=None):
+            (file or board.stdout).write(''.join(
+                traceback.format_exception(type(err), err, err.__traceback__)))
+
+        def uname():
+            return UnameResult(board.sysname, board.sysname, '1.22.0',
+                               'v1.22.0', 'simboard with CPython')
+
+        class Poll(object):
+            def __init__(self):
+                self.fds = []
+
+            def register(self, obj, mask=1):
+                self.fds.append(obj)
+
+            def unregister(self, obj):
+                self.fds.remove(obj)
+
+            def poll(self, timeout=-1):
+                timeout = None if timeout is None or timeout < 0 else timeout / 1000.0
+                readable, _, _ = select.select([board.master_fd], [], [], timeout)
+                return [(self.fds[0], 1)] if readable and self.fds else []
+
+        def ticks_ms():
+            return int(time.monotonic() * 1000) & 0x3fffffff
+
+        def ticks_diff(end, start):
+            return ((end - start + 0x20000000) & 0x3fffffff) - 0x20000000
+
+        def gmtime(secs=None):
+            return tuple(time.gmtime(secs))[:8]
+
+        def localtime(secs=None):
+            return tuple(time.localtime(secs))[:8]
+
+        sys_module = Module('sys', stdin=self.stdin, stdout=self.stdout,
+                            stderr=self.stdout, print_exception=print_exception,
+                            platform='simboard', byteorder='little',
+                            implementation=Module('implementation', name='micropython',
+                                                  version=(1, 22, 0), _mpy=0x206),
+                            maxsize=2**31 - 1)
+        os_module = Module('os', listdir=fs.listdir, ilistdir=fs.ilistdir,
+                           stat=fs.stat, mkdir=fs.mkdir, rmdir=fs.rmdir,
+                           remove=fs.remove, rename=fs.rename,
+                           statvfs=fs.statvfs, chdir=fs.chdir,
+                           getcwd=fs.getcwd, uname=uname, sync=lambda: None)
+        time_module = Module('time', time=lambda: int(time.time()),
+                             gmtime=gmtime, localtime=localtime,
+                             sleep=time.sleep,
+                             sleep_ms=lambda ms: time.sleep(ms / 1000.0),
+                             ticks_ms=ticks_ms, ticks_diff=ticks_diff)
+        gc_module = Module('gc', mem_free=lambda: board.mem_free,
+                           collect=lambda: None)
+        def kbd_intr(char):
+            board.tty.interrupt_char = None if char < 0 else bytes([char])
+
+        micropython_module = Module('micropython', kbd_intr=kbd_intr)
+        select_module = Module('select', poll=Poll, POLLIN=1)
+        return {
+            'sys': sys_module,
+            'os': os_module,
+            'time': time_module,
+            'gc': gc_module,
+            'micropython': micropython_module,
+            'select': select_module,
+            'binascii': binascii,
+            'hashlib': hashlib,
+            'struct': struct,
+        }
+
+    def soft_reset(self):
+        modules = self.make_modules()
+        real_import = builtins.__import__
+        fs = self.fs
+
+        def sim_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if name in modules:
+                return modules[name]
+            if name in ('errno', 'collections'):
+                return real_import(name, globals, locals, fromlist, level)
+            raise ImportError("no module named '{}'".format(name))
+
+        def sim_open(filename, mode='r'):
+            return SimFile(open(fs.host_path(filename), mode.replace('b', '') + 'b'),
+                           'b' in mode)
+
+        def sim_print(*args, sep=' ', end='\n', file=None):
+            (file or self.stdout).write(sep.join(str(arg) for arg in args) + end)
+
+        sim_builtins = dict(vars(builtins))
+        sim_builtins.update(__import__=sim_import, open=sim_open, print=sim_print)
+        self.fs.cwd = '/'
+        self.namespace = {'__builtins__': sim_builtins, '__name__': '__main__'}
+
+    # ----- REPL handling -----
+
+    def run(self):
+        try:
+            self.friendly_repl()
+        except EOFError:
+            pass
+        except OSError:
+            # stop closes the pty, which may be in use
+            if self.running:
+                raise
+
+    def friendly_repl(self):
+        while self.running:
+            char = self.tty.read(1)
+            if char == b'\x01':
+                self.tty.write(b'\r\n' + RAW_BANNER + b'>')
+                self.raw_repl()
+            elif char in (b'\r', b'\x03'):
+                self.tty.write(b'\r\n>>> ')
+
+    def raw_repl(self):
+        code = bytearray()
+        while self.running:
+            char = self.tty.read(1)
+            if char == b'\x02':
+                self.tty.write(FRIENDLY_BANNER)
+                return
+            if char == b'\x01':
+                code = bytearray()
+                self.tty.write(b'\r\n' + RAW_BANNER + b'>')
+            elif char == b'\x03':
+                code = bytearray()
+            elif char == b'\x04':
+                if not code:
+                    self.soft_reset()
+                    self.tty.write(b'OK\r\nMPY: soft reboot\r\n' + RAW_BANNER + b'>')
+                    continue
+                self.tty.write(b'OK')
+                self.execute(bytes(code))
+                code = bytearray()
+                self.tty.write(b'>')
+            else:
+                code += char
+
+    def execute(self, code):
+        err = b''
+        self.tty.interrupt_char = b'\x03'
+        try:
+            exec(compile(code.decode('utf-8'), '<stdin>', 'exec'), self.namespace)
+        except EOFError:
+            raise
+        except BaseException as exc:
+            err = ''.join(traceback.format_exception_only(type(exc), exc))
+            err = ('Traceback (most recent call last):\r\n' + err).encode('utf-8')
+        self.tty.write(b'\x04' + err + b'\x04')
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Simulated MicroPython board.')
+    parser.add_argument('--root', help='host directory holding the board filesystem')
+    parser.add_argument('--baud', type=int, help='emulate the bandwidth of a UART')
+    args = parser.parse_args()
+    board = SimBoard(root=args.root, baud=args.baud).start()
+    print('Simulated board on', board.port, 'with filesystem in', board.root)
+    sys.stdout.flush()
+    try:
+        while board.thread.is_alive():
+            board.thread.join(1)
+    except KeyboardInterrupt:
+        pass
+    board.stop()
+
+
+if __name__ == '__main__':
+    main()
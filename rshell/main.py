@@ -22,6 +22,9 @@ import sys
 try:
     import rshell.dfutils as dfutils
     from rshell.getch import getch
+    from rshell.stats import STATS
+    from rshell.progress import PROGRESS
+    from rshell.watch import create_watcher
     from rshell.pyboard import Pyboard, PyboardError
     from rshell.version import __version__
 except ImportError as err:
@@ -35,18 +38,28 @@ if sys.platform == 'win32':
     subprocess.call('', shell=True)
 
 import argparse
+import atexit
 import binascii
 import calendar
 import cmd
+import concurrent.futures
+import contextlib
 import inspect
 import io
 import fnmatch
+import hashlib
+import json
+import mmap
 import os
+import queue
 import re
 import select
 import serial
 import shutil
 import socket
+import socketserver
+import struct
+import subprocess
 import tempfile
 import time
 import threading
@@ -142,6 +155,10 @@ END_COLOR = NO_COLOR
 
 cur_dir = ''
 
+# In the functions which run on the board, HAS_BUFFER gets replaced with the
+# board's has_buffer (see Device.function_source). The host side of each
+# transfer uses dev.has_buffer, so that boards can be used from several
+# threads at once.
 HAS_BUFFER = False
 IS_UPY = False
 DEBUG = False
@@ -149,6 +166,22 @@ USB_BUFFER_SIZE = 512
 RPI_PICO_USB_BUFFER_SIZE = 32
 UART_BUFFER_SIZE = 32
 BUFFER_SIZE = USB_BUFFER_SIZE
+# Size of the buffer which the board collects received data into before
+# writing it to the filesystem. None means that it gets picked for each
+# board, based on how much free memory the board has.
+WRITE_BUF_SIZE = None
+MIN_WRITE_BUF_SIZE = 512
+MAX_WRITE_BUF_SIZE = 8192
+# How often the board syncs the filesystem while receiving a file: 0 means
+# once per file, -1 means after every chunk and N means every N bytes.
+SYNC_BYTES = 0
+# How long (in seconds) to wait for each chunk of a transfer, and the slowest
+# rate (in bytes per second) that a whole file is allowed to be sent at,
+# before giving up on a board.
+XFER_CHUNK_TIMEOUT = 5
+XFER_MIN_RATE = 256
+# How many times a transfer which timed out is retried
+XFER_RETRIES = 2
 QUIET = False
 RTS = ''
 DTR = ''
@@ -163,6 +196,35 @@ DTR = ''
 import platform
 USE_AUTOCONNECT = sys.platform == 'linux' and 'Microsoft' not in platform.uname().release
 
+# Maps (func, sysname, has_buffer, BUFFER_SIZE, write buffer size, SYNC_BYTES,
+# TEMP_SUFFIX, time offset) to the source
+# of func (and its extra functions) which gets sent to a board.
+REMOTE_SOURCE_CACHE = {}
+# Printed before each result returned by Device.remote_batch
+BATCH_SEPARATOR = '\x1e'
+
+# Local files at least this big are memory mapped when they're uploaded
+MMAP_MIN_SIZE = 1024 * 1024
+
+# Suffix of the temporary files which uploads are written to on the board
+TEMP_SUFFIX = '.rshell-tmp'
+
+# Number of writes which can be queued up for a StreamUpload before the
+# command producing the output has to wait for the board to catch up
+STREAM_QUEUE_SIZE = 64
+
+# rsync --delta only compares files which are at least this big. Smaller
+# files get sent whole.
+DELTA_MIN_SIZE = 2048
+DELTA_MIN_BLOCK_SIZE = 256
+# Limits the number of checksums (and hence memory) needed on the board
+DELTA_MAX_BLOCKS = 256
+REMOTE_SOURCE_SUFFIX = (')\n'
+                        'if output is None:\n'
+                        '    print("None")\n'
+                        'else:\n'
+                        '    print(output)\n')
+
 SIX_MONTHS = 183 * 24 * 60 * 60
 
 QUIT_REPL_CHAR = 'X'
@@ -174,34 +236,106 @@ DELIMS = ' \t\n>;'
 TIME_OFFSET = 0
 ERROR = False
 
+MPY_CROSS = 'mpy-cross'
+MPY_CROSS_VERSION = None
+MPY_CACHE_DIR = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                             'rshell', 'mpy')
+# edit keeps its copies of the files on the boards here, so that unchanged
+# files don't need to be downloaded again.
+EDIT_CACHE_DIR = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                              'rshell', 'edit')
+# MicroPython only runs boot.py and main.py as source, so they never get compiled.
+MPY_EXCLUDE = ('boot.py', 'main.py')
+# Native architectures, indexed by the arch field of sys.implementation._mpy
+MPY_ARCHS = (None, 'x86', 'x64', 'armv6', 'armv6m', 'armv7m', 'armv7em',
+             'armv7emsp', 'armv7emdp', 'xtensa', 'xtensawin', 'rv32imc')
+
 DEVS = []
 DEFAULT_DEV = None
 DEV_IDX = 1
 
 DEV_LOCK = threading.RLock()
 
+# Boards which are plugged in are connected to by this many worker threads,
+# so that several boards can connect at once.
+HOTPLUG_WORKERS = 4
+# Sometimes the serial port reports itself as busy just after it appears,
+# so connecting is tried this many times.
+HOTPLUG_ATTEMPTS = 8
+
+# Messages from the background threads, which are held back while a command
+# is running (see notify).
+NOTIFY_LOCK = threading.Lock()
+NOTIFY_PENDING = []
+NOTIFY_PROMPT = None
+
+# Frame types used between an rshell client and an rshell daemon. Each frame
+# is a 1 byte type followed by a 4 byte big-endian length and the payload.
+DAEMON_EXIT = 0
+DAEMON_STDOUT = 1
+DAEMON_STDERR = 2
+DAEMON_FRAME = '>BI'
+
+# Options which a client sends to the daemon along with its command, when
+# they're given on the client's command line. The daemon applies them while
+# it runs the command (see daemon_options).
+DAEMON_OPTIONS = ('buffer_size', 'ascii_xfer', 'write_buf_size', 'sync_bytes', 'xfer_timeout',
+                  'xfer_retries', 'mpy_cross', 'trace_json')
+
 def add_device(dev):
-    """Adds a device to the list of devices we know about."""
-    global DEV_IDX, DEFAULT_DEV
+    """Adds a device to the list of devices we know about. A new list is
+       built and then swapped in, so anything going through DEVS without
+       holding DEV_LOCK sees either the old list or the new one.
+    """
+    global DEVS, DEV_IDX, DEFAULT_DEV
     with DEV_LOCK:
-        for idx in range(len(DEVS)):
-            test_dev = DEVS[idx]
+        devs = list(DEVS)
+        for idx in range(len(devs)):
+            test_dev = devs[idx]
             if test_dev.dev_name_short == dev.dev_name_short:
                 # This device is already in our list. Delete the old one
                 if test_dev is DEFAULT_DEV:
                     DEFAULT_DEV = None
-                del DEVS[idx]
+                del devs[idx]
                 break
-        if find_device_by_name(dev.name):
+        if any(test_dev.name == dev.name for test_dev in devs):
             # This name is taken - make it unique
             dev.name += '-%d' % DEV_IDX
         dev.name_path = '/' + dev.name + '/'
-        DEVS.append(dev)
+        devs.append(dev)
+        DEVS = devs
         DEV_IDX += 1
         if DEFAULT_DEV is None:
             DEFAULT_DEV = dev
 
 
+def notify(message):
+    """Reports something which happened in the background, like a board
+       being plugged in, without getting mixed up with the output of a
+       command. While the shell is waiting for input, the message is printed
+       above the prompt, which is redrawn along with whatever has been typed
+       so far. Otherwise the message is held back until the command is done.
+    """
+    with NOTIFY_LOCK:
+        if NOTIFY_PROMPT is None:
+            NOTIFY_PENDING.append(message)
+            return
+        sys.stdout.write('\r\x1b[K' + message + '\n' + NOTIFY_PROMPT + readline.get_line_buffer())
+        sys.stdout.flush()
+
+
+def notify_prompt(prompt):
+    """Called with the prompt when the shell starts waiting for input, and
+       with None when it stops. Prints any messages which were held back.
+    """
+    global NOTIFY_PROMPT
+    with NOTIFY_LOCK:
+        for message in NOTIFY_PENDING:
+            print(message)
+        del NOTIFY_PENDING[:]
+        NOTIFY_PROMPT = prompt
+
+
 def find_device_by_name(name):
     """Tries to find a board by board name."""
     if not name:
@@ -299,12 +433,18 @@ def autoconnect():
 
 
 def autoconnect_thread(monitor):
-    """Thread which detects USB Serial devices connecting and disconnecting."""
+    """Thread which detects USB Serial devices connecting and disconnecting.
+       Connecting to a board takes a while, so it's left to a pool of worker
+       threads, which lets several boards connect at the same time.
+    """
     monitor.start()
     monitor.filter_by('tty')
 
     epoll = select.epoll()
     epoll.register(monitor.fileno(), select.POLLIN)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=HOTPLUG_WORKERS,
+                                                     thread_name_prefix='Hotplug')
+    connecting = set()  # Ports which a worker is already connecting to
 
     while True:
         try:
@@ -314,27 +454,44 @@ def autoconnect_thread(monitor):
         for fileno, _ in events:
             if fileno == monitor.fileno():
                 usb_dev = monitor.poll()
-                print('autoconnect: {} action: {}'.format(usb_dev.device_node, usb_dev.action))
-                dev = find_serial_device_by_port(usb_dev.device_node)
+                port = usb_dev.device_node
+                if DEBUG:
+                    print('autoconnect: {} action: {}'.format(port, usb_dev.action))
+                dev = find_serial_device_by_port(port)
                 if usb_dev.action == 'add':
-                    # Try connecting a few times. Sometimes the serial port
-                    # reports itself as busy, which causes the connection to fail.
-                    for i in range(8):
-                        if dev:
-                            connected = connect_serial(dev.port, dev.baud, dev.wait)
-                        elif is_micropython_usb_device(usb_dev):
-                            connected = connect_serial(usb_dev.device_node)
-                        else:
-                            connected = False
-                        if connected:
-                            break
-                        time.sleep(0.25)
+                    if port in connecting:
+                        continue
+                    if dev:
+                        args = (dev.port, dev.baud, dev.wait)
+                    elif is_micropython_usb_device(usb_dev):
+                        args = (port,)
+                    else:
+                        continue
+                    connecting.add(port)
+                    future = executor.submit(hotplug_connect, *args)
+                    future.add_done_callback(lambda _, port=port: connecting.discard(port))
                 elif usb_dev.action == 'remove':
-                    print('')
-                    print("USB Serial device '%s' disconnected" % usb_dev.device_node)
+                    notify("USB Serial device '%s' disconnected" % port)
                     if dev:
                         dev.close()
-                        break
+
+
+def hotplug_connect(port, baud=115200, wait=0):
+    """Connects to a board which has just been plugged in, for the
+       autoconnect workers. The board is only added to DEVS once it's ready
+       to use, and the outcome is reported using notify.
+    """
+    for _ in range(HOTPLUG_ATTEMPTS):
+        try:
+            dev = DeviceSerial(port, baud, wait, hotplug=True)
+        except (DeviceError, ShellError, serial.serialutil.SerialException):
+            time.sleep(0.25)
+            continue
+        add_device(dev)
+        notify("Connected to board '{}' on {}".format(dev.name, port))
+        return True
+    notify('Unable to connect to {}'.format(port))
+    return False
 
 
 def autoscan():
@@ -493,31 +650,50 @@ def parse_pattern(s):
     return None, None # Invalid or nonexistent pattern
 
 
-def validate_pattern(fn):
-    """On success return an absolute path and a pattern.
-    Otherwise print a message and return None, None
+def resolve_pattern(fn):
+    """Splits a pattern into an absolute directory and the pattern to match.
+    Prints a message and returns None, None if the pattern is invalid.
     """
     directory, pattern = parse_pattern(fn)
     if directory is None:
         print_err("Invalid pattern {}.".format(fn))
         return None, None
-    target = resolve_path(directory)
-    mode = auto(get_mode, target)
+    return resolve_path(directory), pattern
+
+
+def check_pattern_dir(fn, mode):
+    """Checks that the directory part of a pattern exists, given its mode.
+    Prints a message and returns False if it doesn't.
+    """
     if not mode_exists(mode):
         print_err("cannot access '{}': No such file or directory".format(fn))
-        return None, None
+        return False
     if not mode_isdir(mode):
         print_err("cannot access '{}': Not a directory".format(fn))
-        return None, None
-    return target, pattern
+        return False
+    return True
+
+
+def validate_pattern(fn):
+    """On success return an absolute path, a pattern and a listing of the
+    path. The directory is checked and listed using a single batch of calls.
+    Otherwise print a message and return None, None, None
+    """
+    target, pattern = resolve_pattern(fn)
+    if target is None:
+        return None, None, None
+    mode, listing = auto_batch([(get_mode, target), (listdir, target)])
+    if not check_pattern_dir(fn, mode):
+        return None, None, None
+    return target, pattern, listing
 
 
 def process_pattern(fn):
     """Return a list of paths matching a pattern (or None on error).
     """
-    directory, pattern = validate_pattern(fn)
+    directory, pattern, filenames = validate_pattern(fn)
     if directory is not None:
-        filenames = fnmatch.filter(auto(listdir, directory), pattern)
+        filenames = fnmatch.filter(filenames, pattern)
         if filenames:
             return [directory + '/' + sfn for sfn in filenames]
         else:
@@ -589,6 +765,20 @@ def remote_repr(i):
     return repr_str
 
 
+def remote_args(args, kwargs):
+    """Returns the argument list used to call a function on the pyboard."""
+    args_arr = [remote_repr(i) for i in args]
+    kwargs_arr = ["{}={}".format(k, remote_repr(v)) for k, v in kwargs.items()]
+    return ', '.join(args_arr + kwargs_arr)
+
+
+def remote_func_name(func):
+    """Returns the name of a function which gets run on the pyboard."""
+    if hasattr(func, 'extra_funcs'):
+        return func.name
+    return func.__name__
+
+
 def print_bytes(byte_str):
     """Prints a string or converts bytes to a string and then prints."""
     if isinstance(byte_str, str):
@@ -621,6 +811,56 @@ def auto(func, filename, *args, **kwargs):
     return dev.remote_eval(func, dev_filename, *args, **kwargs)
 
 
+def auto_batch(calls):
+    """Like auto, but for a list of calls of the form (func, filename, args...).
+       Calls for files on the host are made locally, and all of the calls for
+       files on a given board are made using a single remote_batch. Returns a
+       list containing the result of each call.
+    """
+    results = [None] * len(calls)
+    dev_calls = {}
+    for idx, call in enumerate(calls):
+        func, filename, args = call[0], call[1], tuple(call[2:])
+        dev, dev_filename = get_dev_and_path(filename)
+        if dev is None:
+            if len(dev_filename) > 0 and dev_filename[0] == '~':
+                dev_filename = os.path.expanduser(dev_filename)
+            results[idx] = func(dev_filename, *args)
+        else:
+            dev_calls.setdefault(dev, []).append((idx, (func, (dev_filename,) + args, {})))
+    for dev, idx_calls in dev_calls.items():
+        dev_results = dev.remote_batch([call for _, call in idx_calls])
+        for (idx, _), result in zip(idx_calls, dev_results):
+            results[idx] = result
+    return results
+
+
+def auto_stream(func, filenames, record_func, *args):
+    """Like auto, but for functions (like list_files) which take a list of
+       filenames and produce a stream of records, rather than returning a
+       result. record_func is called with each record as it arrives.
+       Consecutive filenames on the same board are handled by a single
+       remote_stream. Each of filenames can also be a tuple starting with
+       the filename, followed by other values for func (like the pattern
+       for list_files).
+    """
+    dev_filenames = []
+    for entry in filenames:
+        filename = entry[0] if isinstance(entry, tuple) else entry
+        dev, dev_filename = get_dev_and_path(filename)
+        if dev is None and dev_filename[:1] == '~':
+            dev_filename = os.path.expanduser(dev_filename)
+        if isinstance(entry, tuple):
+            dev_filename = (dev_filename,) + entry[1:]
+        dev_filenames.append((dev, dev_filename))
+    for dev, group in itertools.groupby(dev_filenames, key=lambda entry: entry[0]):
+        group_filenames = [dev_filename for _, dev_filename in group]
+        if dev is None:
+            func(group_filenames, *args, emit=record_func)
+        else:
+            dev.remote_stream(func, record_func, group_filenames, *args)
+
+
 def board_name(default):
     """Returns the boards name (if available)."""
     try:
@@ -651,8 +891,31 @@ def cat(src_filename, dst_file):
                 dst_file.write(line)
     else:
         filesize = dev.remote_eval(get_filesize, dev_filename)
-        return dev.remote(send_file_to_host, dev_filename, dst_file, filesize,
-                          xfer_func=recv_file_from_remote)
+        with PROGRESS.file(src_filename, filesize):
+            return dev.remote(send_file_to_host, dev_filename, dst_file, filesize,
+                              xfer_func=recv_file_from_remote)
+
+
+def cat_range(src_filename, dst_file, start, end):
+    """Copies the bytes from start up to end of the indicated file to an
+       already opened file. For files on a board, only those bytes are
+       transferred.
+    """
+    if start >= end:
+        return True
+    (dev, dev_filename) = get_dev_and_path(src_filename)
+    if dev is not None:
+        return download_file(dev, dev_filename, dst_file, end, start)
+    with open(dev_filename, 'rb') as src_file:
+        src_file.seek(start)
+        bytes_remaining = end - start
+        while bytes_remaining > 0:
+            buf = src_file.read(min(bytes_remaining, BUFFER_SIZE))
+            if not buf:
+                break
+            dst_file.write(buf)
+            bytes_remaining -= len(buf)
+    return True
 
 
 def chdir(dirname):
@@ -679,9 +942,10 @@ def copy_file(src_filename, dst_filename):
         return False
 
 
-def cp(src_filename, dst_filename):
+def cp(src_filename, dst_filename, filesize=None):
     """Copies one file to another. The source file may be local or remote and
-       the destination file may be local or remote.
+       the destination file may be local or remote. filesize may be passed
+       in if the caller already knows the size of the source file.
     """
     src_dev, src_dev_filename = get_dev_and_path(src_filename)
     dst_dev, dst_dev_filename = get_dev_and_path(dst_filename)
@@ -689,30 +953,235 @@ def cp(src_filename, dst_filename):
         # src and dst are either on the same remote, or both are on the host
         return auto(copy_file, src_filename, dst_dev_filename)
 
-    filesize = auto(get_filesize, src_filename)
+    if filesize is None:
+        filesize = auto(get_filesize, src_filename)
 
     if dst_dev is None:
         # Copying from remote to host
-        with open(dst_dev_filename, 'wb') as dst_file:
-            return src_dev.remote(send_file_to_host, src_dev_filename, dst_file,
-                                  filesize, xfer_func=recv_file_from_remote)
+        with open(dst_dev_filename, 'wb') as dst_file, PROGRESS.file(src_filename, filesize):
+            return download_file(src_dev, src_dev_filename, dst_file, filesize)
     if src_dev is None:
         # Copying from host to remote
-        with open(src_dev_filename, 'rb') as src_file:
-            return dst_dev.remote(recv_file_from_host, src_file, dst_dev_filename,
-                                  filesize, xfer_func=send_file_to_remote)
+        with open_for_upload(src_dev_filename, filesize) as src_file, \
+                PROGRESS.file(src_filename, filesize):
+            return upload_file(dst_dev, src_file, dst_dev_filename, filesize)
 
     # Copying from remote A to remote B. We first copy the file
     # from remote A to the host and then from the host to remote B
     host_temp_file = tempfile.TemporaryFile()
-    if src_dev.remote(send_file_to_host, src_dev_filename, host_temp_file,
-                      filesize, xfer_func=recv_file_from_remote):
-        host_temp_file.seek(0)
-        return dst_dev.remote(recv_file_from_host, host_temp_file, dst_dev_filename,
-                              filesize, xfer_func=send_file_to_remote)
+    with PROGRESS.file(src_filename, filesize * 2):
+        if download_file(src_dev, src_dev_filename, host_temp_file, filesize):
+            host_temp_file.seek(0)
+            return upload_file(dst_dev, host_temp_file, dst_dev_filename, filesize)
+    return False
+
+
+def cp_range(src_filename, dst_filename, start, end):
+    """Copies the bytes from start up to end of one file to another file.
+       The source file may be local or remote and the destination file may
+       be local or remote. Only the requested bytes are read from the
+       source file.
+    """
+    src_dev = get_dev_and_path(src_filename)[0]
+    dst_dev, dst_dev_filename = get_dev_and_path(dst_filename)
+    if dst_dev is None:
+        with open(dst_dev_filename, 'wb') as dst_file, PROGRESS.file(src_filename, end - start):
+            return cat_range(src_filename, dst_file, start, end)
+    # The range is collected on the host, and then copied to the remote
+    host_temp_file = tempfile.TemporaryFile()
+    with PROGRESS.file(src_filename, (end - start) * (1 if src_dev is None else 2)):
+        if cat_range(src_filename, host_temp_file, start, end):
+            host_temp_file.seek(0)
+            return upload_file(dst_dev, host_temp_file, dst_dev_filename, end - start)
     return False
 
 
+def retry_xfer(xfer, offset=0):
+    """Calls xfer(offset) to transfer a file, starting with the given offset.
+       If the transfer times out, it's retried (up to XFER_RETRIES times),
+       carrying on from where it got to.
+    """
+    for attempt in range(XFER_RETRIES + 1):
+        try:
+            return xfer(offset)
+        except TransferError as err:
+            if attempt == XFER_RETRIES:
+                raise
+            print_err('{} - retrying'.format(err))
+            STATS.add('xfer_retries')
+            offset = err.done
+
+
+def download_file(src_dev, src_dev_filename, dst_file, filesize, offset=0):
+    """Copies a file from a board into an already opened file on the host.
+       Only the bytes from offset up to filesize are copied.
+    """
+    return retry_xfer(lambda offset: src_dev.remote(send_file_to_host, src_dev_filename,
+                                                    dst_file, filesize, offset=offset,
+                                                    xfer_func=recv_file_from_remote),
+                      offset)
+
+
+def upload_file(dst_dev, src_file, dst_dev_filename, filesize):
+    """Copies an already opened file on the host to a board. If the upload
+       is abandoned, the temporary file which it was being written to on the
+       board is removed.
+    """
+    temp_filename = dst_dev_filename + TEMP_SUFFIX
+
+    def upload(offset):
+        if offset:
+            # Only the part of the temporary file which was written out can be kept
+            offset = max(min(offset, dst_dev.remote_eval(get_filesize, temp_filename)), 0)
+        src_file.seek(offset)
+        return dst_dev.remote_eval(recv_file_from_host, src_file, dst_dev_filename,
+                                   filesize, checksum=True, offset=offset,
+                                   xfer_func=send_file_to_remote)
+
+    try:
+        return retry_xfer(upload)
+    except TransferError:
+        try:
+            dst_dev.remote_eval(remove_file, temp_filename)
+        except DeviceError:
+            pass
+        raise
+
+
+def file_checksum(src_file):
+    """Returns the hexlified sha256 of an open file, leaving the file
+       positioned at the start.
+    """
+    hasher = hashlib.sha256()
+    while True:
+        buf = src_file.read(65536)
+        if not buf:
+            break
+        hasher.update(buf)
+    src_file.seek(0)
+    return binascii.hexlify(hasher.digest())
+
+
+def mpy_cross_version():
+    """Returns a tuple containing the version string reported by mpy-cross
+       and the .mpy version that it emits (or None if that can't be parsed).
+    """
+    global MPY_CROSS_VERSION
+    if MPY_CROSS_VERSION is None:
+        try:
+            output = subprocess.check_output([MPY_CROSS, '--version'],
+                                             stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            raise ShellError("Unable to run '{}'. --mpy requires mpy-cross to be installed."
+                             .format(MPY_CROSS))
+        version = str(output, encoding='utf-8').strip()
+        match = re.search(r'mpy v(\d+)', version)
+        MPY_CROSS_VERSION = (version, int(match.group(1)) if match else None)
+    return MPY_CROSS_VERSION
+
+
+def is_mpy_source(filename):
+    """Determines if filename is a python source file which --mpy compiles."""
+    basename = os.path.basename(filename)
+    return basename.endswith('.py') and basename not in MPY_EXCLUDE
+
+
+def mpy_name(filename):
+    """Returns the name used for the compiled version of filename."""
+    if filename.endswith('.py'):
+        return filename[:-3] + '.mpy'
+    return filename
+
+
+def mpy_compile(src_filename, dev):
+    """Cross compiles a python source file on the host into a .mpy file
+       which can be imported by dev.
+
+       Compiled files are kept in a cache keyed by a hash of the source, the
+       compiler version and the options, so unchanged files are never
+       recompiled. Returns the filename of the compiled file, or None if the
+       file couldn't be compiled.
+    """
+    version, emits = mpy_cross_version()
+    options = []
+    board_mpy = dev.get_mpy_version()
+    if board_mpy is not None:
+        if emits is not None and emits != board_mpy & 0xff:
+            raise ShellError("{} emits .mpy v{}, but board '{}' requires v{}"
+                             .format(MPY_CROSS, emits, dev.name, board_mpy & 0xff))
+        arch = (board_mpy >> 10) & 0x0f
+        if 0 < arch < len(MPY_ARCHS):
+            options.append('-march=' + MPY_ARCHS[arch])
+    options += ['-s', os.path.basename(src_filename)]
+    with open(src_filename, 'rb') as src_file:
+        source = src_file.read()
+    key = hashlib.sha256()
+    for item in [version] + options:
+        key.update(bytes(item, encoding='utf-8') + b'\0')
+    key.update(source)
+    cache_filename = os.path.join(MPY_CACHE_DIR, key.hexdigest() + '.mpy')
+    if os.path.exists(cache_filename):
+        STATS.add('mpy_cache_hits')
+        return cache_filename
+    os.makedirs(MPY_CACHE_DIR, exist_ok=True)
+    temp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+    try:
+        subprocess.check_output([MPY_CROSS] + options + ['-o', temp_filename, src_filename],
+                                stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as err:
+        print_err(str(err.output, encoding='utf-8').rstrip())
+        print_err("Unable to compile '{}'".format(src_filename))
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        return None
+    os.replace(temp_filename, cache_filename)
+    STATS.add('mpy_compiles')
+    return cache_filename
+
+
+def edit_cache_filenames(dev, dev_filename):
+    """Returns the filename of the copy of a file on a board which edit
+       keeps in its cache, and the filename of the JSON file recording the
+       size, mtime and sha256 of the file on the board when it was copied.
+       The copy keeps the basename of the file, so that editors still
+       recognize the file type.
+    """
+    key = hashlib.sha256(bytes(dev.name + '\0' + dev_filename, encoding='utf-8')).hexdigest()
+    cache_dir = os.path.join(EDIT_CACHE_DIR, key)
+    return os.path.join(cache_dir, os.path.basename(dev_filename)), cache_dir + '.json'
+
+
+def host_checksum(filename):
+    """Returns the hexlified sha256 of a file on the host (as a str), or
+       None if the file doesn't exist.
+    """
+    try:
+        with open(filename, 'rb') as file:
+            return str(file_checksum(file), encoding='utf-8')
+    except OSError:
+        return None
+
+
+def load_edit_state(state_filename):
+    """Returns the state recorded by save_edit_state, or {} if there isn't any."""
+    try:
+        with open(state_filename) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_edit_state(state_filename, stat, checksum):
+    """Records the size and mtime (from stat) of a file on a board, along
+       with the checksum of its contents, once edit has a copy of it.
+    """
+    state = {'size': stat_size(stat), 'mtime': stat_mtime(stat), 'sha256': checksum}
+    temp_filename = '{}.{}.tmp'.format(state_filename, os.getpid())
+    with open(temp_filename, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(temp_filename, state_filename)
+
+
 def date():
     import time
     tm = time.localtime()
@@ -736,6 +1205,14 @@ def get_vfs_stats(filename):
         return -1
 
 
+@extra_funcs(get_vfs_stats)
+def get_vfs_stats_list(dirnames):
+    """Returns the filesystem statistics (see get_vfs_stats) for each of
+       dirnames, using a single call.
+    """
+    return [get_vfs_stats(dirname) for dirname in dirnames]
+
+
 def get_filesize(filename):
     """Returns the size of a file, in bytes."""
     import os
@@ -747,6 +1224,85 @@ def get_filesize(filename):
         return -1
 
 
+def get_checksum(filename):
+    """Returns the hexlified sha256 of a file, or None if the file can't be
+       read or the firmware lacks sha256.
+    """
+    try:
+        try:
+            import ubinascii as binascii
+        except ImportError:
+            import binascii
+        try:
+            import uhashlib as hashlib
+        except ImportError:
+            import hashlib
+        hasher = hashlib.sha256()
+        buf = bytearray(512)
+        with open(filename, 'rb') as file:
+            while True:
+                num_bytes = file.readinto(buf)
+                if not num_bytes:
+                    break
+                hasher.update(memoryview(buf)[0:num_bytes])
+        return binascii.hexlify(hasher.digest())
+    except:
+        return None
+
+
+def line_range(filename, num_lines, from_end):
+    """Returns the (start, end) byte offsets of the first num_lines lines
+       of a file, or of the last num_lines lines if from_end is True, or
+       None if the file can't be read. Only the part of the file which
+       contains those lines is read, working backwards for from_end.
+    """
+    import os
+    # The file is read locally, so the chunks can be bigger than BUFFER_SIZE
+    chunk_size = 512
+    try:
+        filesize = os.stat(filename)[6]
+        with open(filename, 'rb') as file:
+            if not from_end:
+                end = 0
+                while num_lines > 0:
+                    data = file.read(chunk_size)
+                    if not data:
+                        break
+                    idx = 0
+                    while num_lines > 0:
+                        idx = data.find(b'\n', idx)
+                        if idx < 0:
+                            break
+                        idx += 1
+                        num_lines -= 1
+                    end += idx if num_lines == 0 else len(data)
+                return (0, end)
+            pos = filesize
+            if filesize > 0:
+                # A newline at the very end doesn't start another line
+                file.seek(filesize - 1)
+                if file.read(1) == b'\n':
+                    pos -= 1
+            if num_lines <= 0:
+                return (filesize, filesize)
+            while pos > 0:
+                size = min(pos, chunk_size)
+                pos -= size
+                file.seek(pos)
+                data = file.read(size)
+                idx = len(data)
+                while True:
+                    idx = data.rfind(b'\n', 0, idx)
+                    if idx < 0:
+                        break
+                    num_lines -= 1
+                    if num_lines == 0:
+                        return (pos + idx + 1, filesize)
+            return (0, filesize)
+    except OSError:
+        return None
+
+
 def get_mode(filename):
     """Returns the mode of a file, which can be used to determine if a file
        exists, if a file is a file or a directory.
@@ -793,6 +1349,30 @@ def sysname():
         return repr('unknown')
 
 
+def get_mem_free():
+    """Returns the amount of free heap memory, or None if it isn't known."""
+    try:
+        import gc
+        gc.collect()
+        return gc.mem_free()
+    except:
+        return None
+
+
+def write_buf_size(mem_free):
+    """Returns the size of the write buffer to use for a board with mem_free
+       bytes of free memory. An eighth of the free memory is used, so that
+       there's still plenty left for the rest of recv_file_from_host (and for
+       the heap to be fragmented).
+    """
+    if WRITE_BUF_SIZE:
+        return WRITE_BUF_SIZE
+    if not mem_free:
+        return MIN_WRITE_BUF_SIZE
+    size = (mem_free // 8) // MIN_WRITE_BUF_SIZE * MIN_WRITE_BUF_SIZE
+    return max(MIN_WRITE_BUF_SIZE, min(size, MAX_WRITE_BUF_SIZE))
+
+
 def is_visible(filename):
     """Determines if the file should be considered to be a non-hidden file."""
     return filename[0] != '.' and filename[-1] != '~'
@@ -821,9 +1401,14 @@ def get_lstat(filename):
 
 
 def listdir(dirname):
-    """Returns a list of filenames contained in the named directory."""
+    """Returns a list of filenames contained in the named directory, or
+       None if the directory does not exist.
+    """
     import os
-    return os.listdir(dirname)
+    try:
+        return os.listdir(dirname)
+    except OSError:
+        return None
 
 
 def listdir_matches(match):
@@ -860,38 +1445,307 @@ def listdir_matches(match):
     return matches
 
 
-@extra_funcs(is_visible, lstat)
-def listdir_lstat(dirname, show_hidden=True):
+def ilistdir_stat(dirname, show_hidden, full_stat, stat_func):
+    """Generator which yields (filename, stat) for each file contained in
+       the named directory. Raises OSError if the directory doesn't exist.
+
+       os.ilistdir returns the type (and on most ports the size) of each
+       file, so unless full_stat is True (because the mtime is needed) the
+       stat is made up from those, with the other fields set to 0, rather
+       than calling stat_func for each file. stat_func is also used when
+       os.ilistdir isn't available (like on the host).
+    """
+    import os
+    prefix = '/' if dirname == '/' else dirname + '/'
+    if not hasattr(os, 'ilistdir'):
+        for file in os.listdir(dirname):
+            if is_visible(file) or show_hidden:
+                yield file, stat_func(prefix + file)
+        return
+    for entry in os.ilistdir(dirname):
+        file = entry[0]
+        if is_visible(file) or show_hidden:
+            if full_stat or entry[1] == 0:
+                yield file, stat_func(prefix + file)
+            else:
+                # Directory sizes are meaningless on littlefs. Some ports don't
+                # return the size of files, in which case it's left as -1.
+                if entry[1] == 0x4000:
+                    size = 0
+                else:
+                    size = entry[3] if len(entry) > 3 else -1
+                yield file, (entry[1], 0, 0, 0, 0, 0, size, 0, 0, 0)
+
+
+def walk_stat(dirname, show_hidden, full_stat, stat_func):
+    """Generator which yields (subdir, filename, stat) for each file in the
+       tree rooted at dirname, using ilistdir_stat. subdir is the path of
+       the file's directory relative to dirname ('' for dirname itself).
+       (subdir, None, None) is yielded before the files of each
+       subdirectory. A directory's files come before those of its
+       subdirectories, which are visited in sorted order. The walk doesn't
+       recurse, so only the names of the subdirectories which are still to
+       be visited are held in memory.
+    """
+    stack = ['']
+    while stack:
+        subdir = stack.pop()
+        if subdir:
+            yield subdir, None, None
+            path = dirname.rstrip('/') + '/' + subdir
+        else:
+            path = dirname
+        subdirs = []
+        try:
+            for file, fstat in ilistdir_stat(path, show_hidden, full_stat, stat_func):
+                yield subdir, file, fstat
+                if (fstat[0] & 0xf000) == 0x4000:
+                    subdirs.append(subdir + '/' + file if subdir else file)
+        except OSError:
+            # Only the root not existing is an error. Subdirectories which
+            # can't be read are skipped.
+            if not subdir:
+                raise
+        subdirs.sort(reverse=True)
+        stack.extend(subdirs)
+
+
+def fnmatch_class(pattern, idx, char):
+    """Matches char against the [seq] or [!seq] which starts at pattern[idx].
+       Returns whether it matched and the index following the closing ],
+       or None and idx if there isn't a closing ].
+    """
+    idx += 1
+    negate = pattern[idx:idx + 1] == '!'
+    if negate:
+        idx += 1
+    start = idx
+    matched = False
+    # A ] straight after the [ (or [!) is part of the sequence
+    while idx < len(pattern) and (pattern[idx] != ']' or idx == start):
+        if pattern[idx + 1:idx + 2] == '-' and pattern[idx + 2:idx + 3] not in ('', ']'):
+            if pattern[idx] <= char <= pattern[idx + 2]:
+                matched = True
+            idx += 3
+        else:
+            if pattern[idx] == char:
+                matched = True
+            idx += 1
+    if idx >= len(pattern):
+        return None, start
+    return matched != negate, idx + 1
+
+
+def fnmatch_name(name, pattern):
+    """Returns True if name matches pattern, which supports the * ? [seq] and
+       [!seq] Unix filename matching. This is like fnmatch.fnmatchcase, which
+       isn't available on the board.
+    """
+    name_idx = pattern_idx = 0
+    # Where the last * was seen, so it can be made to match one more
+    # character if the rest of the pattern doesn't match.
+    star_pattern_idx = star_name_idx = -1
+    while name_idx < len(name):
+        matched = False
+        if pattern_idx < len(pattern):
+            char = pattern[pattern_idx]
+            if char == '*':
+                star_pattern_idx = pattern_idx
+                star_name_idx = name_idx
+                pattern_idx += 1
+                continue
+            next_idx = pattern_idx + 1
+            if char == '[':
+                matched, next_idx = fnmatch_class(pattern, pattern_idx, name[name_idx])
+                if matched is None:
+                    matched, next_idx = name[name_idx] == '[', pattern_idx + 1
+            else:
+                matched = char == '?' or char == name[name_idx]
+        if matched:
+            name_idx += 1
+            pattern_idx = next_idx
+        elif star_pattern_idx < 0:
+            return False
+        else:
+            star_name_idx += 1
+            name_idx = star_name_idx
+            pattern_idx = star_pattern_idx + 1
+    return pattern[pattern_idx:].strip('*') == ''
+
+
+@extra_funcs(is_visible, lstat, ilistdir_stat)
+def listdir_lstat(dirname, show_hidden=True, full_stat=True):
     """Returns a list of tuples for each file contained in the named
        directory, or None if the directory does not exist. Each tuple
        contains the filename, followed by the tuple returned by
-       calling os.stat on the filename.
+       calling os.stat on the filename. If full_stat is False, only the
+       mode and size are filled in (see ilistdir_stat).
     """
-    import os
     try:
-        files = os.listdir(dirname)
+        return list(ilistdir_stat(dirname, show_hidden, full_stat, lstat))
     except OSError:
         return None
-    if dirname == '/':
-        return list((file, lstat('/' + file)) for file in files if is_visible(file) or show_hidden)
-    return list((file, lstat(dirname + '/' + file)) for file in files if is_visible(file) or show_hidden)
 
 
-@extra_funcs(is_visible, stat)
-def listdir_stat(dirname, show_hidden=True):
+@extra_funcs(is_visible, stat, ilistdir_stat)
+def listdir_stat(dirname, show_hidden=True, full_stat=True):
     """Returns a list of tuples for each file contained in the named
        directory, or None if the directory does not exist. Each tuple
        contains the filename, followed by the tuple returned by
-       calling os.stat on the filename.
+       calling os.stat on the filename. If full_stat is False, only the
+       mode and size are filled in (see ilistdir_stat).
     """
-    import os
     try:
-        files = os.listdir(dirname)
+        return list(ilistdir_stat(dirname, show_hidden, full_stat, stat))
     except OSError:
         return None
-    if dirname == '/':
-        return list((file, stat('/' + file)) for file in files if is_visible(file) or show_hidden)
-    return list((file, stat(dirname + '/' + file)) for file in files if is_visible(file) or show_hidden)
+
+
+@extra_funcs(is_visible, stat, lstat, ilistdir_stat, walk_stat, fnmatch_class, fnmatch_name)
+def list_files(filenames, show_hidden=True, full_stat=True, recursive=False, emit=None):
+    """Function which runs on the pyboard. Matches up with Device.follow_records.
+
+       For each of filenames, emits its stat (all 0's if it doesn't exist),
+       followed by (filename, lstat) for each of the files it contains if
+       it's a directory, and then None. If recursive is True, the files in
+       each subdirectory follow, preceded by the path of the subdirectory
+       (relative to the directory being listed). Directories are read one
+       entry at a time using ilistdir_stat, so the listing is never held in
+       memory, and the files are only stat'ed if full_stat is True. On the
+       board, each record is printed as a line containing its repr. On the
+       host, emit is called with each record.
+
+       Each of filenames can also be a (filename, pattern) tuple, in which
+       case only the files whose names match pattern are emitted. Patterns
+       only apply to the directory they're in, so its subdirectories aren't
+       walked, even if recursive is True.
+    """
+    if emit is None:
+        emit = lambda record: print(repr(record))
+    for filename in filenames:
+        pattern = None
+        if isinstance(filename, tuple):
+            filename, pattern = filename
+        try:
+            fstat = stat(filename)
+        except OSError:
+            fstat = (0,) * 10
+        emit(fstat)
+        if fstat[0] & 0x4000:
+            if pattern is not None:
+                for entry in ilistdir_stat(filename, show_hidden, full_stat, lstat):
+                    if fnmatch_name(entry[0], pattern):
+                        emit(entry)
+            elif recursive:
+                for subdir, file, entry_stat in walk_stat(filename, show_hidden, full_stat, lstat):
+                    emit(subdir if file is None else (file, entry_stat))
+            else:
+                for entry in ilistdir_stat(filename, show_hidden, full_stat, lstat):
+                    emit(entry)
+        emit(None)
+
+
+@extra_funcs(is_visible, stat, lstat, ilistdir_stat, walk_stat, fnmatch_class, fnmatch_name)
+def find_files(filenames, pattern=None, newer=None, file_type=None, emit=None):
+    """Function which runs on the pyboard. Matches up with Device.follow_records.
+
+       For each of filenames, walks the tree rooted at it, and emits the
+       path (relative to filename, so '' for filename itself) of each file
+       whose name matches pattern, which was modified after newer, and whose
+       type is file_type ('f' or 'd'). Any of these can be None to match
+       everything. False is emitted if filename doesn't exist, and None
+       follows the paths for each filename.
+    """
+    if emit is None:
+        emit = lambda record: print(repr(record))
+
+    def matches(name, fstat):
+        if pattern is not None and not fnmatch_name(name, pattern):
+            return False
+        if file_type is not None and ((fstat[0] & 0xf000) == 0x4000) != (file_type == 'd'):
+            return False
+        return newer is None or fstat[8] > newer
+
+    for filename in filenames:
+        try:
+            fstat = stat(filename)
+        except OSError:
+            emit(False)
+            emit(None)
+            continue
+        if matches(filename.rstrip('/').split('/')[-1], fstat):
+            emit('')
+        if fstat[0] & 0x4000:
+            for subdir, file, entry_stat in walk_stat(filename, True, newer is not None, lstat):
+                if file is not None and matches(file, entry_stat):
+                    emit(subdir + '/' + file if subdir else file)
+        emit(None)
+
+
+def du_tree(dirname, summarize, emit):
+    """Returns the total size of the files in the tree rooted at dirname.
+       Unless summarize is True, (subdir, size) is emitted for each of its
+       subdirectories, after their contents, and then ('', size) for
+       dirname itself. Like walk_stat, the walk doesn't recurse: the stack
+       holds the path, the size so far and the names of the subdirectories
+       still to be visited for each level.
+    """
+    stack = []
+    subdir = ''
+    while True:
+        path = dirname.rstrip('/') + '/' + subdir if subdir else dirname
+        total = 0
+        subdirs = []
+        try:
+            for file, fstat in ilistdir_stat(path, True, False, lstat):
+                if (fstat[0] & 0xf000) == 0x4000:
+                    subdirs.append(subdir + '/' + file if subdir else file)
+                elif fstat[6] < 0:
+                    total += lstat(path.rstrip('/') + '/' + file)[6]
+                else:
+                    total += fstat[6]
+        except OSError:
+            # Subdirectories which can't be read are skipped (like in walk_stat)
+            if not subdir:
+                raise
+        subdirs.reverse()
+        stack.append([subdir, total, subdirs])
+        # Finish off the directories which have no subdirectories left to visit
+        while not stack[-1][2]:
+            subdir, total, _ = stack.pop()
+            if not summarize:
+                emit((subdir, total))
+            if not stack:
+                return total
+            stack[-1][1] += total
+        subdir = stack[-1][2].pop()
+
+
+@extra_funcs(is_visible, stat, lstat, ilistdir_stat, du_tree)
+def disk_usage(filenames, summarize=False, emit=None):
+    """Function which runs on the pyboard. Matches up with Device.follow_records.
+
+       For each of filenames, emits (path, size) for each directory in the
+       tree rooted at it (see du_tree), or just for filename itself if
+       summarize is True. Paths are relative to filename. False is emitted
+       if filename doesn't exist, and None follows the sizes for each
+       filename.
+    """
+    if emit is None:
+        emit = lambda record: print(repr(record))
+    for filename in filenames:
+        try:
+            fstat = stat(filename)
+        except OSError:
+            emit(False)
+        else:
+            if fstat[0] & 0x4000 == 0:
+                emit(('', fstat[6]))
+            else:
+                total = du_tree(filename, summarize, emit)
+                if summarize:
+                    emit(('', total))
+        emit(None)
 
 
 def make_directory(dirname):
@@ -938,12 +1792,103 @@ def rm(filename, recursive=False, force=False):
     return auto(remove_file, filename, recursive, force)
 
 
+def remove_targets(targets, recursive=False, force=False):
+    """Removes each of targets, which are (path, pattern) tuples (see
+       remove_files). Consecutive targets on the same board are removed
+       using a single remote call. Returns a list containing the result
+       from remove_files for each target.
+    """
+    results = []
+    dev_targets = [(get_dev_and_path(path), pattern) for path, pattern in targets]
+    for dev, group in itertools.groupby(dev_targets, key=lambda target: target[0][0]):
+        group = [(dev_path, pattern) for (_, dev_path), pattern in group]
+        if dev is None:
+            results += remove_files(group, recursive, force)
+        else:
+            results += dev.remote_eval(remove_files, group, recursive, force)
+    return results
+
+
+@extra_funcs(make_directory, remove_file)
+def batch_fs_ops(ops):
+    """Carries out a list of mkdir and rm operations. Each operation is a
+       tuple (cmd_idx, 'mkdir', dirname) or
+       (cmd_idx, 'rm', filename, recursive, force). Like the rm command,
+       every operation is attempted, even after one has failed. Returns a
+       list containing True or False for each operation.
+    """
+    results = []
+    for op in ops:
+        if op[1] == 'mkdir':
+            results.append(make_directory(op[2]))
+        else:
+            results.append(remove_file(op[2], op[3], op[4]))
+    return results
+
+
+@extra_funcs(remove_file, fnmatch_class, fnmatch_name)
+def remove_files(targets, recursive=False, force=False):
+    """Removes each of targets, which are (path, pattern) tuples. If pattern
+       is None, path is removed, otherwise every file in the directory path
+       whose name matches pattern is. Returns a tuple for each target made
+       up of the number of files removed and a list of the ones which
+       couldn't be removed, or (0, None) if a pattern didn't match anything.
+
+       The directory is listed in batches of up to 32 matching files, which
+       are removed before listing it again, so that a directory with
+       thousands of files can be cleaned out on a board with little memory.
+    """
+    import os
+    results = []
+    for path, pattern in targets:
+        if pattern is None:
+            if remove_file(path, recursive, force):
+                results.append((1, []))
+            else:
+                results.append((0, [path]))
+            continue
+        prefix = '/' if path == '/' else path + '/'
+        removed = 0
+        failed = []
+        skip = []    # Files which failed, or which -f couldn't remove
+        while True:
+            batch = []
+            try:
+                files = os.ilistdir(path) if hasattr(os, 'ilistdir') else os.listdir(path)
+                for file in files:
+                    if not isinstance(file, str):
+                        file = file[0]
+                    if fnmatch_name(file, pattern) and prefix + file not in skip:
+                        batch.append(prefix + file)
+                        if len(batch) >= 32:
+                            break
+            except OSError:
+                pass
+            for filename in batch:
+                if not remove_file(filename, recursive, force):
+                    failed.append(filename)
+                    skip.append(filename)
+                    continue
+                if force:
+                    try:
+                        os.stat(filename)
+                        skip.append(filename)
+                        continue
+                    except OSError:
+                        pass
+                removed += 1
+            if len(batch) < 32:
+                break
+        results.append((removed, failed) if removed or failed else (0, None))
+    return results
+
+
 def make_dir(dst_dir, dry_run, print_func, recursed):
     """Creates a directory. Produces information in case of dry run.
     Issues error where necessary.
     """
     parent = os.path.split(dst_dir.rstrip('/'))[0] # Check for nonexistent parent
-    parent_files = auto(listdir_lstat, parent) if parent else True # Relative dir
+    parent_files = auto(listdir_lstat, parent, full_stat=False) if parent else True # Relative dir
     if dry_run:
         if recursed: # Assume success: parent not actually created yet
             print_func("Creating directory {}".format(dst_dir))
@@ -956,13 +1901,96 @@ def make_dir(dst_dir, dry_run, print_func, recursed):
     return True
 
 
-def rsync(src_dir, dst_dir, mirror, dry_run, print_func, recursed, sync_hidden):
-    """Synchronizes 2 directory trees."""
+def rsync_changes(src_dir, dst_dir, changed, mirror, print_func, sync_hidden,
+                  mpy=False, delta=False, stage=False):
+    """Synchronizes the paths in changed (which are relative to src_dir) for
+       rsync --watch, without comparing the rest of the trees. Directories
+       are synchronized using rsync and, if mirror is True, files which no
+       longer exist in src_dir are removed from dst_dir. Everything goes
+       into a single Bundle, so with stage the removals are deferred until
+       the files have been uploaded, just like rsync.
+    """
+    dst_dev = get_dev_and_path(dst_dir)[0]
+    handled = []    # Paths whose contents have already been taken care of
+    dirs = []
+    files = []
+    removals = []
+    for relpath in sorted(changed):
+        parts = relpath.split(os.sep) if relpath else []
+        if not sync_hidden and any(part.startswith('.') for part in parts):
+            continue
+        if any(not path or relpath == path or relpath.startswith(path + os.sep)
+               for path in handled):
+            continue
+        src_filename = os.path.join(src_dir, relpath) if relpath else src_dir
+        dst_filename = '/'.join([dst_dir] + parts)
+        src_mode = get_mode(src_filename)
+        if mode_isdir(src_mode):
+            dirs.append((src_filename, dst_filename))
+            handled.append(relpath)
+        elif mode_isfile(src_mode):
+            if mpy and is_mpy_source(src_filename):
+                src_filename = mpy_compile(src_filename, dst_dev)
+                if src_filename is None:
+                    continue
+                dst_filename = mpy_name(dst_filename)
+            files.append((src_filename, dst_filename))
+        elif mirror:
+            if mpy and is_mpy_source(dst_filename):
+                dst_filename = mpy_name(dst_filename)
+            removals.append((dst_filename, None))
+            handled.append(relpath)
+
+    bundle = Bundle(dst_dir, delta=delta, stage=stage)
+    for src_filename, dst_filename in dirs:
+        rsync(src_filename, dst_filename, mirror=mirror, dry_run=False, print_func=print_func,
+              recursed=False, sync_hidden=sync_hidden, mpy=mpy, bundle=bundle)
+    if files:
+        if delta:
+            dst_stats = auto_batch([(get_stat, dst_filename) for _, dst_filename in files])
+        else:
+            dst_stats = [None] * len(files)
+        for (src_filename, dst_filename), dst_stat in zip(files, dst_stats):
+            print_func('Updating %s' % dst_filename)
+            dst_size = None
+            if dst_stat is not None and mode_isfile(stat_mode(dst_stat)):
+                dst_size = stat_size(dst_stat)
+            bundle.add_file(src_filename, dst_filename, dst_size)
+    for dst_filename, _ in removals:
+        print_func('Removing %s' % dst_filename)
+        if stage:
+            bundle.removals.append(dst_filename)
+    bundle.upload()
+    if removals and not stage:
+        remove_targets(removals, recursive=True, force=True)
+
+
+def rsync(src_dir, dst_dir, mirror, dry_run, print_func, recursed, sync_hidden,
+          mpy=False, delta=False, stage=False, bundle=None):
+    """Synchronizes 2 directory trees. If mpy is True then python files
+       copied from the host to a board are compiled into .mpy files.
+
+       When synchronizing from the host to a board, the directories and
+       files which need to be created are collected into a Bundle, which is
+       uploaded in a single transfer once the whole tree has been compared.
+       If delta is True, then large files which already exist on the board
+       are updated by sending just the blocks which changed. If stage is
+       True, then nothing on the board is replaced or removed until all of
+       the files have been uploaded.
+    """
     # This test is a hack to avoid errors when accessing /flash. When the
     # cache synchronisation issue is solved it should be removed
     if not isinstance(src_dir, str) or not len(src_dir):
         return
 
+    if (bundle is None and not dry_run and get_dev_and_path(src_dir)[0] is None and
+            get_dev_and_path(dst_dir)[0] is not None):
+        bundle = Bundle(dst_dir, delta=delta, stage=stage)
+        rsync(src_dir, dst_dir, mirror=mirror, dry_run=dry_run, print_func=print_func,
+              recursed=recursed, sync_hidden=sync_hidden, mpy=mpy, bundle=bundle)
+        bundle.upload()
+        return
+
     sstat = auto(get_stat, src_dir)
     smode = stat_mode(sstat)
     if mode_isfile(smode):
@@ -977,8 +2005,32 @@ def rsync(src_dir, dst_dir, mirror, dry_run, print_func, recursed, sync_hidden):
     for name, stat in src_files:
         d_src[name] = stat
 
+    # With --mpy, foo.py on the host is synchronized with foo.mpy on the board.
+    src_names = {}
+    dst_dev, _ = get_dev_and_path(dst_dir)
+    if mpy and dst_dev is not None and get_dev_and_path(src_dir)[0] is None:
+        for name in list(d_src.keys()):
+            if is_mpy_source(name) and mode_isfile(stat_mode(d_src[name])):
+                d_src[mpy_name(name)] = d_src.pop(name)
+                src_names[mpy_name(name)] = name
+
+    def copy(src_basename, dst_filename, dst_stat=None):
+        src_filename = src_dir + '/' + src_names.get(src_basename, src_basename)
+        if src_basename in src_names:
+            src_filename = mpy_compile(src_filename, dst_dev)
+            if src_filename is None:
+                return
+        if bundle is None:
+            cp(src_filename, dst_filename)
+        else:
+            bundle.add_file(src_filename, dst_filename,
+                            None if dst_stat is None else stat_size(dst_stat))
+
     d_dst = {}
-    dst_files = auto(listdir_stat, dst_dir, show_hidden=sync_hidden)
+    if bundle is not None and dst_dir in bundle.dirs:
+        dst_files = []  # The bundle creates the directory, so it starts off empty
+    else:
+        dst_files = auto(listdir_stat, dst_dir, show_hidden=sync_hidden)
     if dst_files is None: # Directory does not exist
         if not make_dir(dst_dir, dry_run, print_func, recursed):
             return
@@ -993,29 +2045,38 @@ def rsync(src_dir, dst_dir, mirror, dry_run, print_func, recursed, sync_hidden):
     to_upd = set_dst.intersection(set_src) # In both: may need updating
 
     for src_basename in to_add:  # Name in source but absent from destination
-        src_filename = src_dir + '/' + src_basename
+        src_filename = src_dir + '/' + src_names.get(src_basename, src_basename)
         dst_filename = dst_dir + '/' + src_basename
         print_func("Adding %s" % dst_filename)
         src_stat = d_src[src_basename]
         src_mode = stat_mode(src_stat)
         if not dry_run:
             if not mode_isdir(src_mode):
-                cp(src_filename, dst_filename)
+                copy(src_basename, dst_filename)
+            elif bundle is not None:
+                bundle.add_dir(dst_filename)
         if mode_isdir(src_mode):
             rsync(src_filename, dst_filename, mirror=mirror, dry_run=dry_run,
-                  print_func=print_func, recursed=True, sync_hidden=sync_hidden)
+                  print_func=print_func, recursed=True, sync_hidden=sync_hidden,
+                  mpy=mpy, bundle=bundle)
 
     if mirror:  # May delete
+        removals = []
         for dst_basename in to_del:  # In dest but not in source
             dst_filename = dst_dir + '/' + dst_basename
             print_func("Removing %s" % dst_filename)
             if not dry_run:
-                rm(dst_filename, recursive=True, force=True)
+                if bundle is not None and bundle.stage:
+                    bundle.removals.append(dst_filename)
+                else:
+                    removals.append((dst_filename, None))
+        if removals:
+            remove_targets(removals, recursive=True, force=True)
 
     for src_basename in to_upd:  # Names are identical
         src_stat = d_src[src_basename]
         dst_stat = d_dst[src_basename]
-        src_filename = src_dir + '/' + src_basename
+        src_filename = src_dir + '/' + src_names.get(src_basename, src_basename)
         dst_filename = dst_dir + '/' + src_basename
         src_mode = stat_mode(src_stat)
         dst_mode = stat_mode(dst_stat)
@@ -1023,7 +2084,8 @@ def rsync(src_dir, dst_dir, mirror, dry_run, print_func, recursed, sync_hidden):
             if mode_isdir(dst_mode):
                 # src and dst are both directories - recurse
                 rsync(src_filename, dst_filename, mirror=mirror, dry_run=dry_run,
-                      print_func=print_func, recursed=True, sync_hidden=sync_hidden)
+                      print_func=print_func, recursed=True, sync_hidden=sync_hidden,
+                      mpy=mpy, bundle=bundle)
             else:
                 msg = "Source '{}' is a directory and destination " \
                       "'{}' is a file. Ignoring"
@@ -1039,7 +2101,7 @@ def rsync(src_dir, dst_dir, mirror, dry_run, print_func, recursed, sync_hidden):
                     msg = "{} is newer than {} - copying"
                     print_func(msg.format(src_filename, dst_filename))
                     if not dry_run:
-                        cp(src_filename, dst_filename)
+                        copy(src_basename, dst_filename, dst_stat)
 
 
 # rtc_time[0] - year    4 digit
@@ -1103,123 +2165,1037 @@ def set_time(rtc_time):
 # no transformations, so if that's available, we use it, otherwise we need
 # to use hexlify in order to get unaltered data.
 
-def recv_file_from_host(src_file, dst_filename, filesize, dst_mode='wb'):
-    """Function which runs on the pyboard. Matches up with send_file_to_remote."""
+def rename_over(src_filename, dst_filename):
+    """Renames src_filename, replacing dst_filename if it exists."""
+    import os
+    try:
+        os.rename(src_filename, dst_filename)
+    except OSError:
+        # FAT won't rename over an existing file
+        os.remove(dst_filename)
+        os.rename(src_filename, dst_filename)
+
+
+def host_committed():
+    """Function which runs on the pyboard. Called by the functions which
+       receive data from send_file_to_remote once all of the data has
+       arrived. The host sends an ACK to confirm that it sent the data
+       itself. When the host gives up on a transfer, it sends Control-C
+       characters to finish it off instead, so they're never committed.
+    """
+    import sys
+    sys.stdout.write('\x06')
+    if HAS_BUFFER:
+        return sys.stdin.buffer.read(1) == b'\x06'
+    return sys.stdin.read(1) == '\x06'
+
+
+def read_from_host(view):
+    """Function which runs on the pyboard. Fills view (a bytearray or a
+       memoryview) with data from the host.
+    """
+    import sys
+    #rp2: import time
+    view = memoryview(view)
+    idx = 0
+    while idx < len(view):
+        if HAS_BUFFER:
+            idx += sys.stdin.buffer.readinto(view[idx:])
+        else:
+            idx += sys.stdin.readinto(view[idx:])
+            # The following sleep is required for the RPi Pico
+            #rp2: time.sleep_ms(20)
+
+
+def recv_blocks_from_host(filesize, dst_file=None):
+    """Function which runs on the pyboard. Receives filesize bytes sent by
+       send_file_to_remote, and yields them as memoryviews of up to
+       WRITE_BUF_SIZE bytes, each of which is only valid until the next one
+       is asked for.
+
+       Each chunk is read straight into the buffer after the previous one,
+       so nothing is allocated per chunk (except when hexlify is being
+       used), and the filesystem sees large writes no matter how small the
+       chunks on the wire are. The filesystem is synced according to
+       SYNC_BYTES, after flushing dst_file if there is one.
+    """
     import sys
     try:
         import ubinascii
     except:
         import binascii as ubinascii
     import os
+    view = memoryview(bytearray(max(WRITE_BUF_SIZE, BUFFER_SIZE)))
     if HAS_BUFFER:
-        try:
-            import micropython
-            # We don't want 0x03 bytes in the data to be interpreted as a Control-C
-            # This gets reset each time the REPL runs a line, so we don't need to
-            # worry about resetting it ourselves
-            micropython.kbd_intr(-1)
-        except:
-            pass
-    try:
-        #rp2: import time
-        with open(dst_filename, dst_mode) as dst_file:
-            bytes_remaining = filesize
-            if not HAS_BUFFER:
-                bytes_remaining *= 2  # hexlify makes each byte into 2
-            buf_size = BUFFER_SIZE
-            write_buf = bytearray(buf_size)
-            read_buf = bytearray(buf_size)
-            while bytes_remaining > 0:
+        chunk_size = BUFFER_SIZE
+    else:
+        chunk_size = BUFFER_SIZE // 2
+        hex_view = memoryview(bytearray(chunk_size * 2))
+    buf_len = 0
+    unsynced = 0
+    bytes_remaining = filesize
+    while bytes_remaining > 0:
+        read_size = min(bytes_remaining, chunk_size)
+        if buf_len + read_size > len(view) or (SYNC_BYTES < 0 and buf_len > 0):
+            yield view[0:buf_len]
+            unsynced += buf_len
+            buf_len = 0
+            if SYNC_BYTES < 0 or 0 < SYNC_BYTES <= unsynced:
+                if dst_file:
+                    dst_file.flush()
+                if hasattr(os, 'sync'):
+                    os.sync()
+                unsynced = 0
+        # Send back an ack as a form of flow control
+        sys.stdout.write('\x06')
+        if HAS_BUFFER:
+            read_from_host(view[buf_len:buf_len + read_size])
+        else:
+            read_from_host(hex_view[0:read_size * 2])
+            view[buf_len:buf_len + read_size] = ubinascii.unhexlify(hex_view[0:read_size * 2])
+        buf_len += read_size
+        bytes_remaining -= read_size
+    if buf_len > 0:
+        yield view[0:buf_len]
+
+
+@extra_funcs(rename_over, host_committed, read_from_host, recv_blocks_from_host)
+def recv_file_from_host(src_file, dst_filename, filesize, dst_mode='wb', checksum=False,
+                        offset=0):
+    """Function which runs on the pyboard. Matches up with send_file_to_remote.
+
+       When writing a new file, the data is written to a temporary file
+       which only replaces dst_filename once all of it has arrived. If
+       checksum is True, the host follows the commit with the sha256 of the
+       data, which it works out as it sends it, and the file must match
+       that too (if the firmware has sha256).
+       If the transfer isn't committed by the host, the temporary file is
+       left behind, and the transfer can be resumed by calling this again
+       with offset set to the number of bytes in the temporary file which
+       can be kept.
+
+       The data is received by recv_blocks_from_host, so it's written out
+       WRITE_BUF_SIZE bytes at a time and synced according to SYNC_BYTES.
+    """
+    import sys
+    try:
+        import ubinascii
+    except:
+        import binascii as ubinascii
+    import os
+    try:
+        import gc
+        gc.collect()
+    except:
+        pass
+    hasher = None
+    if checksum:
+        try:
+            try:
+                import uhashlib as hashlib
+            except ImportError:
+                import hashlib
+            hasher = hashlib.sha256()
+        except:
+            pass
+    write_filename = dst_filename
+    if dst_mode == 'wb':
+        write_filename = dst_filename + TEMP_SUFFIX
+    if HAS_BUFFER:
+        try:
+            import micropython
+            # We don't want 0x03 bytes in the data to be interpreted as a Control-C
+            # This gets reset each time the REPL runs a line, so we don't need to
+            # worry about resetting it ourselves
+            micropython.kbd_intr(-1)
+        except:
+            pass
+    try:
+        with open(write_filename, 'r+b' if offset else dst_mode) as dst_file:
+            if offset and hasher:
+                # Resuming, so the checksum needs to include what's already there
+                view = memoryview(bytearray(BUFFER_SIZE))
+                num_read = 0
+                while num_read < offset:
+                    num_bytes = dst_file.readinto(view[0:min(len(view), offset - num_read)])
+                    hasher.update(view[0:num_bytes])
+                    num_read += num_bytes
+                view = None
+            dst_file.seek(offset)
+            for block in recv_blocks_from_host(filesize - offset, dst_file):
+                dst_file.write(block)
+                if hasher:
+                    hasher.update(block)
+        if not host_committed():
+            return False
+        if checksum:
+            # The digest is always sent, even if we can't check it
+            if HAS_BUFFER:
+                expected = sys.stdin.buffer.read(64)
+            else:
+                expected = bytes(sys.stdin.read(64), 'utf-8')
+            if hasher and ubinascii.hexlify(hasher.digest()) != expected:
+                os.remove(write_filename)
+                return False
+        if write_filename != dst_filename:
+            rename_over(write_filename, dst_filename)
+        if hasattr(os, 'sync'):
+            os.sync()
+        return True
+    except:
+        if write_filename != dst_filename:
+            try:
+                os.remove(write_filename)
+            except:
+                pass
+        return False
+
+
+@extra_funcs(rename_over, host_committed, read_from_host)
+def recv_stream_from_host(src_file, dst_filename, dst_mode='wb'):
+    """Function which runs on the pyboard. Matches up with send_stream_to_remote.
+
+       Receives data whose length isn't known up front, as a series of
+       frames (see send_stream_to_remote). The data is collected into a
+       buffer of WRITE_BUF_SIZE bytes and synced like in recv_file_from_host.
+       When writing a new file, the data goes to a temporary file which
+       only replaces dst_filename once the host has committed the stream.
+    """
+    import sys
+    try:
+        import ubinascii
+    except:
+        import binascii as ubinascii
+    import os
+    try:
+        import gc
+        gc.collect()
+    except:
+        pass
+    write_filename = dst_filename
+    if dst_mode == 'wb':
+        write_filename = dst_filename + TEMP_SUFFIX
+    if HAS_BUFFER:
+        try:
+            import micropython
+            micropython.kbd_intr(-1)
+        except:
+            pass
+    try:
+        with open(write_filename, dst_mode) as dst_file:
+            buf = bytearray(max(WRITE_BUF_SIZE, BUFFER_SIZE))
+            view = memoryview(buf)
+            buf_len = 0
+            if HAS_BUFFER:
+                chunk_size = BUFFER_SIZE
+                header = bytearray(3)
+            else:
+                chunk_size = BUFFER_SIZE // 2
+                header = bytearray(6)
+                hex_view = memoryview(bytearray(chunk_size * 2))
+            unsynced = 0
+            while True:
                 # Send back an ack as a form of flow control
                 sys.stdout.write('\x06')
-                read_size = min(bytes_remaining, buf_size)
-                buf_remaining = read_size
-                buf_index = 0
-                while buf_remaining > 0:
-                    if HAS_BUFFER:
-                        bytes_read = sys.stdin.buffer.readinto(read_buf, read_size)
-                    else:
-                        bytes_read = sys.stdin.readinto(read_buf, read_size)
-                    # The following sleep is required for the RPi Pico
-                    #rp2: time.sleep_ms(20)
-                    if bytes_read > 0:
-                        write_buf[buf_index:bytes_read] = read_buf[0:bytes_read]
-                        buf_index += bytes_read
-                        buf_remaining -= bytes_read
+                read_from_host(header)
+                frame = header if HAS_BUFFER else ubinascii.unhexlify(header)
+                size = (frame[1] << 8) | frame[2]
+                if frame[0] != 2 or size > chunk_size:
+                    # Not a frame, so the host has given up (see Device.recover)
+                    raise OSError
+                if size == 0:
+                    break
+                if buf_len + size > len(buf):
+                    dst_file.write(view[0:buf_len])
+                    unsynced += buf_len
+                    buf_len = 0
                 if HAS_BUFFER:
-                    dst_file.write(write_buf[0:read_size])
+                    read_from_host(view[buf_len:buf_len + size])
                 else:
-                    dst_file.write(ubinascii.unhexlify(write_buf[0:read_size]))
-                if hasattr(os, 'sync'):
-                    os.sync()
-                bytes_remaining -= read_size
+                    read_from_host(hex_view[0:size * 2])
+                    view[buf_len:buf_len + size] = ubinascii.unhexlify(hex_view[0:size * 2])
+                buf_len += size
+                if SYNC_BYTES < 0:
+                    dst_file.write(view[0:buf_len])
+                    unsynced += buf_len
+                    buf_len = 0
+                if unsynced > 0 and (SYNC_BYTES < 0 or 0 < SYNC_BYTES <= unsynced):
+                    dst_file.flush()
+                    if hasattr(os, 'sync'):
+                        os.sync()
+                    unsynced = 0
+            if buf_len > 0:
+                dst_file.write(view[0:buf_len])
+        if not host_committed():
+            raise OSError
+        if write_filename != dst_filename:
+            rename_over(write_filename, dst_filename)
+        if hasattr(os, 'sync'):
+            os.sync()
         return True
     except:
+        if write_filename != dst_filename:
+            try:
+                os.remove(write_filename)
+            except:
+                pass
         return False
 
 
-def send_file_to_remote(dev, src_file, dst_filename, filesize, dst_mode='wb'):
+def xfer_deadline(num_bytes):
+    """Returns the time (from time.monotonic) by which a transfer of
+       num_bytes bytes has to have finished.
+    """
+    return time.monotonic() + XFER_CHUNK_TIMEOUT + num_bytes / XFER_MIN_RATE
+
+
+def wait_for_ack(dev, file_deadline, done, pending):
+    """Waits for the board to acknowledge a chunk sent by send_file_to_remote.
+       done is the number of bytes which the board is known to have received
+       and pending is the number which it may still be waiting for.
+    """
+    deadline = min(time.monotonic() + XFER_CHUNK_TIMEOUT, file_deadline)
+    ack_start = time.perf_counter()
+    while True:
+        ack = dev.read(1)
+        if ack == b'\x06':
+            STATS.add_time('ack_wait', time.perf_counter() - ack_start)
+            return
+        if ack:
+            # The function on the board stopped early, and is printing its result
+            dev.recover()
+            raise DeviceError('Unexpected response {!r} from {} during transfer'
+                              .format(ack, dev.name))
+        if time.monotonic() >= deadline:
+            dev.recover(pending)
+            raise TransferError('Timed out sending to {} after {} bytes'
+                                .format(dev.name, done), done)
+
+
+def send_file_to_remote(dev, src_file, dst_filename, filesize, *args, checksum=False, offset=0,
+                        **kwargs):
+    """Intended to be passed to the `remote` function as the xfer_func argument.
+       Matches up with recv_file_from_host (and the other functions which
+       receive a file, whose other arguments are ignored).
+
+       Data is read into a preallocated buffer (or sliced straight out of
+       src_file if it's an mmap), so no new objects are created per chunk
+       except for the hexlified data in ASCII mode. The data is sent starting
+       from the current position of src_file, which must be offset. If
+       checksum is True, the sha256 of the file is worked out as it's sent,
+       and sent once the transfer has been committed, so the file doesn't
+       need to be read an extra time.
+
+       Raises TransferError if the board stops acknowledging the data, or
+       if the transfer takes too long.
+    """
+    has_buffer = dev.has_buffer
+    if has_buffer:
+        buf_size = BUFFER_SIZE
+    else:
+        buf_size = BUFFER_SIZE // 2
+    buf = memoryview(bytearray(buf_size))
+    mapped = None
+    if isinstance(src_file, mmap.mmap):
+        mapped = memoryview(src_file)
+        map_offset = src_file.tell()
+    readinto = getattr(src_file, 'readinto', None)
+    hasher = hashlib.sha256() if checksum else None
+    if hasher and offset:
+        # Resuming, so the checksum needs to include what was sent before
+        src_file.seek(0)
+        bytes_remaining = offset
+        while bytes_remaining > 0:
+            data = src_file.read(min(bytes_remaining, 65536))
+            if not data:
+                break
+            hasher.update(data)
+            bytes_remaining -= len(data)
+        src_file.seek(offset)
+    bytes_remaining = filesize - offset
+    file_deadline = xfer_deadline(bytes_remaining)
+    read_size = 0
+    save_timeout = dev.timeout
+    dev.timeout = min(2, XFER_CHUNK_TIMEOUT)
+    try:
+        while bytes_remaining > 0:
+            # Wait for ack so we don't get too far ahead of the remote
+            wait_for_ack(dev, file_deadline, filesize - bytes_remaining - read_size,
+                         (bytes_remaining + read_size) * (1 if has_buffer else 2))
+
+            read_size = min(bytes_remaining, buf_size)
+            if mapped is not None:
+                chunk = mapped[map_offset:map_offset + read_size]
+                map_offset += read_size
+            elif readinto is not None:
+                chunk = buf[0:readinto(buf[0:read_size])]
+            else:
+                chunk = src_file.read(read_size)
+            if hasher:
+                hasher.update(chunk)
+            if has_buffer:
+                dev.write(chunk)
+            else:
+                dev.write(binascii.hexlify(chunk))
+            if mapped is not None:
+                chunk.release()
+            bytes_remaining -= read_size
+            PROGRESS.update(read_size)
+        # Wait for the board to receive the last chunk, and then commit the
+        # transfer (see host_committed).
+        wait_for_ack(dev, file_deadline, filesize - read_size,
+                     read_size * (1 if has_buffer else 2))
+        dev.write(b'\x06')
+        if hasher:
+            dev.write(binascii.hexlify(hasher.digest()))
+    finally:
+        if mapped is not None:
+            mapped.release()
+        dev.timeout = save_timeout
+
+
+def send_stream_to_remote(dev, src_file, dst_filename, dst_mode='wb'):
     """Intended to be passed to the `remote` function as the xfer_func argument.
-       Matches up with recv_file_from_host.
+       Matches up with recv_stream_from_host.
+
+       Sends src_file, whose size isn't known up front, as a series of
+       frames. Each frame is made up of STX, the length of the data (2 bytes)
+       and then the data, and a frame with no data ends the stream. Data is
+       sent as soon as some can be read (using read1, if src_file has it),
+       so output which is produced slowly isn't held up.
+
+       Streams can't be sent again, so there's no resuming. TransferError
+       is raised if the board stops acknowledging the frames.
+
+       This runs in StreamUpload's thread while other boards are used from
+       the main thread, so the encoding is taken from dev once, up front.
     """
-    bytes_remaining = filesize
+    has_buffer = dev.has_buffer
+    if has_buffer:
+        buf_size = BUFFER_SIZE
+    else:
+        buf_size = BUFFER_SIZE // 2
+    read = src_file.read1 if hasattr(src_file, 'read1') else src_file.read
+    done = 0
+    frame_size = 0
     save_timeout = dev.timeout
-    dev.timeout = 2
-    while bytes_remaining > 0:
-        # Wait for ack so we don't get too far ahead of the remote
-        ack = dev.read(1)
-        if ack is None or ack != b'\x06':
-            sys.stderr.write("timed out or error in transfer to remote: {!r}\n".format(ack))
-            sys.exit(2)
+    dev.timeout = min(2, XFER_CHUNK_TIMEOUT)
+    try:
+        while True:
+            # Wait for ack so we don't get too far ahead of the remote
+            wait_for_ack(dev, xfer_deadline(frame_size), done, frame_size)
+            data = read(buf_size)
+            frame = struct.pack('>cH', b'\x02', len(data)) + data
+            if not has_buffer:
+                frame = binascii.hexlify(frame)
+            dev.write(frame)
+            frame_size = len(frame)
+            if not data:
+                break
+            done += len(data)
+            PROGRESS.update(len(data))
+        # Wait for the board to receive the end of the stream, and then
+        # commit the transfer (see host_committed).
+        wait_for_ack(dev, xfer_deadline(frame_size), done, frame_size)
+        dev.write(b'\x06')
+    finally:
+        dev.timeout = save_timeout
 
-        if HAS_BUFFER:
-            buf_size = BUFFER_SIZE
+
+@contextlib.contextmanager
+def open_for_upload(filename, filesize):
+    """Opens a file on the host which is going to be sent to a board. Large
+       files are memory mapped, so that send_file_to_remote can send slices
+       of the mapping rather than reading the file into buffers.
+    """
+    with open(filename, 'rb') as src_file:
+        if filesize < MMAP_MIN_SIZE:
+            yield src_file
         else:
-            buf_size = BUFFER_SIZE // 2
-        read_size = min(bytes_remaining, buf_size)
-        buf = src_file.read(read_size)
-        #sys.stdout.write('\r%d/%d' % (filesize - bytes_remaining, filesize))
-        #sys.stdout.flush()
-        if HAS_BUFFER:
-            dev.write(buf)
+            with mmap.mmap(src_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+
+
+@extra_funcs(rename_over, host_committed, read_from_host, recv_blocks_from_host)
+def recv_bundle_from_host(src_file, dst_dirname, filesize, stage=False):
+    """Function which runs on the pyboard. Matches up with send_file_to_remote.
+
+       Unpacks a stream created by Bundle as it arrives, creating the
+       directories and writing the files which it contains relative to
+       dst_dirname. Only one buffer worth of the stream is held in memory
+       at a time. Each file is written to a temporary file, and once the
+       host has committed the whole stream they replace the originals
+       (unless stage is True, in which case swap_staged does that later).
+       Returns a list containing True or False for each entry.
+    """
+    import os
+    if HAS_BUFFER:
+        try:
+            import micropython
+            micropython.kbd_intr(-1)
+        except:
+            pass
+    results = []
+    written = []        # index into results and name of each file written
+    header = bytearray(7)   # kind, name length (2 bytes), data size (4 bytes)
+    header_size = 7
+    header_len = 0
+    kind = 0
+    data_size = 0
+    dst_file = None
+    file_ok = False
+    file_remaining = 0
+    try:
+        for chunk in recv_blocks_from_host(filesize):
+            idx = 0
+            while idx < len(chunk):
+                if file_remaining > 0:
+                    num_bytes = min(file_remaining, len(chunk) - idx)
+                    if dst_file:
+                        try:
+                            dst_file.write(chunk[idx:idx + num_bytes])
+                        except OSError:
+                            file_ok = False
+                    idx += num_bytes
+                    file_remaining -= num_bytes
+                    if file_remaining == 0:
+                        if dst_file:
+                            dst_file.close()
+                            dst_file = None
+                            written.append((len(results), name))
+                        results.append(file_ok)
+                    continue
+                num_bytes = min(header_size - header_len, len(chunk) - idx)
+                header[header_len:header_len + num_bytes] = chunk[idx:idx + num_bytes]
+                header_len += num_bytes
+                idx += num_bytes
+                if header_len < header_size:
+                    continue
+                header_len = 0
+                if kind == 0:
+                    # We have the fixed part of the header, next comes the name
+                    kind = header[0]
+                    if kind != 68 and kind != 70:
+                        # Not a valid entry, so the rest of the stream is junk
+                        file_remaining = filesize
+                        continue
+                    data_size = (header[3] << 24) | (header[4] << 16) | (header[5] << 8) | header[6]
+                    header_size = (header[1] << 8) | header[2]
+                    if header_size > len(header):
+                        header = bytearray(header_size)
+                    continue
+                name = dst_dirname + '/' + str(header[0:header_size], 'utf-8')
+                if kind == 68:  # D - directory
+                    try:
+                        os.mkdir(name)
+                        results.append(True)
+                    except OSError:
+                        try:
+                            results.append(os.stat(name)[0] & 0x4000 != 0)
+                        except OSError:
+                            results.append(False)
+                else:           # F - file
+                    try:
+                        dst_file = open(name + TEMP_SUFFIX, 'wb')
+                        file_ok = True
+                    except OSError:
+                        file_ok = False
+                    file_remaining = data_size
+                    if data_size == 0:
+                        if dst_file:
+                            dst_file.close()
+                            dst_file = None
+                            written.append((len(results), name))
+                        results.append(file_ok)
+                header_size = 7
+                kind = 0
+        committed = host_committed()
+    except:
+        committed = False
+        if dst_file:
+            dst_file.close()
+    for idx, name in written:
+        try:
+            if not committed:
+                os.remove(name + TEMP_SUFFIX)
+                results[idx] = False
+            elif results[idx] and not stage:
+                rename_over(name + TEMP_SUFFIX, name)
+        except OSError:
+            results[idx] = False
+    if hasattr(os, 'sync'):
+        os.sync()
+    return results
+
+
+class GeneratedFile(object):
+    """File-like object whose contents are produced by the generate method
+       as they're read, so that streams which are uploaded to a board don't
+       need to be held in memory. self.size must be the total size of the
+       stream.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.chunks = None
+        self.pending = b''
+        self.offset = 0     # How much of pending has been read
+
+    def generate(self):
+        """Generates the contents of the stream as a sequence of bytes objects."""
+        return iter(())
+
+    def rewind(self):
+        """Goes back to the start of the stream, so that it can be sent again."""
+        self.chunks = None
+        self.pending = b''
+        self.offset = 0
+
+    def read(self, num_bytes):
+        """Reads the next num_bytes bytes of the stream. Reads are much
+           smaller than the chunks which get generated, so the current chunk
+           is kept along with how much of it has been read, rather than
+           copying what's left of it for each read.
+        """
+        if self.chunks is None:
+            self.chunks = self.generate()
+        parts = []
+        while num_bytes > 0:
+            if self.offset >= len(self.pending):
+                try:
+                    self.pending = next(self.chunks)
+                except StopIteration:
+                    break
+                self.offset = 0
+            data = self.pending[self.offset:self.offset + num_bytes]
+            self.offset += len(data)
+            num_bytes -= len(data)
+            parts.append(data)
+        return b''.join(parts)
+
+
+class Bundle(GeneratedFile):
+    """Collects the directories and files which need to be uploaded to a
+       board, so that they can all be sent in a single transfer.
+
+       The bundle is sent as a stream of entries, which is generated as it's
+       read. Each entry has a header containing the kind of entry (D or F),
+       the length of the name and the size of the data, followed by the name
+       (relative to the destination directory) and then the file data.
+    """
+
+    HEADER = '>cHI'
+
+    def __init__(self, dst_dir, delta=False, stage=False):
+        GeneratedFile.__init__(self)
+        self.dst_dev, self.dst_dev_dir = get_dev_and_path(dst_dir)
+        self.dst_dir = dst_dir
+        self.entries = []
+        self.dirs = set()
+        self.delta = delta
+        self.deltas = []
+        # When staging, files are left as temporary files and removals are
+        # deferred until everything has been uploaded.
+        self.stage = stage
+        self.removals = []
+
+    def add(self, kind, dst_filename, src_filename, filesize):
+        name = bytes(dst_filename[len(self.dst_dir) + 1:], encoding='utf-8')
+        self.entries.append((kind, name, src_filename, filesize, dst_filename))
+        self.size += struct.calcsize(self.HEADER) + len(name) + filesize
+
+    def add_dir(self, dst_filename):
+        """Adds a directory to be created on the board."""
+        self.add(b'D', dst_filename, None, 0)
+        self.dirs.add(dst_filename)
+
+    def add_file(self, src_filename, dst_filename, dst_size=None):
+        """Adds a file on the host to be copied to the board. dst_size is the
+           size of the existing copy on the board (if any). In delta mode,
+           large files which already exist on the board are updated by
+           sending just the parts which changed.
+        """
+        filesize = os.stat(src_filename).st_size
+        if self.delta and dst_size and filesize >= DELTA_MIN_SIZE and dst_size >= DELTA_MIN_SIZE:
+            self.deltas.append((src_filename, dst_filename, dst_size))
         else:
-            dev.write(binascii.hexlify(buf))
-        bytes_remaining -= read_size
-    #sys.stdout.write('\r')
-    dev.timeout = save_timeout
+            self.add(b'F', dst_filename, src_filename, filesize)
+
+    def generate(self):
+        """Generates the stream which gets unpacked by recv_bundle_from_host."""
+        for kind, name, src_filename, filesize, _ in self.entries:
+            header = struct.pack(self.HEADER, kind, len(name), filesize) + name
+            if src_filename is not None:
+                PROGRESS.start_file(src_filename, len(header) + filesize)
+            yield header
+            if src_filename is None:
+                continue
+            with open(src_filename, 'rb') as src_file:
+                bytes_remaining = filesize
+                while bytes_remaining > 0:
+                    data = src_file.read(min(bytes_remaining, 65536))
+                    if not data:
+                        # The file shrank after it was added. Pad it out,
+                        # so that the remaining entries are still intact.
+                        data = bytes(min(bytes_remaining, 65536))
+                    bytes_remaining -= len(data)
+                    yield data
+
+    def upload(self):
+        """Sends the bundle to the board, followed by any deltas. Returns
+           True if every entry was created successfully.
+        """
+        success = True
+        if self.entries:
+            success = self.upload_entries()
+        if self.deltas:
+            success = self.upload_deltas() and success
+        if self.stage:
+            success = self.swap_staged(success)
+        return success
+
+    def swap_staged(self, success):
+        """Replaces the destination files with the staged temporary files
+           and carries out the removals, using a single remote call so that
+           the tree on the board changes all at once. If anything failed to
+           upload, the staged files are discarded instead.
+        """
+        staged = [get_dev_and_path(dst_filename)[1]
+                  for kind, _, _, _, dst_filename in self.entries if kind == b'F']
+        staged += [get_dev_and_path(dst_filename)[1] for _, dst_filename, _ in self.deltas]
+        removals = [get_dev_and_path(dst_filename)[1] for dst_filename in self.removals]
+        if not success:
+            self.dst_dev.remote_eval(swap_staged, [],
+                                     [filename + TEMP_SUFFIX for filename in staged])
+            print_err('Not all files were uploaded, so {} was left unchanged'
+                      .format(self.dst_dir))
+            return False
+        results = self.dst_dev.remote_eval(swap_staged, staged, removals)
+        for filename, ok in zip(removals + staged, results):
+            if not ok:
+                print_err('Unable to update {}'.format(filename))
+                success = False
+        return success
+
+    def upload_entries(self):
+        """Sends the directories and whole files in a single transfer."""
+        STATS.add('bundle_entries', len(self.entries))
+        # Bundle.generate starts reporting on each file as it gets to it
+        PROGRESS.expect(self.size, sum(1 for entry in self.entries if entry[0] == b'F'))
+
+        def upload(offset):
+            # Nothing in a bundle is kept unless all of it arrives, so a
+            # bundle which timed out is sent again from the start.
+            self.rewind()
+            return self.dst_dev.remote_eval(recv_bundle_from_host, self, self.dst_dev_dir,
+                                            self.size, self.stage,
+                                            xfer_func=send_file_to_remote)
+
+        try:
+            results = retry_xfer(upload)
+        finally:
+            PROGRESS.end_file()
+        success = True
+        for idx, (kind, _, src_filename, _, dst_filename) in enumerate(self.entries):
+            if idx < len(results) and results[idx]:
+                continue
+            if kind == b'D':
+                print_err("Unable to create {}".format(dst_filename))
+            else:
+                print_err("Unable to copy '{}' to '{}'".format(src_filename, dst_filename))
+            success = False
+        return success
+
+    def upload_deltas(self):
+        """Updates files which already exist on the board by sending just
+           the blocks which changed. The checksums of all of the files are
+           fetched using a single batch of calls. Files which don't have
+           enough in common with the copy on the board are sent whole.
+        """
+        dev = self.dst_dev
+        block_sizes = [delta_block_size(dst_size) for _, _, dst_size in self.deltas]
+        checksums = dev.remote_batch(
+            [(block_checksums, (get_dev_and_path(dst_filename)[1], block_size), {})
+             for (_, dst_filename, _), block_size in zip(self.deltas, block_sizes)])
+        success = True
+        for (src_filename, dst_filename, _), block_size, sums in zip(self.deltas, block_sizes,
+                                                                     checksums):
+            dst_dev_filename = get_dev_and_path(dst_filename)[1]
+            with open(src_filename, 'rb') as src_file:
+                data = src_file.read()
+            delta = DeltaFile(data, sums, block_size) if sums else None
+            if delta is None or delta.size >= len(data):
+                STATS.add('delta_full_copies')
+                PROGRESS.expect(len(data), 1)
+                ok = cp(src_filename, dst_filename + (TEMP_SUFFIX if self.stage else ''))
+            else:
+                STATS.add('delta_bytes_saved', len(data) - delta.size)
+                PROGRESS.expect(delta.size, 1)
+                with PROGRESS.file(src_filename, delta.size):
+                    ok = self.upload_delta(delta, dst_dev_filename, block_size)
+            if not ok:
+                print_err("Unable to copy '{}' to '{}'".format(src_filename, dst_filename))
+                success = False
+        return success
+
+    def upload_delta(self, delta, dst_dev_filename, block_size):
+        """Sends a DeltaFile to the board. If it times out, it's sent again
+           from the start.
+        """
+        def upload(offset):
+            delta.rewind()
+            return self.dst_dev.remote_eval(recv_delta_from_host, delta, dst_dev_filename,
+                                            delta.size, block_size, self.stage,
+                                            xfer_func=send_file_to_remote)
+        return retry_xfer(upload)
+
+
+@extra_funcs(rename_over, remove_file)
+def swap_staged(filenames, removals):
+    """Function which runs on the pyboard. Removes each of the removals and
+       then renames the staged temporary file for each of filenames over
+       the file itself. Returns a list containing True or False for each of
+       the removals followed by each of the filenames.
+    """
+    results = []
+    for filename in removals:
+        results.append(remove_file(filename, True, True))
+    for filename in filenames:
+        try:
+            rename_over(filename + TEMP_SUFFIX, filename)
+            results.append(True)
+        except OSError:
+            results.append(False)
+    return results
+
+
+def delta_block_size(filesize):
+    """Returns the block size used to compare a file of the given size, which
+       keeps the number of checksums that the board needs to send bounded.
+    """
+    block_size = max(DELTA_MIN_BLOCK_SIZE, -(-filesize // DELTA_MAX_BLOCKS))
+    return (block_size + 63) & ~63
+
+
+def block_checksums(filename, block_size):
+    """Function which runs on the pyboard. Returns a list containing the
+       (crc32, sha256 prefix) of each block of filename, or None if the file
+       can't be read or the firmware lacks crc32 or sha256.
+    """
+    try:
+        import ubinascii as binascii
+    except:
+        import binascii
+    try:
+        import uhashlib as hashlib
+    except:
+        import hashlib
+    try:
+        sums = []
+        buf = bytearray(block_size)
+        with open(filename, 'rb') as src_file:
+            while True:
+                num_bytes = src_file.readinto(buf)
+                if not num_bytes:
+                    break
+                block = memoryview(buf)[0:num_bytes]
+                sums.append((binascii.crc32(block),
+                             binascii.hexlify(hashlib.sha256(block).digest()[0:8])))
+        return sums
+    except:
+        return None
+
+
+def crc32_rolling_tables(block_size):
+    """Returns the tables used by DeltaFile to slide the CRC32 of a block
+       along by a byte. If crc is the CRC32 of data[pos:pos + block_size],
+       then the CRC32 of the block starting at pos + 1 is
+       (crc >> 8) ^ roll_in[(crc ^ data[pos + block_size]) & 0xff] ^ roll_out[data[pos]]
+       roll_in adds the new byte to the end of the block, as crc32 itself
+       would, and roll_out takes away the old byte, which has been followed
+       by block_size bytes by then.
+    """
+    roll_in = [binascii.crc32(bytes([byte])) for byte in range(256)]
+    zeros = bytes(block_size)
+    zeros_crc = binascii.crc32(zeros)
+    roll_out = [binascii.crc32(bytes([byte]) + zeros) ^ zeros_crc for byte in range(256)]
+    return roll_in, roll_out
+
+
+class DeltaFile(GeneratedFile):
+    """Describes how to build a file on the host from the blocks of the
+       existing copy on a board, as a stream of instructions for
+       recv_delta_from_host. Each instruction is either B followed by a
+       block number, or L followed by a length and that many bytes of
+       literal data.
+
+       The weak checksum is a CRC32, which the board computes using C code.
+       Through the parts of the file which changed, the host slides it a
+       byte at a time. CRC32 is linear, so each step only needs a lookup for
+       the byte entering the block and one for the byte leaving it (see
+       crc32_rolling_tables), rather than going over the whole block again.
+       Blocks whose CRC32 matches are confirmed using the sha256 prefix.
+    """
+
+    HEADER = '>cI'
+
+    def __init__(self, data, checksums, block_size):
+        GeneratedFile.__init__(self)
+        roll_in, roll_out = crc32_rolling_tables(block_size)
+        # The last block is ignored, since it may be a partial block.
+        blocks = {}
+        for idx, (weak, strong) in enumerate(checksums[:-1]):
+            blocks.setdefault(weak, []).append((strong, idx))
+        header_size = struct.calcsize(self.HEADER)
+        self.ops = []
+        view = memoryview(data)
+        literal_start = 0
+        pos = 0
+        crc = None
+        while pos + block_size <= len(data):
+            if crc is None:
+                crc = binascii.crc32(view[pos:pos + block_size])
+            matches = blocks.get(crc)
+            if matches:
+                block = view[pos:pos + block_size]
+                strong = binascii.hexlify(hashlib.sha256(block).digest()[0:8])
+                idx = next((idx for block_strong, idx in matches if block_strong == strong), None)
+                if idx is not None:
+                    if literal_start < pos:
+                        self.ops.append((b'L', view[literal_start:pos]))
+                        self.size += header_size + pos - literal_start
+                    self.ops.append((b'B', idx))
+                    self.size += header_size
+                    pos += block_size
+                    literal_start = pos
+                    crc = None
+                    continue
+            if pos + block_size < len(data):
+                crc = ((crc >> 8) ^ roll_in[(crc ^ view[pos + block_size]) & 0xff] ^
+                       roll_out[view[pos]])
+            pos += 1
+        if literal_start < len(data):
+            self.ops.append((b'L', view[literal_start:]))
+            self.size += header_size + len(data) - literal_start
+
+    def generate(self):
+        for kind, value in self.ops:
+            if kind == b'B':
+                yield struct.pack(self.HEADER, kind, value)
+            else:
+                yield struct.pack(self.HEADER, kind, len(value))
+                yield bytes(value)
+
+
+@extra_funcs(rename_over, host_committed, read_from_host, recv_blocks_from_host)
+def recv_delta_from_host(src_file, dst_filename, filesize, block_size, stage=False):
+    """Function which runs on the pyboard. Matches up with send_file_to_remote.
+
+       Rebuilds dst_filename from a stream created by DeltaFile, which
+       contains literal data and references to blocks of the existing file.
+       The new file is written to a temporary file, which then replaces
+       dst_filename (unless stage is True).
+    """
+    import os
+    if HAS_BUFFER:
+        try:
+            import micropython
+            micropython.kbd_intr(-1)
+        except:
+            pass
+    temp_filename = dst_filename + TEMP_SUFFIX
+    header = bytearray(5)   # kind, value (4 bytes)
+    header_len = 0
+    literal_remaining = 0
+    try:
+        with open(dst_filename, 'rb') as old_file:
+            with open(temp_filename, 'wb') as new_file:
+                block_buf = memoryview(bytearray(block_size))
+                for chunk in recv_blocks_from_host(filesize, new_file):
+                    idx = 0
+                    while idx < len(chunk):
+                        if literal_remaining > 0:
+                            num_bytes = min(literal_remaining, len(chunk) - idx)
+                            new_file.write(chunk[idx:idx + num_bytes])
+                            idx += num_bytes
+                            literal_remaining -= num_bytes
+                            continue
+                        num_bytes = min(5 - header_len, len(chunk) - idx)
+                        header[header_len:header_len + num_bytes] = chunk[idx:idx + num_bytes]
+                        header_len += num_bytes
+                        idx += num_bytes
+                        if header_len < 5:
+                            continue
+                        header_len = 0
+                        value = (header[1] << 24) | (header[2] << 16) | (header[3] << 8) | header[4]
+                        if header[0] == 66:     # B - block from the existing file
+                            old_file.seek(value * block_size)
+                            num_bytes = old_file.readinto(block_buf)
+                            new_file.write(block_buf[0:num_bytes])
+                        else:                   # L - literal data
+                            literal_remaining = value
+        if not host_committed():
+            raise OSError
+        if not stage:
+            rename_over(temp_filename, dst_filename)
+        if hasattr(os, 'sync'):
+            os.sync()
+        return True
+    except:
+        try:
+            os.remove(temp_filename)
+        except:
+            pass
+        return False
 
 
-def recv_file_from_remote(dev, src_filename, dst_file, filesize):
+def recv_file_from_remote(dev, src_filename, dst_file, filesize, offset=0):
     """Intended to be passed to the `remote` function as the xfer_func argument.
        Matches up with send_file_to_host.
+
+       Data is read straight into a preallocated buffer, which is written
+       out using memoryview slices, so no new objects are created per chunk
+       except for the unhexlified data in ASCII mode.
+
+       Raises TransferError if the board stops sending data, or if the
+       transfer takes too long. Only complete chunks are written to
+       dst_file, so the transfer can be resumed from where it got to.
     """
-    bytes_remaining = filesize
-    if not HAS_BUFFER:
+    has_buffer = dev.has_buffer
+    bytes_remaining = filesize - offset
+    file_deadline = xfer_deadline(bytes_remaining)
+    if not has_buffer:
         bytes_remaining *= 2  # hexlify makes each byte into 2
     buf_size = BUFFER_SIZE
-    write_buf = bytearray(buf_size)
+    buf = memoryview(bytearray(buf_size))
     while bytes_remaining > 0:
         read_size = min(bytes_remaining, buf_size)
-        buf_remaining = read_size
         buf_index = 0
-        while buf_remaining > 0:
-            read_buf = dev.read(buf_remaining)
-            bytes_read = len(read_buf)
-            if bytes_read:
-                write_buf[buf_index:bytes_read] = read_buf[0:bytes_read]
-                buf_index += bytes_read
-                buf_remaining -= bytes_read
-        if HAS_BUFFER:
-            dst_file.write(write_buf[0:read_size])
+        deadline = min(time.monotonic() + XFER_CHUNK_TIMEOUT, file_deadline)
+        while buf_index < read_size:
+            read_start = time.perf_counter()
+            num_bytes = dev.readinto(buf[buf_index:read_size])
+            STATS.add_time('data_wait', time.perf_counter() - read_start)
+            buf_index += num_bytes
+            if num_bytes == 0 and time.monotonic() >= deadline:
+                done = filesize - (bytes_remaining if has_buffer else bytes_remaining // 2)
+                dev.recover()
+                raise TransferError('Timed out receiving {} from {} after {} bytes'
+                                    .format(src_filename, dev.name, done), done)
+        if has_buffer:
+            dst_file.write(buf[0:read_size])
         else:
-            dst_file.write(binascii.unhexlify(write_buf[0:read_size]))
+            dst_file.write(binascii.unhexlify(buf[0:read_size]))
         # Send an ack to the remote as a form of flow control
         dev.write(b'\x06')   # ASCII ACK is 0x06
         bytes_remaining -= read_size
+        PROGRESS.update(read_size if has_buffer else read_size // 2)
 
 
-def send_file_to_host(src_filename, dst_file, filesize):
-    """Function which runs on the pyboard. Matches up with recv_file_from_remote."""
+def send_file_to_host(src_filename, dst_file, filesize, offset=0):
+    """Function which runs on the pyboard. Matches up with recv_file_from_remote.
+       The file is sent starting at offset, so that a transfer can be resumed.
+    """
     import sys
     try:
         import ubinascii
@@ -1227,7 +3203,8 @@ def send_file_to_host(src_filename, dst_file, filesize):
         import binascii as ubinascii
     try:
         with open(src_filename, 'rb') as src_file:
-            bytes_remaining = filesize
+            src_file.seek(offset)
+            bytes_remaining = filesize - offset
             if HAS_BUFFER:
                 buf_size = BUFFER_SIZE
             else:
@@ -1286,6 +3263,18 @@ def test_unhexlify():
         return False
 
 
+def get_mpy_version():
+    """Returns sys.implementation._mpy, which encodes the .mpy version and
+       native architecture supported by the firmware, or None if the
+       firmware doesn't provide it.
+    """
+    import sys
+    try:
+        return sys.implementation._mpy
+    except AttributeError:
+        return None
+
+
 def get_time_epoch():
     """Determines the epoch used by the MicroPython board."""
     import time
@@ -1465,9 +3454,35 @@ def connect_serial(port, baud=115200, wait=0):
     return True
 
 
+def split_commands(line):
+    """Strips any comment from a line and splits it into the commands which
+       are separated by semicolons.
+    """
+    comment_idx = line.find("#")
+    if comment_idx >= 0:
+        line = line[0:comment_idx]
+        line = line.strip()
+
+    # search multiple commands on the same line
+    lexer = shlex.shlex(line)
+    lexer.whitespace = ''
+
+    return ["".join(group)
+            for issemicolon, group in itertools.groupby(lexer, lambda x: x == ";")
+            if not issemicolon]
+
+
 def strip_source(source):
     """ Strip out comments and Docstrings from some python source code."""
-    mod = ""
+    mod = []
+
+    def rstrip_mod():
+        """Removes trailing whitespace from the output built so far."""
+        while mod:
+            mod[-1] = mod[-1].rstrip(' \t\n')
+            if mod[-1]:
+                return
+            mod.pop()
 
     prev_toktype = token.INDENT
     last_lineno = -1
@@ -1484,19 +3499,123 @@ def strip_source(source):
         if slineno > last_lineno:
             last_col = 0
         if scol > last_col:
-            mod += " " * (scol - last_col)
+            mod.append(" " * (scol - last_col))
         if toktype == token.STRING and prev_toktype == token.INDENT:
             # Docstring
-            mod = mod.rstrip(' \t\n')
+            rstrip_mod()
         elif toktype == tokenize.COMMENT:
             # Comment
-            mod = mod.rstrip(' \t\n')
+            rstrip_mod()
         else:
-            mod += ttext
+            mod.append(ttext)
         prev_toktype = toktype
         last_col = ecol
         last_lineno = elineno
-    return mod
+    return ''.join(mod)
+
+
+class StreamUpload(object):
+    """File-like object which streams whatever is written to it into a file
+       on a board, using recv_stream_from_host. The transfer runs in its own
+       thread, which is fed through a queue, so that the command producing
+       the output can carry on at the same time. The queue is bounded, so
+       the memory used doesn't depend on how much is written, and nothing
+       is staged in a temporary file.
+
+       The board is busy for as long as the stream is open, so the command
+       mustn't use the board itself.
+    """
+
+    def __init__(self, dev, dst_filename, dst_mode='wb'):
+        self.dev = dev
+        self.dst_filename = dst_filename
+        self.queue = queue.Queue(STREAM_QUEUE_SIZE)
+        self.pending = b''
+        self.offset = 0     # How much of pending has been read (see read1)
+        self.eof = False
+        self.error = None
+        self.result = None
+        self.thread = threading.Thread(target=self.upload, args=(dst_mode,), daemon=True)
+        self.thread.start()
+
+    def upload(self, dst_mode):
+        try:
+            self.result = self.dev.remote_eval(recv_stream_from_host, self,
+                                               self.dst_filename, dst_mode,
+                                               xfer_func=send_stream_to_remote)
+        except (DeviceError, serial.serialutil.SerialException) as err:
+            self.error = err
+
+    @property
+    def buffer(self):
+        return self
+
+    def isatty(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def put(self, item):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        raise DeviceError('Unable to write to {} on {}: {}'.format(
+            self.dst_filename, self.dev.name, self.error or 'transfer ended'))
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if data:
+            self.put(bytes(data))
+        return len(data)
+
+    def read1(self, num_bytes):
+        """Called by send_stream_to_remote. Waits until something has been
+           written, and then returns up to num_bytes of whatever has been
+           written so far, or b'' once the stream has been closed. Like
+           GeneratedFile.read, an offset into pending is kept, rather than
+           copying what's left of it for each read.
+        """
+        parts = []
+        wait = True
+        while num_bytes > 0:
+            if self.offset >= len(self.pending):
+                if self.eof:
+                    break
+                try:
+                    data = self.queue.get() if wait else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if data is None:
+                    self.eof = True
+                    break
+                self.pending = data
+                self.offset = 0
+            data = self.pending[self.offset:self.offset + num_bytes]
+            self.offset += len(data)
+            num_bytes -= len(data)
+            parts.append(data)
+            wait = False
+        return b''.join(parts)
+
+    def close(self):
+        """Ends the stream, and waits for the board to commit it. Returns
+           True if the whole stream was written to the file.
+        """
+        try:
+            self.put(None)
+        except DeviceError:
+            pass
+        self.thread.join()
+        if self.error is not None:
+            print_err(self.error)
+        elif not self.result:
+            print_err('Unable to write to {} on {}'.format(self.dst_filename, self.dev.name))
+        return bool(self.result)
 
 
 class SmartFile(object):
@@ -1511,6 +3630,9 @@ class SmartFile(object):
     def flush(self):
         self.file.flush()
 
+    def isatty(self):
+        return self.file.isatty()
+
     def read(self, num_bytes):
         return self.file.buffer.read(num_bytes)
 
@@ -1531,46 +3653,66 @@ class DeviceError(Exception):
     pass
 
 
+class TransferError(DeviceError):
+    """Raised when a transfer to or from a board times out. done is the
+       number of bytes which are known to have been transferred, which
+       is where the transfer can be resumed from.
+    """
+
+    def __init__(self, message, done=0):
+        DeviceError.__init__(self, message)
+        self.done = done
+
+
 class Device(object):
 
-    def __init__(self, pyb):
+    def __init__(self, pyb, quiet=False):
         self.pyb = pyb
+        self.quiet = QUIET or quiet
         self.has_buffer = False  # needs to be set for remote_eval to work
         self.time_offset = 0
         self.adjust_for_timezone = False
         self.sysname = ''
-        QUIET or print('Retrieving sysname ... ', end='', flush=True)
-        self.sysname = self.remote_eval(sysname)
-        QUIET or print(self.sysname)
+        self.name = ''
+        self.session = None
+        self.prompt_consumed = False
+        self.write_buf_size = MIN_WRITE_BUF_SIZE
+        self.mpy_version = None
+        self.mpy_version_probed = False
+        self.quiet or print('Retrieving sysname ... ', end='', flush=True)
+        self.sysname, self.mem_free = self.remote_batch([(sysname, (), {}),
+                                                         (get_mem_free, (), {})])
+        self.write_buf_size = write_buf_size(self.mem_free)
+        self.quiet or print(self.sysname)
         if not ASCII_XFER:
-            QUIET or print('Testing if sys.stdin.buffer exists ... ', end='', flush=True)
+            self.quiet or print('Testing if sys.stdin.buffer exists ... ', end='', flush=True)
             self.has_buffer = self.remote_eval(test_buffer)
-            QUIET or print('Y' if self.has_buffer else 'N')
+            self.quiet or print('Y' if self.has_buffer else 'N')
         else:
-            QUIET or print('Testing if ubinascii.unhexlify exists ... ', end='', flush=True)
+            self.quiet or print('Testing if ubinascii.unhexlify exists ... ', end='', flush=True)
             unhexlify_exists = self.remote_eval(test_unhexlify)
-            QUIET or print('Y' if unhexlify_exists else 'N')
+            self.quiet or print('Y' if unhexlify_exists else 'N')
             if not unhexlify_exists:
                 raise ShellError('rshell needs MicroPython firmware with ubinascii.unhexlify')
-        QUIET or print('Retrieving root directories ... ', end='', flush=True)
+        self.quiet or print('Retrieving root directories ... ', end='', flush=True)
         self.root_dirs = ['/{}/'.format(dir) for dir in self.remote_eval(listdir, '/')]
-        QUIET or print(' '.join(self.root_dirs))
-        QUIET or print('Setting time ... ', end='', flush=True)
+        self.quiet or print(' '.join(self.root_dirs))
+        self.quiet or print('Setting time ... ', end='', flush=True)
         now = self.sync_time()
-        QUIET or print(time.strftime('%b %d, %Y %H:%M:%S', now))
-        QUIET or print('Evaluating board_name ... ', end='', flush=True)
+        self.quiet or print(time.strftime('%b %d, %Y %H:%M:%S', now))
+        self.quiet or print('Evaluating board_name ... ', end='', flush=True)
         self.name, messages = self.remote_eval_last(board_name, self.default_board_name())
-        QUIET or print(self.name)
-        if (len(messages) > 0) and not QUIET:
+        self.quiet or print(self.name)
+        if (len(messages) > 0) and not self.quiet:
             print('----- Prints from board.py ----')
             print(messages)
             print('----')
         self.dev_name_short = self.name
-        QUIET or print('Retrieving time epoch ... ', end='', flush=True)
+        self.quiet or print('Retrieving time epoch ... ', end='', flush=True)
         epoch_tuple = self.remote_eval(get_time_epoch)
         if len(epoch_tuple) == 8:
             epoch_tuple = epoch_tuple + (0,)
-        QUIET or print(time.strftime('%b %d, %Y', epoch_tuple))
+        self.quiet or print(time.strftime('%b %d, %Y', epoch_tuple))
 
         self.time_offset = calendar.timegm(epoch_tuple)
         # The pyboard maintains its time as localtime, whereas unix and
@@ -1593,9 +3735,26 @@ class Device(object):
             self.pyb.serial.close()
         self.pyb = None
 
+    def soft_reset(self):
+        """Soft resets the board from the normal REPL, like pressing
+           Control-D, so that boot.py and main.py are run again. Anything
+           which is running is interrupted first.
+        """
+        self.check_pyb()
+        self.pyb.serial.write(b'\r\x03\x03\x04')
+
     def default_board_name(self):
         return 'unknown'
 
+    def get_mpy_version(self):
+        """Returns sys.implementation._mpy from the board. The board is only
+           asked the first time, since this is only needed for --mpy.
+        """
+        if not self.mpy_version_probed:
+            self.mpy_version = self.remote_eval(get_mpy_version)
+            self.mpy_version_probed = True
+        return self.mpy_version
+
     def is_root_path(self, filename):
         """Determines if 'filename' corresponds to a directory on this device."""
         test_filename = filename + '/'
@@ -1611,75 +3770,314 @@ class Device(object):
         """Reads data from the pyboard over the serial port."""
         self.check_pyb()
         try:
-            return self.pyb.serial.read(num_bytes)
+            data = self.pyb.serial.read(num_bytes)
+            STATS.add('bytes_received', len(data))
+            return data
         except (serial.serialutil.SerialException, TypeError):
             # Write failed - assume that we got disconnected
             self.close()
             raise DeviceError('serial port %s closed' % self.dev_name_short)
 
+    def readinto(self, buf):
+        """Reads data from the pyboard over the serial port into buf, and
+           returns the number of bytes read.
+        """
+        self.check_pyb()
+        try:
+            readinto = getattr(self.pyb.serial, 'readinto', None)
+            if readinto is None:
+                data = self.pyb.serial.read(len(buf))
+                num_bytes = len(data)
+                buf[0:num_bytes] = data
+            else:
+                num_bytes = readinto(buf)
+            STATS.add('bytes_received', num_bytes)
+            return num_bytes
+        except (serial.serialutil.SerialException, TypeError):
+            # Read failed - assume that we got disconnected
+            self.close()
+            raise DeviceError('serial port %s closed' % self.dev_name_short)
+
+    def recover(self, pending=0):
+        """Gets the board back to the raw REPL after a transfer was abandoned,
+           so that it can carry on being used. Control-C characters are sent
+           until the function running on the board returns. They interrupt
+           it, unless it disabled the keyboard interrupt to receive binary
+           data, in which case they're received as data instead (the board
+           may still be waiting for up to pending bytes), and the transfer
+           won't be committed (see host_committed). Returns True if the
+           board was recovered.
+
+           Like waiting for an ACK, each write of padding is only given
+           XFER_CHUNK_TIMEOUT seconds, so a board which has stopped reading
+           can't hang the shell. If a write times out, the port is closed
+           (see write) and DeviceError is raised.
+        """
+        self.check_pyb()
+        STATS.add('recoveries')
+        save_timeout = self.timeout
+        save_write_timeout = self.write_timeout
+        self.timeout = 0.1
+        self.write_timeout = XFER_CHUNK_TIMEOUT
+        pending += BUFFER_SIZE + 1
+        pad = b'\x03' * BUFFER_SIZE
+        tail = b''
+        deadline = time.monotonic() + XFER_CHUNK_TIMEOUT
+        try:
+            while time.monotonic() < deadline:
+                if pending > 0:
+                    self.write(pad[0:min(pending, len(pad))])
+                    pending -= len(pad)
+                data = self.read(1)
+                if data:
+                    data += self.read(self.pyb.serial.inWaiting())
+                    # The raw REPL ends the output with EOT and then prompts with >
+                    tail = (tail + data)[-2:]
+                    if tail == b'\x04>':
+                        return True
+                    deadline = time.monotonic() + XFER_CHUNK_TIMEOUT
+        finally:
+            if self.pyb is not None:
+                self.timeout = save_timeout
+                self.write_timeout = save_write_timeout
+        return False
+
     def remote(self, func, *args, xfer_func=None, **kwargs):
         """Calls func with the indicated args on the micropython board."""
-        global HAS_BUFFER
-        HAS_BUFFER = self.has_buffer
-        if hasattr(func, 'extra_funcs'):
-          func_name = func.name
-          func_lines = []
-          for extra_func in func.extra_funcs:
-            func_lines += inspect.getsource(extra_func).split('\n')
-            func_lines += ['']
-          func_lines += filter(lambda line: line[:1] != '@', func.source.split('\n'))
-          func_src = '\n'.join(func_lines)
-        else:
-          func_name = func.__name__
-          func_src = inspect.getsource(func)
-        if self.sysname == 'rp2':
-            func_src = func_src.replace('#rp2: ', '')
-        func_src = strip_source(func_src)
-        args_arr = [remote_repr(i) for i in args]
-        kwargs_arr = ["{}={}".format(k, remote_repr(v)) for k, v in kwargs.items()]
-        func_src += 'output = ' + func_name + '('
-        func_src += ', '.join(args_arr + kwargs_arr)
-        func_src += ')\n'
-        func_src += 'if output is None:\n'
-        func_src += '    print("None")\n'
-        func_src += 'else:\n'
-        func_src += '    print(output)\n'
-        time_offset = self.time_offset
-        if self.adjust_for_timezone:
-          time_offset -= time.localtime().tm_gmtoff
-        func_src = func_src.replace('TIME_OFFSET', '{}'.format(time_offset))
-        func_src = func_src.replace('HAS_BUFFER', '{}'.format(HAS_BUFFER))
-        func_src = func_src.replace('BUFFER_SIZE', '{}'.format(BUFFER_SIZE))
-        func_src = func_src.replace('IS_UPY', 'True')
+        func_name = remote_func_name(func)
+        with STATS.phase('remote', func=func_name):
+            with STATS.phase('build_source'):
+                func_src = self.build_source(func, func_name, args, kwargs)
+            output, _ = self.run_source(func_src, xfer_func, args, kwargs)
+        return output
+
+    def remote_batch(self, calls):
+        """Calls each (func, args, kwargs) in calls on the micropython board,
+           one after the other, using a single raw REPL session. The source
+           of each function is only sent once. Returns a list containing the
+           result of each call, converted back into python using eval (like
+           remote_eval).
+        """
+        with STATS.phase('remote_batch', calls=len(calls)):
+            with STATS.phase('build_source'):
+                func_srcs = []
+                call_srcs = []
+                for func, args, kwargs in calls:
+                    func_name = remote_func_name(func)
+                    func_src = self.function_source(func, func_name)
+                    if func_src not in func_srcs:
+                        func_srcs.append(func_src)
+                    call_srcs.append('output = {}({})\nprint({!r}, output, sep="")\n'
+                                     .format(func_name, remote_args(args, kwargs),
+                                             BATCH_SEPARATOR))
+                func_src = ''.join(func_srcs + call_srcs)
+            output, output_err = self.run_source(func_src)
+        results = output.split(bytes(BATCH_SEPARATOR, encoding='utf-8'))[1:]
+        if len(results) < len(calls):
+            # The call which didn't produce a result raised an exception
+            err = str(output_err, encoding='utf-8').strip().split('\n')
+            raise DeviceError('{} failed on {}: {}'.format(
+                remote_func_name(calls[len(results)][0]), self.name, err[-1]))
+        with STATS.phase('eval'):
+            return [eval(result) for result in results]
+
+    def remote_stream(self, func, record_func, *args, **kwargs):
+        """Calls func, which prints one record per line (like list_files),
+           with the indicated args on the micropython board. record_func is
+           called with each record (converted back into python using eval)
+           as soon as it arrives, so the records are never all held in
+           memory, either on the board or on the host.
+        """
+        func_name = remote_func_name(func)
+        with STATS.phase('remote_stream', func=func_name):
+            with STATS.phase('build_source'):
+                func_src = ''.join((self.function_source(func, func_name), func_name,
+                                    '(', remote_args(args, kwargs), ')\n'))
+            _, output_err = self.run_source(func_src, record_func=record_func)
+        if output_err:
+            err = str(output_err, encoding='utf-8').strip().split('\n')
+            raise DeviceError('{} failed on {}: {}'.format(func_name, self.name, err[-1]))
+
+    def follow_records(self, record_func, timeout=20):
+        """Used instead of pyboard.follow for remote_stream. The output is
+           read as it becomes available (rather than a byte at a time), and
+           record_func is called for each complete line of normal output.
+           Returns the normal output (which has already been consumed, so it's
+           empty) and the error output.
+        """
+        serial = self.pyb.serial
+        line_buf = bytearray()
+        output_err = bytearray()
+        in_err = False
+        deadline = time.monotonic() + timeout
+        while True:
+            data = serial.read(max(1, serial.inWaiting()))
+            if not data:
+                if time.monotonic() >= deadline:
+                    raise PyboardError('timeout waiting for EOF reception')
+                continue
+            STATS.add('bytes_received', len(data))
+            deadline = time.monotonic() + timeout
+            if in_err:
+                output_err += data
+            else:
+                eot = data.find(b'\x04')
+                if eot < 0:
+                    line_buf += data
+                else:
+                    line_buf += data[:eot]
+                    output_err += data[eot + 1:]
+                    in_err = True
+                end = len(line_buf) if in_err else line_buf.rfind(b'\n') + 1
+                if end > 0:
+                    for line in bytes(line_buf[:end]).split(b'\n'):
+                        if line.strip():
+                            record_func(eval(line))
+                    del line_buf[:end]
+            if in_err and b'\x04' in output_err:
+                # Anything after the EOF is the prompt for the next command,
+                # which needs to be asked for again in a raw_repl_session.
+                eot = output_err.find(b'\x04')
+                self.prompt_consumed = b'>' in output_err[eot:]
+                return b'', bytes(output_err[:eot])
+
+    def run_source(self, func_src, xfer_func=None, args=(), kwargs={}, record_func=None):
+        """Runs func_src on the micropython board using the raw REPL, and
+           returns the output and error output. If xfer_func is provided, it's
+           called (with args and kwargs) after the code has been sent, in
+           order to transfer data. If record_func is provided, the output is
+           passed to it a line at a time, using follow_records.
+        """
+        STATS.add('remote_calls')
+        STATS.add('code_bytes', len(func_src))
+        STATS.add('bytes_sent', len(func_src))
         if DEBUG:
             print('----- About to send %d bytes of code to the pyboard -----' % len(func_src))
             print(func_src)
             print('-----')
         self.check_pyb()
+        session = self.session
+        completed = False
         try:
-            self.pyb.enter_raw_repl()
+            if session is None or not session['entered']:
+                with STATS.phase('enter_raw_repl'):
+                    self.pyb.enter_raw_repl()
+                self.prompt_consumed = False
+                if session is not None:
+                    session['entered'] = True
+            elif self.prompt_consumed:
+                # Control-A gets the raw REPL to prompt again
+                self.pyb.serial.write(b'\r\x01')
+                self.prompt_consumed = False
             self.check_pyb()
-            output = self.pyb.exec_raw_no_follow(func_src)
+            with STATS.phase('upload_code'):
+                self.pyb.exec_raw_no_follow(func_src)
             if xfer_func:
-                xfer_func(self, *args, **kwargs)
+                with STATS.phase('xfer', func=xfer_func.__name__):
+                    xfer_func(self, *args, **kwargs)
             self.check_pyb()
-            output, _ = self.pyb.follow(timeout=20)
+            with STATS.phase('follow'):
+                if record_func is None:
+                    output, output_err = self.pyb.follow(timeout=20)
+                    STATS.add('bytes_received', len(output) + len(output_err))
+                else:
+                    output, output_err = self.follow_records(record_func)
             self.check_pyb()
-            self.pyb.exit_raw_repl()
+            if session is None:
+                self.pyb.exit_raw_repl()
+            completed = True
         except (serial.serialutil.SerialException, TypeError):
             self.close()
             raise DeviceError('serial port %s closed' % self.dev_name_short)
+        except PyboardError as err:
+            raise DeviceError('{}: {}'.format(self.dev_name_short, err))
+        finally:
+            if session is not None and not completed:
+                # Start afresh, since the board may be in any state
+                session['entered'] = False
+                session['sources'].clear()
         if DEBUG:
             print('-----Response-----')
             print(output)
             print('-----')
-        return output
+        return output, output_err
+
+    def build_source(self, func, func_name, args, kwargs):
+        """Returns the source code which is sent to the board to call func.
+           Within a raw_repl_session, the functions are only sent the first
+           time that they're called.
+        """
+        func_src = self.function_source(func, func_name)
+        if self.session is not None:
+            if func_src in self.session['sources']:
+                func_src = ''
+            else:
+                self.session['sources'].add(func_src)
+        return ''.join((func_src, 'output = ', func_name,
+                        '(', remote_args(args, kwargs), REMOTE_SOURCE_SUFFIX))
+
+    @contextlib.contextmanager
+    def raw_repl_session(self):
+        """Context manager which keeps the board in the raw REPL between
+           remote calls, rather than entering it (which soft reboots the
+           board) and leaving it again for every call. For commands, like
+           df --watch, which make the same calls over and over again.
+        """
+        self.session = {'entered': False, 'sources': set()}
+        try:
+            yield
+        finally:
+            session, self.session = self.session, None
+            if session['entered'] and self.pyb is not None:
+                try:
+                    self.pyb.exit_raw_repl()
+                except (serial.serialutil.SerialException, TypeError):
+                    self.close()
+
+    def function_source(self, func, func_name):
+        """Returns the source of func and its extra functions, with the
+           placeholders filled in. This only depends on the function and the
+           settings, so it's cached, and only the arguments get rendered for
+           each call.
+        """
+        time_offset = self.time_offset
+        if self.adjust_for_timezone:
+          time_offset -= time.localtime().tm_gmtoff
+        key = (func, self.sysname, self.has_buffer, BUFFER_SIZE, self.write_buf_size, SYNC_BYTES,
+               TEMP_SUFFIX, time_offset)
+        func_src = REMOTE_SOURCE_CACHE.get(key)
+        if func_src is not None:
+            return func_src
+        STATS.add('source_cache_misses')
+        if hasattr(func, 'extra_funcs'):
+          func_lines = []
+          for extra_func in func.extra_funcs:
+            func_lines += inspect.getsource(extra_func).split('\n')
+            func_lines += ['']
+          func_lines += filter(lambda line: line[:1] != '@', func.source.split('\n'))
+          func_src = '\n'.join(func_lines)
+        else:
+          func_src = inspect.getsource(func)
+        if self.sysname == 'rp2':
+            func_src = func_src.replace('#rp2: ', '')
+        func_src = strip_source(func_src)
+        func_src = func_src.replace('TIME_OFFSET', '{}'.format(time_offset))
+        func_src = func_src.replace('HAS_BUFFER', '{}'.format(self.has_buffer))
+        func_src = func_src.replace('BUFFER_SIZE', '{}'.format(BUFFER_SIZE))
+        func_src = func_src.replace('WRITE_BUF_SIZE', '{}'.format(self.write_buf_size))
+        func_src = func_src.replace('SYNC_BYTES', '{}'.format(SYNC_BYTES))
+        func_src = func_src.replace('TEMP_SUFFIX', '{!r}'.format(TEMP_SUFFIX))
+        func_src = func_src.replace('IS_UPY', 'True')
+        REMOTE_SOURCE_CACHE[key] = func_src
+        return func_src
 
     def remote_eval(self, func, *args, **kwargs):
         """Calls func with the indicated args on the micropython board, and
            converts the response back into python by using eval.
         """
-        return eval(self.remote(func, *args, **kwargs))
+        output = self.remote(func, *args, **kwargs)
+        with STATS.phase('eval'):
+            return eval(output)
 
     def remote_eval_last(self, func, *args, **kwargs):
         """Calls func with the indicated args on the micropython board, and
@@ -1709,6 +4107,7 @@ class Device(object):
         """Writes data to the pyboard over the serial port."""
         self.check_pyb()
         try:
+            STATS.add('bytes_sent', len(buf))
             return self.pyb.serial.write(buf)
         except (serial.serialutil.SerialException, BrokenPipeError, TypeError):
             # Write failed - assume that we got disconnected
@@ -1718,25 +4117,30 @@ class Device(object):
 
 class DeviceSerial(Device):
 
-    def __init__(self, port, baud, wait):
+    def __init__(self, port, baud, wait, hotplug=False):
+        """hotplug is True when connecting from the autoconnect workers, in
+           which case nothing is printed, and errors are always reported
+           using DeviceError, so that they don't exit rshell.
+        """
         self.port = port
         self.baud = baud
         self.wait = wait
+        self.quiet = QUIET or hotplug
 
         if wait and not os.path.exists(port):
             toggle = False
             try:
-                if not QUIET:
+                if not self.quiet:
                     sys.stdout.write("Waiting %d seconds for serial port '%s' to exist" % (wait, port))
                     sys.stdout.flush()
                 while wait and not os.path.exists(port):
-                    if not QUIET:
+                    if not self.quiet:
                         sys.stdout.write('.')
                         sys.stdout.flush()
                     time.sleep(0.5)
                     toggle = not toggle
                     wait = wait if not toggle else wait -1
-                QUIET or sys.stdout.write("\n")
+                self.quiet or sys.stdout.write("\n")
             except KeyboardInterrupt:
                 raise DeviceError('Interrupted')
 
@@ -1745,6 +4149,8 @@ class DeviceSerial(Device):
         try:
             pyb = Pyboard(port, baudrate=baud, wait=wait, rts=RTS, dtr=DTR)
         except PyboardError as err:
+            if hotplug:
+                raise DeviceError(str(err))
             print(err)
             sys.exit(1)
 
@@ -1760,7 +4166,7 @@ class DeviceSerial(Device):
         except serial.serialutil.SerialException:
             # Write failed. Now report that we're waiting and keep trying until
             # a write succeeds
-            QUIET or sys.stdout.write("Waiting for transport to be connected.")
+            self.quiet or sys.stdout.write("Waiting for transport to be connected.")
             while True:
                 time.sleep(0.5)
                 try:
@@ -1768,32 +4174,32 @@ class DeviceSerial(Device):
                     break
                 except serial.serialutil.SerialException:
                     pass
-                if not QUIET:
+                if not self.quiet:
                     sys.stdout.write('.')
                     sys.stdout.flush()
-            QUIET or sys.stdout.write('\n')
+            self.quiet or sys.stdout.write('\n')
 
         # Send Control-C followed by CR until we get a >>> prompt
-        QUIET or print('Trying to connect to REPL ', end='', flush=True)
+        self.quiet or print('Trying to connect to REPL ', end='', flush=True)
         connected = False
         for _ in range(20):
             pyb.serial.write(b'\x03\r')
-            time.sleep(0.5)
-            pyb.serial.write(b'\x03\r')
-            data = pyb.read_until(1, b'>>> ', timeout=0.1)
+            # Carries on as soon as the prompt arrives, rather than always
+            # waiting for the whole half second
+            data = pyb.read_until(1, b'>>> ', timeout=0.5)
             if data.endswith(b'>>> '):
                 connected = True
                 break
-            if not QUIET:
+            if not self.quiet:
                 sys.stdout.write('.')
                 sys.stdout.flush()
         if connected:
-            QUIET or print(' connected', flush=True)
+            self.quiet or print(' connected', flush=True)
         else:
             raise DeviceError('Unable to connect to REPL')
 
         # In theory the serial port is now ready to use
-        Device.__init__(self, pyb)
+        Device.__init__(self, pyb, hotplug)
         self.dev_name_short = port
 
     def default_board_name(self):
@@ -1819,6 +4225,24 @@ class DeviceSerial(Device):
             # if the serial port is closed.
             pass
 
+    @property
+    def write_timeout(self):
+        """Gets the write timeout associated with the serial port."""
+        self.check_pyb()
+        return self.pyb.serial.write_timeout
+
+    @write_timeout.setter
+    def write_timeout(self, value):
+        """Sets the write timeout associated with the serial port. recover
+           relies on it, so failing to set it is an error.
+        """
+        self.check_pyb()
+        try:
+            self.pyb.serial.write_timeout = value
+        except (ValueError, serial.serialutil.SerialException) as err:
+            raise DeviceError('Unable to set the write timeout of {}: {}'
+                              .format(self.dev_name_short, err))
+
 
 class DeviceNet(Device):
 
@@ -1847,6 +4271,16 @@ class DeviceNet(Device):
         """There is no equivalent to timeout for the telnet connection."""
         pass
 
+    @property
+    def write_timeout(self):
+        """There is no equivalent to write_timeout for the telnet connection."""
+        return None
+
+    @write_timeout.setter
+    def write_timeout(self, value):
+        """There is no equivalent to write_timeout for the telnet connection."""
+        pass
+
 
 class AutoBool(object):
     """A simple class which allows a boolean to be set to False in conjunction
@@ -1939,19 +4373,11 @@ class Shell(cmd.Cmd):
                 # print a newline to pretty things up for the caller.
                 self.print('')
             return True
-        # Strip comments
-        comment_idx = line.find("#")
-        if comment_idx >= 0:
-            line = line[0:comment_idx]
-            line = line.strip()
-
-        # search multiple commands on the same line
-        lexer = shlex.shlex(line)
-        lexer.whitespace = ''
-
-        for issemicolon, group in itertools.groupby(lexer, lambda x: x == ";"):
-            if not issemicolon:
-                self.onecmd_exec("".join(group))
+        for command in split_commands(line):
+            try:
+                self.onecmd_exec(command)
+            finally:
+                self.end_redirect()
 
     def onecmd_exec(self, line):
         try:
@@ -1973,6 +4399,137 @@ class Shell(cmd.Cmd):
             # exit the shell, just the command.
             return False
 
+    def batch_fs_op(self, cmd_idx, command):
+        """Determines if a command from a command file is a simple mkdir or rm
+           which can be combined with its neighbours. Returns a tuple
+           (dev, ops) or None if the command needs to be run by itself.
+        """
+        args = shlex.split(command)
+        if len(args) < 2 or '>' in args or '>>' in args:
+            return None
+        recursive = force = False
+        if args[0] == 'mkdir':
+            filenames = args[1:]
+        elif args[0] == 'rm':
+            # The options are parsed in the same way as do_rm, and anything
+            # which do_rm would complain about is left for it to report.
+            parser = self.create_argparser('rm')
+
+            def parse_error(message):
+                raise ShellError(message)
+
+            parser.error = parse_error
+            if '-h' in args or '--help' in args:
+                return None
+            try:
+                rm_args = parser.parse_args(args[1:])
+            except ShellError:
+                return None
+            filenames = rm_args.filename
+            recursive = rm_args.recursive
+            force = rm_args.force
+        else:
+            return None
+        if not filenames:
+            return None
+        ops_dev = None
+        ops = []
+        for filename in filenames:
+            if filename[0] == '-' or is_pattern(filename):
+                return None
+            filename = resolve_path(filename)
+            dev, dev_filename = get_dev_and_path(filename)
+            if dev is None or (ops_dev is not None and dev is not ops_dev):
+                return None
+            ops_dev = dev
+            if args[0] == 'mkdir':
+                ops.append(((cmd_idx, 'mkdir', dev_filename), filename))
+            else:
+                ops.append(((cmd_idx, 'rm', dev_filename, recursive, force), filename))
+        return ops_dev, ops
+
+    def run_batch_fs_ops(self, dev, ops):
+        """Sends a group of mkdir and rm operations to a board in one remote
+           call. Returns the set of line numbers which had a failure.
+        """
+        failed_lines = set()
+        try:
+            results = dev.remote_eval(batch_fs_ops, [op for _, op, _ in ops])
+        except DeviceError as err:
+            print_err(err)
+            return set(line_num for line_num, _, _ in ops)
+        for (line_num, op, filename), success in zip(ops, results):
+            if not success:
+                if op[1] == 'mkdir':
+                    print_err('Unable to create %s' % filename)
+                    failed_lines.add(line_num)
+                elif not op[4]:
+                    print_err("Unable to remove '{}'".format(filename))
+                    failed_lines.add(line_num)
+        return failed_lines
+
+    def run_script(self):
+        """Executes the file of commands which was passed in as stdin.
+
+           The whole file is parsed up front, so a syntax error on any line
+           means that nothing gets executed. Consecutive mkdir and rm commands
+           which operate on the same board are sent to the board as a single
+           remote call rather than one per file. Failures don't stop the
+           script, and every operation in a batch is attempted even after
+           one has failed (see batch_fs_ops), so a batch behaves like its
+           commands being run one at a time. The failing lines are listed
+           at the end.
+        """
+        commands = []
+        parse_ok = True
+        for line_num, line in enumerate(self.stdin, 1):
+            try:
+                for command in split_commands(line.strip()):
+                    shlex.split(command)
+                    commands.append((line_num, command.strip()))
+            except ValueError as err:
+                print_err('{}:{}: {}'.format(self.filename, line_num, err))
+                parse_ok = False
+        if not parse_ok:
+            return
+
+        failed_lines = set()
+        batch_dev = None
+        batch_ops = []
+        for cmd_idx, (line_num, command) in enumerate(commands):
+            if not command:
+                continue
+            if command == 'EOF' or command == 'exit':
+                break
+            self.line_num = line_num
+            try:
+                dev_ops = self.batch_fs_op(cmd_idx, command)
+            except DeviceError as err:
+                print_err(err)
+                failed_lines.add(line_num)
+                continue
+            if dev_ops and dev_ops[0] is batch_dev:
+                batch_ops += [(line_num, op, filename) for op, filename in dev_ops[1]]
+                continue
+            if batch_ops:
+                failed_lines |= self.run_batch_fs_ops(batch_dev, batch_ops)
+                batch_ops = []
+                batch_dev = None
+            if dev_ops:
+                batch_dev = dev_ops[0]
+                batch_ops = [(line_num, op, filename) for op, filename in dev_ops[1]]
+                continue
+            self.precmd(command)
+            self.onecmd_exec(command)
+            if ERROR:
+                failed_lines.add(line_num)
+            self.postcmd(False, command)
+        if batch_ops:
+            failed_lines |= self.run_batch_fs_ops(batch_dev, batch_ops)
+        if failed_lines:
+            print_err('{}: errors on line(s) {}'.format(
+                self.filename, ', '.join(str(line_num) for line_num in sorted(failed_lines))))
+
     def default(self, line):
         print_err("Unrecognized command:", line)
 
@@ -1982,32 +4539,68 @@ class Shell(cmd.Cmd):
 
         """
         pass
+
+    def preloop(self):
+        self.notify_prompt(self.visible_prompt())
+
     def precmd(self, line):
         global ERROR
         ERROR = False
+        self.notify_prompt(None)
         self.stdout = self.smart_stdout
         return line
 
     def postcmd(self, stop, line):
-        if self.stdout != self.smart_stdout:
-            if self.redirect_dev is not None:
-                # Redirecting to a remote device, now that we're finished the
-                # command, we can copy the collected output to the remote.
-                if DEBUG:
-                    print('Copy redirected output to "%s"' % self.redirect_filename)
-                # This belongs on the remote. Copy/append now
-                filesize = self.stdout.tell()
-                self.stdout.seek(0)
-                self.redirect_dev.remote(recv_file_from_host, self.stdout,
-                                         self.redirect_filename, filesize,
-                                         dst_mode=self.redirect_mode,
-                                         xfer_func=send_file_to_remote)
-            self.stdout.close()
+        self.end_redirect()
         self.stdout = self.real_stdout
         if not stop:
             self.set_prompt()
+            self.notify_prompt(self.visible_prompt())
         return stop
 
+    def notify_prompt(self, prompt):
+        """Tells notify whether the shell is waiting for input (see notify_prompt)."""
+        notify_prompt(prompt)
+
+    def visible_prompt(self):
+        """Returns the prompt which is shown while waiting for input, so that
+           notify can redraw it, or None if the shell isn't interactive.
+        """
+        if self.stdin != sys.stdin or not cmd.Cmd.use_rawinput or FAKE_INPUT_PROMPT:
+            return None
+        return self.prompt
+
+    def end_redirect(self):
+        """Finishes off the output redirection (if any) of the command which
+           has just been run. This is done after each command, so that when
+           several are separated by semicolons, each one gets its own.
+        """
+        if self.stdout not in (self.smart_stdout, self.real_stdout):
+            stdout = self.stdout
+            self.stdout = self.smart_stdout
+            if self.redirect_dev is not None and not isinstance(stdout.file, StreamUpload):
+                # Redirecting to a remote device, now that we're finished the
+                # command, we can copy the collected output to the remote.
+                if DEBUG:
+                    print('Copy redirected output to "%s"' % self.redirect_filename)
+                # This belongs on the remote. Copy/append now. This runs
+                # after the command, outside of onecmd_exec, so errors are
+                # reported here rather than ending the shell.
+                filesize = stdout.tell()
+                stdout.seek(0)
+                try:
+                    success = self.redirect_dev.remote_eval(recv_file_from_host, stdout,
+                                                            self.redirect_filename, filesize,
+                                                            dst_mode=self.redirect_mode,
+                                                            xfer_func=send_file_to_remote)
+                except DeviceError as err:
+                    print_err(err)
+                else:
+                    if not success:
+                        print_err('Unable to write to {} on {}'.format(self.redirect_filename,
+                                                                      self.redirect_dev.name))
+            stdout.close()
+
     def print(self, *args, end='\n', file=None):
         """Convenience function so you don't need to remember to put the \n
            at the end of the line.
@@ -2143,6 +4736,7 @@ class Shell(cmd.Cmd):
             args = shlex.split(line)
         except ValueError as err:
             raise DeviceError(str(err))
+        curr_cmd, _, _ = self.parseline(self.lastcmd)
         self.redirect_filename = ''
         self.redirect_dev = None
         redirect_index = -1
@@ -2167,23 +4761,47 @@ class Shell(cmd.Cmd):
                 if DEBUG:
                     print('Redirecting (append) to', self.redirect_filename)
             self.redirect_dev, self.redirect_filename = get_dev_and_path(self.redirect_filename)
+            del args[redirect_index + 1]
+            del args[redirect_index]
+        # The arguments are checked before the output is redirected, so that
+        # a command which isn't going to run doesn't truncate the file.
+        parser = self.create_argparser(curr_cmd)
+        parsed_args = parser.parse_args(args) if parser else args
+        self.check_args(curr_cmd, parsed_args)
+        if redirect_index >= 0:
             try:
                 if self.redirect_dev is None:
                     self.stdout = SmartFile(open(self.redirect_filename, self.redirect_mode))
+                elif self.can_stream_output(curr_cmd, args):
+                    self.stdout = SmartFile(StreamUpload(self.redirect_dev,
+                                                         self.redirect_filename,
+                                                         self.redirect_mode + 'b'))
                 else:
                     # Redirecting to a remote device. We collect the results locally
                     # and copy them to the remote device at the end of the command.
                     self.stdout = SmartFile(tempfile.TemporaryFile(mode='w+'))
             except OSError as err:
                 raise ShellError(err)
+        return parsed_args
 
-            del args[redirect_index + 1]
-            del args[redirect_index]
-        curr_cmd, _, _ = self.parseline(self.lastcmd)
-        parser = self.create_argparser(curr_cmd)
-        if parser:
-            args = parser.parse_args(args)
-        return args
+    def check_args(self, command, args):
+        """Called by line_to_args with the arguments of command (parsed, if
+           the command has an argparse_ spec). Raises ShellError if the
+           command can't be run with them.
+        """
+        pass
+
+    def can_stream_output(self, cmd, args):
+        """Returns True if the output of cmd can be streamed straight to the
+           board which it's being redirected to (see StreamUpload), which is
+           the case if the command won't be using that board itself.
+        """
+        if cmd == 'echo':
+            return True
+        if cmd == 'cat':
+            return all(arg == '-' or get_dev_and_path(resolve_path(arg))[0] is not self.redirect_dev
+                       for arg in args)
+        return False
 
     def do_args(self, line):
         """args [arguments...]
@@ -2220,15 +4838,16 @@ class Shell(cmd.Cmd):
         return self.filename_complete(text, line, begidx, endidx)
 
     def do_cat(self, line):
-        """cat FILENAME...
+        """cat [FILENAME|-]...
 
-           Concatenates files and sends to stdout.
+           Concatenates files and sends to stdout. - (or no FILENAME) reads
+           from stdin, until end of file.
         """
-        # note: when we get around to supporting cat from stdin, we'll need
-        #       to write stdin to a temp file, and then copy the file
-        #       since we need to know the filesize when copying to the pyboard.
         args = self.line_to_args(line)
-        for filename in args:
+        for filename in args or ['-']:
+            if filename == '-':
+                self.cat_stdin()
+                continue
             filename = resolve_path(filename)
             mode = auto(get_mode, filename)
             if not mode_exists(mode):
@@ -2237,7 +4856,25 @@ class Shell(cmd.Cmd):
             if not mode_isfile(mode):
                 print_err("'%s': is not a file" % filename)
                 continue
-            cat(filename, self.stdout)
+            if self.stdout.isatty():
+                # The progress bar would get mixed up with the file
+                with PROGRESS.suspended():
+                    cat(filename, self.stdout)
+            else:
+                cat(filename, self.stdout)
+
+    def cat_stdin(self):
+        """Copies stdin to stdout for cat. Data is passed on as soon as it's
+           read, rather than waiting for the end of the input.
+        """
+        stdin = sys.stdin.buffer
+        read = getattr(stdin, 'read1', stdin.read)
+        while True:
+            data = read(BUFFER_SIZE * 8)
+            if not data:
+                break
+            self.stdout.write(data)
+            self.stdout.flush()
 
     def complete_cd(self, text, line, begidx, endidx):
         return self.directory_complete(text, line, begidx, endidx)
@@ -2311,29 +4948,32 @@ class Shell(cmd.Cmd):
        cp SOURCE... DIRECTORY       Copy multiple SOURCE files to a directory.
        cp [-r|--recursive] [SOURCE|SOURCE_DIR]... DIRECTORY
        cp [-r] PATTERN DIRECTORY    Copy matching files to DIRECTORY.
+       cp --range START:END SOURCE DEST
+                                    Copy part of a single SOURCE file.
 
            The destination must be a directory except in the case of
            copying a single file. To copy directories -r must be specified.
            This will cause directories and their contents to be recursively
            copied.
+
+           With --mpy, python files copied to a board are compiled into
+           .mpy files using mpy-cross (boot.py and main.py are copied as is).
+
+           With --range, only the bytes from START up to (but not including)
+           END are copied, and only those bytes are transferred from a board.
+           As with Python slices, either may be left out, and negative values
+           count back from the end of the file, so --range=-1000: copies the
+           last 1000 bytes (the = is needed when START is negative).
        """
         args = self.line_to_args(line)
         if len(args.filenames) < 2:
             print_err('Missing destination file')
             return
         dst_dirname = resolve_path(args.filenames[-1])
-        dst_mode = auto(get_mode, dst_dirname)
-        d_dst = {}  # Destination directory: lookup stat by basename
-        if args.recursive:
-            dst_files = auto(listdir_stat, dst_dirname)
-            if dst_files is None:
-                err = "cp: target {} is not a directory"
-                print_err(err.format(dst_dirname))
-                return
-            for name, stat in dst_files:
-                d_dst[name] = stat
-
         src_filenames = args.filenames[:-1]
+        if args.range is not None:
+            self.copy_range(args.range, src_filenames, dst_dirname)
+            return
 
         # Process PATTERN
         sfn = src_filenames[0]
@@ -2344,13 +4984,66 @@ class Shell(cmd.Cmd):
             src_filenames = process_pattern(sfn)
             if src_filenames is None:
                 return
-
         for src_filename in src_filenames:
             if is_pattern(src_filename):
                 print_err("Only one pattern permitted.")
                 return
-            src_filename = resolve_path(src_filename)
-            src_mode = auto(get_mode, src_filename)
+        src_filenames = [resolve_path(src_filename) for src_filename in src_filenames]
+
+        # Look at the destination and all of the sources using a single
+        # batch of calls per board.
+        calls = [(get_mode, dst_dirname)]
+        if args.recursive:
+            calls.append((listdir_stat, dst_dirname, True, False))
+        calls += [(get_stat, src_filename) for src_filename in src_filenames]
+        results = auto_batch(calls)
+        dst_mode = results.pop(0)
+        d_dst = {}  # Destination directory: lookup stat by basename
+        if args.recursive:
+            dst_files = results.pop(0)
+            if dst_files is None:
+                err = "cp: target {} is not a directory"
+                print_err(err.format(dst_dirname))
+                return
+            for name, stat in dst_files:
+                d_dst[name] = stat
+
+        files = [stat for stat in results if mode_isfile(stat_mode(stat))]
+        with PROGRESS.job(sum(stat_size(stat) for stat in files), len(files)):
+            self.copy_files(args, src_filenames, results, dst_dirname, dst_mode, d_dst)
+
+    def copy_range(self, byte_range, src_filenames, dst_filename):
+        """Copies part of a single file for cp --range."""
+        if len(src_filenames) != 1 or is_pattern(src_filenames[0]):
+            print_err('cp --range copies a single file')
+            return
+        start, sep, end = byte_range.partition(':')
+        try:
+            if not sep:
+                raise ValueError
+            byte_slice = slice(int(start) if start else None, int(end) if end else None)
+        except ValueError:
+            print_err("Invalid range '{}', expecting START:END".format(byte_range))
+            return
+        src_filename = resolve_path(src_filenames[0])
+        src_stat, dst_mode = auto_batch([(get_stat, src_filename), (get_mode, dst_filename)])
+        if not mode_isfile(stat_mode(src_stat)):
+            print_err("File '{}' doesn't exist".format(src_filename))
+            return
+        if mode_isdir(dst_mode):
+            dst_filename = dst_filename + '/' + os.path.basename(src_filename)
+        start, end, _ = byte_slice.indices(stat_size(src_stat))
+        end = max(start, end)
+        self.print("Copying bytes {}-{} of '{}' to '{}' ...".format(start, end, src_filename,
+                                                                     dst_filename))
+        if not cp_range(src_filename, dst_filename, start, end):
+            err = "Unable to copy '{}' to '{}'"
+            print_err(err.format(src_filename, dst_filename))
+
+    def copy_files(self, args, src_filenames, src_stats, dst_dirname, dst_mode, d_dst):
+        """Copies each of src_filenames (whose stats are in src_stats) for cp."""
+        for src_filename, src_stat in zip(src_filenames, src_stats):
+            src_mode = stat_mode(src_stat)
             if not mode_exists(src_mode):
                 print_err("File '{}' doesn't exist".format(src_filename))
                 return
@@ -2372,7 +5065,8 @@ class Shell(cmd.Cmd):
                             return
 
                     rsync(src_filename, dst_filename, mirror=False, dry_run=False,
-                          print_func=lambda *args: None, recursed=False, sync_hidden=args.all)
+                          print_func=lambda *args: None, recursed=False, sync_hidden=args.all,
+                          mpy=args.mpy)
                 else:
                     print_err("Omitting directory {}".format(src_filename))
                 continue
@@ -2380,8 +5074,22 @@ class Shell(cmd.Cmd):
                 dst_filename = dst_dirname + '/' + os.path.basename(src_filename)
             else:
                 dst_filename = dst_dirname
+            if args.mpy and is_mpy_source(src_filename):
+                dst_dev, _ = get_dev_and_path(dst_filename)
+                if dst_dev is not None and get_dev_and_path(src_filename)[0] is None:
+                    dst_filename = mpy_name(dst_filename)
+                    self.print("Compiling '{}' ...".format(src_filename))
+                    mpy_filename = mpy_compile(src_filename, dst_dev)
+                    if mpy_filename is None:
+                        break
+                    self.print("Copying '{}' to '{}' ...".format(src_filename, dst_filename))
+                    if not cp(mpy_filename, dst_filename):
+                        err = "Unable to copy '{}' to '{}'"
+                        print_err(err.format(src_filename, dst_filename))
+                        break
+                    continue
             self.print("Copying '{}' to '{}' ...".format(src_filename, dst_filename))
-            if not cp(src_filename, dst_filename):
+            if not cp(src_filename, dst_filename, filesize=stat_size(src_stat)):
                 err = "Unable to copy '{}' to '{}'"
                 print_err(err.format(src_filename, dst_filename))
                 break
@@ -2430,7 +5138,8 @@ class Shell(cmd.Cmd):
 
            Copies the file locally, launches an editor to edit the file.
            When the editor exits, if the file was modified then its copied
-           back.
+           back. The local copy is kept, and is reused the next time the
+           file is edited if the file on the board hasn't changed.
 
            You can specify the editor used with the --editor command line
            option when you start rshell, or by using the VISUAL or EDITOR
@@ -2441,26 +5150,66 @@ class Shell(cmd.Cmd):
             return
         filename = resolve_path(line)
         dev, dev_filename = get_dev_and_path(filename)
-        mode = auto(get_mode, filename)
-        if mode_exists(mode) and mode_isdir(mode):
-            print_err("Unable to edit directory '{}'".format(filename))
-            return
         if dev is None:
             # File is local
+            if mode_isdir(auto(get_mode, filename)):
+                print_err("Unable to edit directory '{}'".format(filename))
+                return
             os.system("{} '{}'".format(EDITOR, filename))
         else:
             # File is remote
-            with tempfile.TemporaryDirectory() as temp_dir:
-                local_filename = os.path.join(temp_dir, os.path.basename(filename))
-                if mode_exists(mode):
-                    print('Retrieving {} ...'.format(filename))
-                    cp(filename, local_filename)
-                old_stat = get_stat(local_filename)
-                if os.system("{} '{}'".format(EDITOR, local_filename)) == 0:
-                    new_stat = get_stat(local_filename)
-                    if old_stat != new_stat:
-                        self.print('Updating {} ...'.format(filename))
-                        cp(local_filename, filename)
+            self.edit_remote(filename, dev, dev_filename)
+
+    def edit_remote(self, filename, dev, dev_filename):
+        """Edits a copy of a file on a board, for edit. The copy is kept in
+           EDIT_CACHE_DIR, and is only downloaded again if the size, mtime or
+           sha256 of the file on the board no longer match the copy. Boards
+           without an RTC can rewrite a file without changing its size or
+           mtime, so if the board can't compute the sha256, the file is
+           always downloaded. The file is only uploaded if its contents were
+           changed, in which case only the changed blocks of large files are
+           sent.
+        """
+        local_filename, state_filename = edit_cache_filenames(dev, dev_filename)
+        os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+        stat, checksum = auto_batch([(get_stat, filename), (get_checksum, filename)])
+        if checksum is not None:
+            checksum = str(checksum, encoding='utf-8')
+        if mode_isdir(stat_mode(stat)):
+            print_err("Unable to edit directory '{}'".format(filename))
+            return
+        state = load_edit_state(state_filename)
+        if mode_exists(stat_mode(stat)):
+            local_checksum = host_checksum(local_filename)
+            if (state.get('size') == stat_size(stat) and state.get('mtime') == stat_mtime(stat) and
+                    checksum is not None and checksum == local_checksum and
+                    state.get('sha256') == local_checksum):
+                STATS.add('edit_cache_hits')
+            else:
+                print('Retrieving {} ...'.format(filename))
+                if not cp(filename, local_filename):
+                    print_err("Unable to copy '{}'".format(filename))
+                    return
+                state = {'sha256': host_checksum(local_filename)}
+                save_edit_state(state_filename, stat, state['sha256'])
+        else:
+            state = {}
+            if os.path.exists(local_filename):
+                os.remove(local_filename)
+        if os.system("{} '{}'".format(EDITOR, local_filename)) != 0:
+            return
+        new_checksum = host_checksum(local_filename)
+        if new_checksum is None or new_checksum == state.get('sha256'):
+            return
+        self.print('Updating {} ...'.format(filename))
+        bundle = Bundle(os.path.dirname(filename), delta=True)
+        bundle.add_file(local_filename, filename,
+                        stat_size(stat) if mode_exists(stat_mode(stat)) else None)
+        if bundle.upload():
+            save_edit_state(state_filename, auto(get_stat, filename), new_checksum)
+        elif os.path.exists(state_filename):
+            # Make sure that the next edit starts from the copy on the board
+            os.remove(state_filename)
 
     def complete_filesize(self, text, line, begidx, endidx):
         return self.filename_complete(text, line, begidx, endidx)
@@ -2533,6 +5282,35 @@ class Shell(cmd.Cmd):
             pass
         self.print(str(self.nohelp % (line,)))
 
+    argparse_head = (
+        add_arg(
+            '-n', '--lines',
+            dest='lines',
+            metavar='NUM',
+            type=int,
+            help='print the first NUM lines instead of the first 10',
+            default=10
+        ),
+        add_arg(
+            'filenames',
+            metavar='FILE',
+            nargs='+',
+            help='Files to print'
+        ),
+    )
+
+    def complete_head(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx)
+
+    def do_head(self, line):
+        """head [-n NUM] FILE...
+
+           Prints the first 10 (or NUM) lines of each FILE. For files on a
+           board, only those lines are transferred.
+        """
+        args = self.line_to_args(line)
+        self.print_lines(args.filenames, args.lines, False)
+
     argparse_ls = (
         add_arg(
             '-a', '--all',
@@ -2548,6 +5326,20 @@ class Shell(cmd.Cmd):
             help='use a long listing format',
             default=False
         ),
+        add_arg(
+            '-R', '--recursive',
+            dest='recursive',
+            action='store_true',
+            help='list subdirectories recursively',
+            default=False
+        ),
+        add_arg(
+            '-U',
+            dest='unsorted',
+            action='store_true',
+            help='do not sort; list entries as they are read from the directory',
+            default=False
+        ),
         add_arg(
             'filenames',
             metavar='FILE',
@@ -2560,7 +5352,7 @@ class Shell(cmd.Cmd):
         return self.filename_complete(text, line, begidx, endidx)
 
     def do_ls(self, line):
-        """ls [-a] [-l] [FILE|DIRECTORY|PATTERN]...
+        """ls [-a] [-l] [-R] [-U] [FILE|DIRECTORY|PATTERN]...
        PATTERN supports * ? [seq] [!seq] Unix filename matching
 
            List directory contents.
@@ -2568,46 +5360,83 @@ class Shell(cmd.Cmd):
         args = self.line_to_args(line)
         if len(args.filenames) == 0:
             args.filenames = ['.']
-        for idx, fn in enumerate(args.filenames):
-            if not is_pattern(fn):
-                filename = resolve_path(fn)
-                stat = auto(get_stat, filename)
-                mode = stat_mode(stat)
-                if not mode_exists(mode):
-                    err = "Cannot access '{}': No such file or directory"
-                    print_err(err.format(filename))
-                    continue
-                if not mode_isdir(mode):
-                    if args.long:
-                        print_long(fn, stat, self.print)
-                    else:
-                        self.print(fn)
-                    continue
-                if len(args.filenames) > 1:
-                    if idx > 0:
-                        self.print('')
-                    self.print("%s:" % filename)
-                pattern = '*'
-            else: # A pattern was specified
-                filename, pattern = validate_pattern(fn)
+        entries = []
+        for fn in args.filenames:
+            if is_pattern(fn):
+                filename, pattern = resolve_pattern(fn)
                 if filename is None: # An error was printed
                     continue
-            files = []
-            ldir_stat = auto(listdir_lstat, filename)
-            if ldir_stat is None:
-                err = "Cannot access '{}': No such file or directory"
-                print_err(err.format(filename))
             else:
-                for filename, stat in sorted(ldir_stat,
-                                             key=lambda entry: entry[0]):
-                    if is_visible(filename) or args.all:
-                        if fnmatch.fnmatch(filename, pattern):
-                            if args.long:
-                                print_long(filename, stat, self.print)
-                            else:
-                                files.append(decorated_filename(filename, stat))
-            if len(files) > 0:
+                filename = resolve_path(fn)
+                pattern = None
+            entries.append((fn, filename, pattern))
+        # Each entry produces its stat, followed by the files in it (if it's
+        # a directory) and then None. With -R, the files in each subdirectory
+        # follow, preceded by the name of the subdirectory. Patterns are
+        # matched on the board, which doesn't walk the subdirectories of a
+        # pattern's directory. The files are printed as they arrive when
+        # they're unsorted. Sorting needs the whole of a directory, so
+        # otherwise its entries are kept until it's complete (only one
+        # directory is held at a time, and -U avoids holding any).
+        entry_iter = iter(enumerate(entries))
+        state = {'entry': None, 'listing': False, 'files': []}
+
+        def print_files():
+            files = state['files']
+            if args.long:
+                for filename, stat in sorted(files, key=lambda entry: entry[0]):
+                    print_long(filename, stat, self.print)
+            elif len(files) > 0:
                 print_cols(sorted(files), self.print, self.columns)
+            state['files'] = []
+
+        def ls_record(record):
+            if state['entry'] is None:
+                idx, (fn, filename, pattern) = next(entry_iter)
+                state['entry'] = filename
+                state['listing'] = False
+                state['files'] = []
+                mode = stat_mode(record)
+                if pattern is None:
+                    if not mode_exists(mode):
+                        err = "Cannot access '{}': No such file or directory"
+                        print_err(err.format(filename))
+                    elif not mode_isdir(mode):
+                        if args.long:
+                            print_long(fn, record, self.print)
+                        else:
+                            self.print(fn)
+                    else:
+                        if len(args.filenames) > 1 or args.recursive:
+                            if idx > 0:
+                                self.print('')
+                            self.print("%s:" % filename)
+                        state['listing'] = True
+                elif check_pattern_dir(fn, mode):
+                    state['listing'] = True
+            elif record is None:
+                print_files()
+                state['entry'] = None
+            elif isinstance(record, str):
+                # The start of a subdirectory
+                print_files()
+                self.print('')
+                self.print("%s/%s:" % (state['entry'].rstrip('/'), record))
+            elif state['listing']:
+                filename, stat = record
+                if args.unsorted:
+                    if args.long:
+                        print_long(filename, stat, self.print)
+                    else:
+                        self.print(decorated_filename(filename, stat))
+                elif args.long:
+                    state['files'].append(record)
+                else:
+                    state['files'].append(decorated_filename(filename, stat))
+
+        auto_stream(list_files, [filename if pattern is None else (filename, pattern)
+                                 for _, filename, pattern in entries], ls_record,
+                    args.all, args.long, args.recursive)
 
     argparse_df = (
         add_arg(
@@ -2625,53 +5454,217 @@ class Shell(cmd.Cmd):
             default=False
         ),
         add_arg(
-            '-H', '--si',
-            dest='human_readable_si',
-            action='store_true',
-            help='Prints sizes in a human-readable format using power of 1000',
-            default=False
+            '-H', '--si',
+            dest='human_readable_si',
+            action='store_true',
+            help='Prints sizes in a human-readable format using power of 1000',
+            default=False
+        ),
+        add_arg(
+            '--watch',
+            dest='watch',
+            metavar='INTERVAL',
+            type=float,
+            help='Reports the space again every INTERVAL seconds, until Control-C is pressed',
+            default=None
+        ),
+    )
+
+    def complete_df(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx)
+
+
+    def do_df(self, line):
+        """df [-b|-h|-H] [--watch INTERVAL]
+
+           Report file system space usage
+        """
+        args = self.line_to_args(line)
+
+        if args.byte_sizes:
+            columns = dfutils.create_byte_sizes_columns(dfutils.DByteFormat.BYTES)
+        elif args.human_readable:
+            columns = dfutils.create_byte_sizes_columns(dfutils.DByteFormat.HUMAN)
+        elif args.human_readable_si:
+            columns = dfutils.create_byte_sizes_columns(dfutils.DByteFormat.HUMAN_SI)
+        else:
+            columns = dfutils.create_block_sizes_columns()
+
+        with DEV_LOCK:
+            devs = list(DEVS)
+        if args.watch is None:
+            self.print_df(devs, columns)
+            return
+        # Each board stays in the raw REPL between polls, so only the first
+        # poll soft reboots it and sends the code.
+        with contextlib.ExitStack() as stack:
+            for dev in devs:
+                stack.enter_context(dev.raw_repl_session())
+            try:
+                while True:
+                    self.print(time.strftime('%Y-%m-%d %H:%M:%S'))
+                    self.print_df(devs, columns)
+                    time.sleep(args.watch)
+                    self.print('')
+            except KeyboardInterrupt:
+                self.print('')
+
+    def print_df(self, devs, columns):
+        """Prints the df table for the root directories of devs. The boards
+           are queried at the same time, using one call for each board.
+        """
+        def vfs_stats(dev):
+            try:
+                return dev.remote_eval(get_vfs_stats_list, dev.root_dirs)
+            except DeviceError as err:
+                return err
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(devs), 1)) as executor:
+            dev_stats = list(executor.map(vfs_stats, devs))
+        table = []
+        widths = [len(col.title()) for col in columns]
+        for dev, stats_list in zip(devs, dev_stats):
+            if isinstance(stats_list, DeviceError):
+                print_err(stats_list)
+                continue
+            for dir, stats in zip(dev.root_dirs, stats_list):
+                row = [col.formatted(stats, dev.name, dir) for col in columns]
+                table.append(row)
+                widths = [max(len(val), widths[i]) for i, val in enumerate(row)]
+        col_formatters = []
+        for i, width in enumerate(widths):
+            # first and last row should be aligned to the left, others to the right
+            alignment = '<' if i == 0 or i == len(widths) - 1 else '>'
+            col_formatters.append('{:' + alignment + str(width) + 's}')
+        row_f = "  ".join(col_formatters)
+        self.print(row_f.format(*[col.title() for col in columns]))
+        for row in table:
+            self.print(row_f.format(*row))
+
+    argparse_du = (
+        add_arg(
+            '-s', '--summarize',
+            dest='summarize',
+            action='store_true',
+            help='display only a total for each argument',
+            default=False
+        ),
+        add_arg(
+            '-h', '--human-readable',
+            dest='human_readable',
+            action='store_true',
+            help='Prints sizes in a human-readable format using power of 1024',
+            default=False
+        ),
+        add_arg(
+            'filenames',
+            metavar='FILE',
+            nargs='*',
+            help='Files or directories to report on'
+        ),
+    )
+
+    def complete_du(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx)
+
+    def do_du(self, line):
+        """du [-s] [-h] [FILE|DIRECTORY]...
+
+           Report the space used by files, and by each directory in the
+           trees rooted at the directories given.
+        """
+        args = self.line_to_args(line)
+        if len(args.filenames) == 0:
+            args.filenames = ['.']
+        filename_iter = iter(args.filenames)
+        state = {'fn': None}
+
+        def du_record(record):
+            if state['fn'] is None:
+                state['fn'] = next(filename_iter)
+            if record is None:
+                state['fn'] = None
+            elif record is False:
+                err = "Cannot access '{}': No such file or directory"
+                print_err(err.format(state['fn']))
+            else:
+                path, size = record
+                if args.human_readable:
+                    size = dfutils.convert_bytes(size, 'B')
+                if path:
+                    path = state['fn'].rstrip('/') + '/' + path
+                self.print('{}\t{}'.format(size, path or state['fn']))
+
+        auto_stream(disk_usage, [resolve_path(fn) for fn in args.filenames], du_record,
+                    args.summarize)
+
+    argparse_find = (
+        add_arg(
+            'filenames',
+            metavar='PATH',
+            nargs='*',
+            help='Directories to search'
+        ),
+        add_arg(
+            '-name',
+            dest='name',
+            metavar='PATTERN',
+            help='only list files whose names match PATTERN',
+            default=None
+        ),
+        add_arg(
+            '-newer',
+            dest='newer',
+            metavar='FILE',
+            help='only list files modified more recently than FILE',
+            default=None
+        ),
+        add_arg(
+            '-type',
+            dest='type',
+            choices=('f', 'd'),
+            help='only list files (f) or directories (d)',
+            default=None
         ),
     )
 
-    def complete_df(self, text, line, begidx, endidx):
+    def complete_find(self, text, line, begidx, endidx):
         return self.filename_complete(text, line, begidx, endidx)
 
+    def do_find(self, line):
+        """find [PATH]... [-name PATTERN] [-newer FILE] [-type f|d]
+       PATTERN supports * ? [seq] [!seq] Unix filename matching
 
-    def do_df(self, line):
-        """df [-b|-h|-H]
-
-           Report file system space usage
+           Search for files in the trees rooted at each PATH.
         """
         args = self.line_to_args(line)
+        if len(args.filenames) == 0:
+            args.filenames = ['.']
+        newer = None
+        if args.newer is not None:
+            newer_stat = auto(get_stat, resolve_path(args.newer))
+            if not mode_exists(stat_mode(newer_stat)):
+                print_err("Cannot access '{}': No such file or directory".format(args.newer))
+                return
+            newer = stat_mtime(newer_stat)
+        filename_iter = iter(args.filenames)
+        state = {'fn': None}
+
+        def find_record(record):
+            if state['fn'] is None:
+                state['fn'] = next(filename_iter)
+            if record is None:
+                state['fn'] = None
+            elif record is False:
+                err = "Cannot access '{}': No such file or directory"
+                print_err(err.format(state['fn']))
+            elif record:
+                self.print(state['fn'].rstrip('/') + '/' + record)
+            else:
+                self.print(state['fn'])
 
-        if args.byte_sizes:
-            columns = dfutils.create_byte_sizes_columns(dfutils.DByteFormat.BYTES)
-        elif args.human_readable:
-            columns = dfutils.create_byte_sizes_columns(dfutils.DByteFormat.HUMAN)
-        elif args.human_readable_si:
-            columns = dfutils.create_byte_sizes_columns(dfutils.DByteFormat.HUMAN_SI)
-        else:
-            columns = dfutils.create_block_sizes_columns()
-
-        table = []
-        widths = [len(col.title()) for col in columns]
-        with DEV_LOCK:
-            for dev in DEVS:
-                for dir in dev.root_dirs:
-                    stats = dev.remote_eval(get_vfs_stats, dir)
-                    row = [col.formatted(stats, dev.name, dir) for col in columns]
-                    table.append(row)
-                    widths = [max(len(val), widths[i]) for i, val in enumerate(row)]
-        col_formatters = []
-        for i, width in enumerate(widths):
-            # first and last row should be aligned to the left, others to the right
-            alignment = '<' if i == 0 or i == len(widths) - 1 else '>'
-            col_formatters.append('{:' + alignment + str(width) + 's}')
-        row_f = "  ".join(col_formatters)
-        print(row_f.format(*[col.title() for col in columns]))
-        for row in table:
-            print(row_f.format(*row))
-
+        auto_stream(find_files, [resolve_path(fn) for fn in args.filenames], find_record,
+                    args.name, newer, args.type)
 
     def complete_mkdir(self, text, line, begidx, endidx):
         return self.filename_complete(text, line, begidx, endidx)
@@ -2819,6 +5812,22 @@ class Shell(cmd.Cmd):
             help='Copy directories recursively',
             default=False
         ),
+        add_arg(
+            '--mpy',
+            dest='mpy',
+            action='store_true',
+            help='Compile .py files into .mpy files using mpy-cross',
+            default=False
+        ),
+        add_arg(
+            '--range',
+            dest='range',
+            metavar='START:END',
+            help='Only copy the bytes from START up to END of a single file. '
+                 'Either may be left out, and negative values count back from '
+                 'the end of the file (use --range=-1000: when START is negative)',
+            default=None
+        ),
         add_arg(
             'filenames',
             metavar='FILE',
@@ -2855,32 +5864,41 @@ class Shell(cmd.Cmd):
 
     def do_rm(self, line):
         """rm [-f|--force] FILE...            Remove one or more files
-       rm [-f|--force] PATTERN            Remove multiple files
+       rm [-f|--force] PATTERN...         Remove multiple files
        rm -r [-f|--force] [FILE|DIRECTORY]... Files and/or directories
-       rm -r [-f|--force] PATTERN         Multiple files and/or directories
+       rm -r [-f|--force] PATTERN...      Multiple files and/or directories
 
            Removes files or directories. To remove directories (and
            any contents) -r must be specified.
 
         """
         args = self.line_to_args(line)
-        filenames = args.filename
-        # Process PATTERN
-        sfn = filenames[0]
-        if is_pattern(sfn):
-            if len(filenames) > 1:
-                print_err("Usage: rm [-r] [-f] PATTERN")
-                return
-            filenames = process_pattern(sfn)
-            if filenames is None:
-                return
-
-        for filename in filenames:
-            filename = resolve_path(filename)
-            if not rm(filename, recursive=args.recursive, force=args.force):
-                if not args.force:
-                    print_err("Unable to remove '{}'".format(filename))
-                break
+        # Patterns are matched on the board, so everything (however many
+        # files match) is removed using a single call per board.
+        filenames = []
+        targets = []
+        for filename in args.filename:
+            if is_pattern(filename):
+                path, pattern = resolve_pattern(filename)
+                if path is None: # An error was printed
+                    continue
+            else:
+                path, pattern = resolve_path(filename), None
+            filenames.append(filename)
+            targets.append((path, pattern))
+        results = remove_targets(targets, recursive=args.recursive, force=args.force)
+        if args.force:
+            return
+        for filename, (path, pattern), (_, failed) in zip(filenames, targets, results):
+            if failed is None:
+                print_err("cannot access '{}': No such file or directory".format(filename))
+            elif pattern is None:
+                if failed:
+                    print_err("Unable to remove '{}'".format(path))
+            else:
+                for failed_filename in failed:
+                    print_err("Unable to remove '{}/{}'".format(path.rstrip('/'),
+                                                               failed_filename.split('/')[-1]))
 
     def do_shell(self, line):
         """!some-shell-command args
@@ -2893,6 +5911,139 @@ class Shell(cmd.Cmd):
             line = '/bin/bash'
         os.system(line)
 
+    argparse_stats = (
+        add_arg(
+            '-r', '--reset',
+            dest='reset',
+            action='store_true',
+            help='Reset the statistics after printing them',
+            default=False
+        ),
+    )
+
+    def do_stats(self, line):
+        """stats [-r|--reset]
+
+           Prints the time spent in each phase of the remote calls made so far
+           and the number of bytes transferred.
+        """
+        args = self.line_to_args(line)
+        rows = [('Phase', 'Count', 'Total ms', 'Avg ms', 'Max ms'), '-']
+        rows += [(name, str(count), '%.1f' % total, '%.2f' % avg, '%.2f' % longest)
+                 for name, count, total, avg, longest in STATS.phase_rows()]
+        column_print('<>>>>', rows, self.print)
+        self.print('')
+        rows = [('Counter', 'Value'), '-']
+        rows += [(name, str(value)) for name, value in STATS.counter_rows()]
+        column_print('<>', rows, self.print)
+        if args.reset:
+            STATS.reset()
+
+    argparse_tail = (
+        add_arg(
+            '-n', '--lines',
+            dest='lines',
+            metavar='NUM',
+            type=int,
+            help='print the last NUM lines instead of the last 10',
+            default=10
+        ),
+        add_arg(
+            '-f', '--follow',
+            dest='follow',
+            action='store_true',
+            help='print data as it\'s appended to the files',
+            default=False
+        ),
+        add_arg(
+            '-s', '--sleep-interval',
+            dest='interval',
+            metavar='SECONDS',
+            type=float,
+            help='with -f, check the files every SECONDS seconds (default 1)',
+            default=1.0
+        ),
+        add_arg(
+            'filenames',
+            metavar='FILE',
+            nargs='+',
+            help='Files to print'
+        ),
+    )
+
+    def complete_tail(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx)
+
+    def do_tail(self, line):
+        """tail [-n NUM] [-f] [-s SECONDS] FILE...
+
+           Prints the last 10 (or NUM) lines of each FILE. For files on a
+           board, the lines are found by reading backwards from the end of
+           the file, and only those lines are transferred.
+
+           With -f, tail keeps checking the size of the files (every
+           SECONDS seconds), and prints whatever gets appended to them,
+           until Control-C is pressed.
+        """
+        args = self.line_to_args(line)
+        self.print_lines(args.filenames, args.lines, True, args.follow, args.interval)
+
+    def print_lines(self, filenames, num_lines, from_end, follow=False, interval=1.0):
+        """Prints the first (or last) num_lines lines of each of filenames,
+           for head and tail. Each board stays in the raw REPL until the
+           command is done, so following files only costs a call per board
+           each time they're checked.
+        """
+        filenames = [resolve_path(filename) for filename in filenames]
+        devs = []
+        for filename in filenames:
+            dev = get_dev_and_path(filename)[0]
+            if dev is not None and dev not in devs:
+                devs.append(dev)
+        state = {'header': None}
+
+        def print_header(filename):
+            if len(filenames) > 1 and state['header'] != filename:
+                if state['header'] is not None:
+                    self.print('')
+                self.print('==> {} <=='.format(filename))
+            state['header'] = filename
+
+        with contextlib.ExitStack() as stack:
+            for dev in devs:
+                stack.enter_context(dev.raw_repl_session())
+            ends = {}
+            for filename in filenames:
+                file_range = auto(line_range, filename, num_lines, from_end)
+                if file_range is None:
+                    print_err("Cannot access '{}': No such file".format(filename))
+                    continue
+                print_header(filename)
+                cat_range(filename, self.stdout, *file_range)
+                ends[filename] = file_range[1]
+            self.stdout.flush()
+            if not follow:
+                return
+            try:
+                while ends:
+                    time.sleep(interval)
+                    sizes = auto_batch([(get_filesize, filename) for filename in ends])
+                    for (filename, end), size in zip(list(ends.items()), sizes):
+                        if size < 0:
+                            print_err("Cannot access '{}': No such file".format(filename))
+                            del ends[filename]
+                            continue
+                        if size < end:
+                            print_err('{}: file truncated'.format(filename))
+                            end = 0
+                        if size > end:
+                            print_header(filename)
+                            cat_range(filename, self.stdout, end, size)
+                        ends[filename] = size
+                    self.stdout.flush()
+            except KeyboardInterrupt:
+                self.print('')
+
     argparse_rsync = (
         add_arg(
             '-a', '--all',
@@ -2925,6 +6076,54 @@ class Shell(cmd.Cmd):
             help='Doesn\'t show what has been done.',
             default=False
         ),
+        add_arg(
+            '--mpy',
+            dest='mpy',
+            action='store_true',
+            help='Compile .py files into .mpy files using mpy-cross',
+            default=False
+        ),
+        add_arg(
+            '--stage',
+            dest='stage',
+            action='store_true',
+            help='Upload everything before replacing or removing any files '
+                 'on the board',
+            default=False
+        ),
+        add_arg(
+            '--delta',
+            dest='delta',
+            action='store_true',
+            help='Only send the parts of changed files which differ from '
+                 'the copy on the board',
+            default=False
+        ),
+        add_arg(
+            '-w', '--watch',
+            dest='watch',
+            action='store_true',
+            help='After synchronizing, keep watching SRC_DIR and copy changes '
+                 'to the board as they happen',
+            default=False
+        ),
+        add_arg(
+            '--debounce',
+            dest='debounce',
+            metavar='SECONDS',
+            type=float,
+            help='With --watch, wait until nothing has changed for SECONDS '
+                 'before copying (default 0.5)',
+            default=0.5
+        ),
+        add_arg(
+            '--reset',
+            dest='reset',
+            action='store_true',
+            help='With --watch, soft reset the board after copying each batch '
+                 'of changes',
+            default=False
+        ),
         add_arg(
             'src_dir',
             metavar='SRC_DIR',
@@ -2938,23 +6137,382 @@ class Shell(cmd.Cmd):
     )
 
     def do_rsync(self, line):
-        """rsync [-m|--mirror] [-n|--dry-run] [-q|--quiet] SRC_DIR DEST_DIR
+        """rsync [-m|--mirror] [-n|--dry-run] [-q|--quiet] [--mpy] [--delta] [--stage]
+       [-w|--watch [--debounce SECONDS] [--reset]] SRC_DIR DEST_DIR
 
            Synchronizes a destination directory tree with a source directory tree.
+           With --mpy, foo.py on the host is compiled and synchronized with
+           foo.mpy on the board. With --delta, only the changed blocks of
+           large files are sent to the board. With --stage, files on the
+           board are only replaced or removed once everything has been
+           uploaded.
+
+           With --watch, rsync carries on watching SRC_DIR (which must be on
+           the host) once the trees are synchronized, and copies whatever
+           changes to the board, until Control-C is pressed. With --reset,
+           the board is soft reset after each batch of changes.
         """
         args = self.line_to_args(line)
         src_dir = resolve_path(args.src_dir)
         dst_dir = resolve_path(args.dst_dir)
         verbose = not args.quiet
         pf = print if args.dry_run or verbose else lambda *args : None
-        rsync(src_dir, dst_dir, mirror=args.mirror, dry_run=args.dry_run,
-             print_func=pf, recursed=False, sync_hidden=args.all)
+        watcher = None
+        if args.watch:
+            dst_dev = get_dev_and_path(dst_dir)[0]
+            if get_dev_and_path(src_dir)[0] is not None or dst_dev is None or args.dry_run:
+                print_err('rsync --watch copies from a directory on the host to a board')
+                return
+            # Start watching first, so that nothing changed during the
+            # initial synchronization gets missed.
+            watcher = create_watcher(src_dir)
+        try:
+            with PROGRESS.job():
+                rsync(src_dir, dst_dir, mirror=args.mirror, dry_run=args.dry_run,
+                      print_func=pf, recursed=False, sync_hidden=args.all, mpy=args.mpy,
+                      delta=args.delta, stage=args.stage)
+            if watcher is not None:
+                self.watch_rsync(args, watcher, src_dir, dst_dir, dst_dev, pf)
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    def watch_rsync(self, args, watcher, src_dir, dst_dir, dst_dev, print_func):
+        """Copies changes to the board as they're made, for rsync --watch.
+           The board stays in the raw REPL between batches of changes
+           (unless it's reset after each one), so each batch only costs the
+           transfers themselves.
+        """
+        self.print('Watching {} for changes. Press Control-C to stop.'.format(src_dir))
+        try:
+            with contextlib.ExitStack() as stack:
+                if not args.reset:
+                    stack.enter_context(dst_dev.raw_repl_session())
+                while True:
+                    changed = watcher.wait_for_changes(args.debounce)
+                    try:
+                        with contextlib.ExitStack() as batch:
+                            if args.reset:
+                                # The board has to leave the raw REPL to be reset
+                                batch.enter_context(dst_dev.raw_repl_session())
+                            with PROGRESS.job():
+                                rsync_changes(src_dir, dst_dir, changed, args.mirror,
+                                              print_func, args.all, args.mpy,
+                                              args.delta, args.stage)
+                        if args.reset:
+                            print_func('Resetting %s' % dst_dev.name)
+                            dst_dev.soft_reset()
+                    except DeviceError as err:
+                        print_err(err)
+        except KeyboardInterrupt:
+            self.print('')
+
+
+class DaemonShell(Shell):
+    """Shell used by the daemon to run commands forwarded from clients.
+
+       Commands which need to interact with the client's terminal can't be
+       run by the daemon.
+    """
+
+    def interactive_only(self, command):
+        raise ShellError("'{}' isn't available through the rshell daemon. "
+                         "Use rshell --no-daemon instead.".format(command))
+
+    def check_args(self, command, args):
+        """Refuses commands which would read the daemon's stdin rather than
+           the client's, or which run until they're interrupted (which only
+           stops the client, leaving the daemon busy).
+        """
+        if command == 'cat' and (not args or '-' in args):
+            self.interactive_only('cat -')
+        if command == 'tail' and args.follow:
+            self.interactive_only('tail -f')
+        if command == 'rsync' and args.watch:
+            self.interactive_only('rsync --watch')
+
+    def notify_prompt(self, prompt):
+        # The daemon prints notifications as they happen (see run_daemon),
+        # so they don't end up in the output sent to a client.
+        pass
+
+    def do_edit(self, line):
+        self.interactive_only('edit')
+
+    def do_repl(self, line):
+        self.interactive_only('repl')
+
+    def do_shell(self, line):
+        self.interactive_only('shell')
+
+
+class DaemonStream(object):
+    """File-like object which forwards the output of a command running in
+       the daemon to the client which requested the command.
+    """
+
+    def __init__(self, sock_file, stream):
+        self.sock_file = sock_file
+        self.stream = stream
+        # SmartFile writes bytes to file.buffer
+        self.buffer = self
+
+    def flush(self):
+        self.sock_file.flush()
+
+    def isatty(self):
+        return False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if data:
+            self.sock_file.write(struct.pack(DAEMON_FRAME, self.stream, len(data)))
+            self.sock_file.write(data)
+            self.sock_file.flush()
+        return len(data)
+
+
+class ThreadOutput(object):
+    """File-like object which the daemon uses as sys.stdout and sys.stderr.
+       Output from the thread which is running a command goes to the stream
+       of the client which sent it (see redirect), and output from any
+       other thread, like the ones which connect boards when they're plugged
+       in, goes to the daemon's own stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    @property
+    def target(self):
+        return getattr(self.local, 'stream', None) or self.stream
+
+    @contextlib.contextmanager
+    def redirect(self, stream):
+        """Sends the output of the current thread to stream."""
+        self.local.stream = stream
+        try:
+            yield
+        finally:
+            self.local.stream = None
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+@contextlib.contextmanager
+def daemon_options(options):
+    """Applies the options which a client sent along with its command (see
+       DAEMON_OPTIONS) while the daemon runs the command, and then goes back
+       to the daemon's own settings.
+    """
+    global BUFFER_SIZE
+    global WRITE_BUF_SIZE
+    global SYNC_BYTES
+    global XFER_CHUNK_TIMEOUT
+    global XFER_RETRIES
+    global MPY_CROSS
+    saved = (BUFFER_SIZE, WRITE_BUF_SIZE, SYNC_BYTES, XFER_CHUNK_TIMEOUT, XFER_RETRIES,
+             MPY_CROSS, PROGRESS.mode, STATS.tracing)
+    with DEV_LOCK:
+        devs = list(DEVS)
+    saved_devs = [(dev, dev.has_buffer, dev.write_buf_size) for dev in devs]
+    BUFFER_SIZE = options.get('buffer_size', BUFFER_SIZE)
+    WRITE_BUF_SIZE = options.get('write_buf_size', WRITE_BUF_SIZE)
+    SYNC_BYTES = options.get('sync_bytes', SYNC_BYTES)
+    XFER_CHUNK_TIMEOUT = options.get('xfer_timeout', XFER_CHUNK_TIMEOUT)
+    XFER_RETRIES = options.get('xfer_retries', XFER_RETRIES)
+    MPY_CROSS = options.get('mpy_cross', MPY_CROSS)
+    PROGRESS.mode = options.get('progress', PROGRESS.mode)
+    for dev in devs:
+        if options.get('ascii_xfer'):
+            dev.has_buffer = False
+        if 'write_buf_size' in options:
+            dev.write_buf_size = write_buf_size(dev.mem_free)
+    trace_json = options.get('trace_json')
+    if trace_json:
+        STATS.tracing = True
+        first_event = STATS.num_events()
+    try:
+        yield
+    finally:
+        if trace_json:
+            try:
+                STATS.write_trace(trace_json, first_event)
+            except OSError as err:
+                print_err(err)
+        (BUFFER_SIZE, WRITE_BUF_SIZE, SYNC_BYTES, XFER_CHUNK_TIMEOUT, XFER_RETRIES,
+         MPY_CROSS, PROGRESS.mode, STATS.tracing) = saved
+        for dev, has_buffer, dev_write_buf_size in saved_devs:
+            dev.has_buffer = has_buffer
+            dev.write_buf_size = dev_write_buf_size
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """Runs a single command line (or command file) sent by an rshell client."""
+
+    def handle(self):
+        global ERROR
+        try:
+            request = json.loads(str(self.rfile.readline(), encoding='utf-8'))
+        except ValueError:
+            return
+        stdout = DaemonStream(self.wfile, DAEMON_STDOUT)
+        stderr = DaemonStream(self.wfile, DAEMON_STDERR)
+        ERROR = False
+        try:
+            with self.server.stdout.redirect(stdout), self.server.stderr.redirect(stderr), \
+                    daemon_options(request.get('options', {})):
+                try:
+                    os.chdir(request['cwd'])
+                except OSError as err:
+                    print_err(err)
+                if 'script' in request:
+                    shell = DaemonShell(stdin=io.StringIO(request['script']),
+                                        stdout=stdout, filename=request['filename'],
+                                        timing=self.server.timing)
+                    shell.run_script()
+                else:
+                    shell = DaemonShell(stdout=stdout, timing=self.server.timing)
+                    shell.cmdloop(request['cmd'])
+        except BrokenPipeError:
+            # The client went away before the command finished.
+            return
+        except Exception:
+            ERROR = True
+            stderr.write(traceback.format_exc())
+        try:
+            stdout.sock_file.write(struct.pack(DAEMON_FRAME, DAEMON_EXIT, 1))
+            stdout.sock_file.write(b'1' if ERROR else b'0')
+        except BrokenPipeError:
+            # The client went away without waiting for the exit status.
+            pass
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """Listens on a unix socket for commands from rshell clients. Requests
+       are handled one at a time, since they share the connected boards.
+    """
+
+    def __init__(self, socket_path, stdout, stderr, timing=False):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timing = timing
+        socketserver.UnixStreamServer.__init__(self, socket_path, DaemonRequestHandler)
+
+
+def daemon_is_running(socket_path):
+    """Determines if an rshell daemon is listening on socket_path."""
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def run_daemon(socket_path, timing=False):
+    """Keeps the boards which are currently connected open, and services
+       commands forwarded by other rshell invocations until interrupted.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        print_err('rshell --daemon requires unix domain sockets')
+        return
+    if daemon_is_running(socket_path):
+        print_err("An rshell daemon is already listening on '{}'".format(socket_path))
+        return
+    if os.path.exists(socket_path):
+        # Left over from a daemon which didn't exit cleanly.
+        os.remove(socket_path)
+    save_stdout, save_stderr = sys.stdout, sys.stderr
+    sys.stdout = ThreadOutput(save_stdout)
+    sys.stderr = ThreadOutput(save_stderr)
+    server = DaemonServer(socket_path, sys.stdout, sys.stderr, timing=timing)
+    try:
+        os.chmod(socket_path, 0o600)
+        QUIET or print("rshell daemon listening on '{}'. Use Control-C to exit.".format(socket_path))
+        # There's no prompt to keep notifications away from, so they can be
+        # printed as they happen.
+        notify_prompt('')
+        server.serve_forever()
+    except KeyboardInterrupt:
+        QUIET or print('')
+    finally:
+        notify_prompt(None)
+        server.server_close()
+        os.remove(socket_path)
+        sys.stdout, sys.stderr = save_stdout, save_stderr
+
+
+def forward_to_daemon(socket_path, cmd_line, script=None, filename=None, options=None):
+    """Sends a command line (or the contents of a command file) to a running
+       rshell daemon and copies the output to our stdout and stderr. options
+       are applied by the daemon while it runs the command (see
+       daemon_options).
+
+       Returns the exit status of the command, or None if no daemon is
+       listening on socket_path.
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    request = {'cwd': os.getcwd(), 'cmd': cmd_line, 'options': options or {}}
+    if script is not None:
+        request['script'] = script
+        request['filename'] = filename
+    header_size = struct.calcsize(DAEMON_FRAME)
+    with sock, sock.makefile('rwb') as sock_file:
+        sock_file.write(bytes(json.dumps(request), encoding='utf-8') + b'\n')
+        sock_file.flush()
+        while True:
+            header = sock_file.read(header_size)
+            if len(header) < header_size:
+                print_err('rshell daemon closed the connection')
+                return 1
+            stream, length = struct.unpack(DAEMON_FRAME, header)
+            data = sock_file.read(length)
+            if stream == DAEMON_EXIT:
+                return int(data)
+            out = sys.stdout if stream == DAEMON_STDOUT else sys.stderr
+            out.buffer.write(data)
+            out.flush()
+
+
+def sync_policy(value):
+    """Converts the value of the --sync option into SYNC_BYTES."""
+    if value == 'file':
+        return 0
+    if value == 'chunk':
+        return -1
+    try:
+        kbytes = int(value)
+    except ValueError:
+        kbytes = 0
+    if kbytes <= 0:
+        raise argparse.ArgumentTypeError(
+            "expecting file, chunk or a number of KB, found '{}'".format(value))
+    return kbytes * 1024
 
 
 def real_main():
     """The main program."""
     global RTS
     global DTR
+    global WRITE_BUF_SIZE
+    global SYNC_BYTES
+    global XFER_CHUNK_TIMEOUT
+    global XFER_RETRIES
     try:
         default_baud = int(os.getenv('RSHELL_BAUD'))
     except:
@@ -2965,6 +6523,8 @@ def real_main():
     default_user = os.getenv('RSHELL_USER') or 'micro'
     default_password = os.getenv('RSHELL_PASSWORD') or 'python'
     default_editor = os.getenv('RSHELL_EDITOR') or os.getenv('VISUAL') or os.getenv('EDITOR') or 'vi'
+    default_socket = os.getenv('RSHELL_SOCKET') or os.path.expanduser('~/.rshell.sock')
+    default_mpy_cross = os.getenv('RSHELL_MPY_CROSS') or 'mpy-cross'
     default_color = sys.stdout.isatty()
     default_nocolor = not default_color
     global BUFFER_SIZE
@@ -3087,6 +6647,40 @@ def real_main():
         help='Reports the version and exits.',
         default=False
     )
+    parser.add_argument(
+        "--mpy-cross",
+        dest="mpy_cross",
+        help="Set the mpy-cross compiler used by cp --mpy and rsync --mpy (default '%s')" %
+             default_mpy_cross,
+        default=default_mpy_cross
+    )
+    parser.add_argument(
+        "--trace-json",
+        dest="trace_json",
+        help="Write a Chrome trace of the remote calls made to this file",
+        default=None
+    )
+    parser.add_argument(
+        "--daemon",
+        dest="daemon",
+        action="store_true",
+        help="Keep the boards connected and run commands sent by other "
+             "rshell invocations",
+        default=False
+    )
+    parser.add_argument(
+        "--no-daemon",
+        dest="no_daemon",
+        action="store_true",
+        help="Don't send the command to a running rshell daemon",
+        default=False
+    )
+    parser.add_argument(
+        "--socket",
+        dest="socket",
+        help="Set the socket used to talk to the rshell daemon (default '%s')" % default_socket,
+        default=default_socket
+    )
     parser.add_argument(
         "--quiet",
         dest="quiet",
@@ -3094,6 +6688,54 @@ def real_main():
         help="Turns off some output (useful for testing)",
         default=False
     )
+    parser.add_argument(
+        "--write-buffer-size",
+        dest="write_buf_size",
+        action="store",
+        type=int,
+        help="Set the size of the buffer which the board collects received "
+             "data into before writing it to a file (default = based on the "
+             "board's free memory)",
+        default=WRITE_BUF_SIZE
+    )
+    parser.add_argument(
+        "--sync",
+        dest="sync_bytes",
+        action="store",
+        type=sync_policy,
+        metavar="POLICY",
+        help="Set how often the board syncs its filesystem while receiving a file: "
+             "file (default), chunk, or a number of KB",
+        default=SYNC_BYTES
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="xfer_timeout",
+        action="store",
+        type=float,
+        metavar="SECONDS",
+        help="Set how long to wait for each chunk of a file transfer before giving "
+             "up on the board (default = %d)" % XFER_CHUNK_TIMEOUT,
+        default=XFER_CHUNK_TIMEOUT
+    )
+    parser.add_argument(
+        "--retries",
+        dest="xfer_retries",
+        action="store",
+        type=int,
+        help="Set how many times a file transfer which timed out is retried "
+             "(default = %d)" % XFER_RETRIES,
+        default=XFER_RETRIES
+    )
+    parser.add_argument(
+        "--progress",
+        dest="progress",
+        action="store",
+        choices=["bar", "json", "none"],
+        help="Set how the progress of file transfers is shown on stderr (default = "
+             "bar if stderr is a terminal, otherwise none)",
+        default=None
+    )
     parser.add_argument(
         "cmd",
         nargs=argparse.REMAINDER,
@@ -3103,6 +6745,10 @@ def real_main():
 
     if args.buffer_size is not None:
         BUFFER_SIZE = args.buffer_size
+    WRITE_BUF_SIZE = args.write_buf_size
+    SYNC_BYTES = args.sync_bytes
+    XFER_CHUNK_TIMEOUT = args.xfer_timeout
+    XFER_RETRIES = args.xfer_retries
 
     if args.debug:
         print("Debug = %s" % args.debug)
@@ -3116,7 +6762,14 @@ def real_main():
         print("ascii = %d" % args.ascii_xfer)
         print("Timing = %d" % args.timing)
         print("Quiet = %d" % args.quiet)
+        print("Daemon = %d" % args.daemon)
+        print("Socket = %s" % args.socket)
         print("BUFFER_SIZE = %d" % BUFFER_SIZE)
+        print("WRITE_BUF_SIZE = %s" % WRITE_BUF_SIZE)
+        print("SYNC_BYTES = %d" % SYNC_BYTES)
+        print("XFER_CHUNK_TIMEOUT = %g" % XFER_CHUNK_TIMEOUT)
+        print("XFER_RETRIES = %d" % XFER_RETRIES)
+        print("Progress = %s" % args.progress)
         print("Cmd = [%s]" % ', '.join(args.cmd))
 
     if args.version:
@@ -3132,6 +6785,11 @@ def real_main():
     global EDITOR
     EDITOR = args.editor
 
+    if args.progress is None:
+        PROGRESS.mode = 'bar' if sys.stderr.isatty() else None
+    elif args.progress != 'none':
+        PROGRESS.mode = args.progress
+
     if args.nocolor:
         global DIR_COLOR, PROMPT_COLOR, PY_COLOR, END_COLOR
         DIR_COLOR = ''
@@ -3146,6 +6804,8 @@ def real_main():
 
     global ASCII_XFER
     ASCII_XFER = args.ascii_xfer
+    global MPY_CROSS
+    MPY_CROSS = args.mpy_cross
     RTS = args.rts
     DTR = args.dtr
 
@@ -3153,6 +6813,30 @@ def real_main():
         listports()
         return
 
+    if not args.daemon and not args.no_daemon and args.port == parser.get_default('port'):
+        # If an rshell daemon is running, then it already has the boards
+        # connected, so we let it run the command (unless we've been asked
+        # to connect to a particular board ourselves).
+        options = {dest: getattr(args, dest) for dest in DAEMON_OPTIONS
+                   if getattr(args, dest) != parser.get_default(dest)}
+        # The progress is shown on our stderr, not the daemon's.
+        options['progress'] = PROGRESS.mode
+        script = None
+        if args.filename:
+            with open(args.filename) as cmd_file:
+                script = cmd_file.read()
+        cmd_line = ' '.join(args.cmd)
+        if script is not None or cmd_line:
+            status = forward_to_daemon(args.socket, cmd_line, script, args.filename, options)
+            if status is not None:
+                global ERROR
+                ERROR = status != 0
+                return
+
+    if args.trace_json:
+        STATS.tracing = True
+        atexit.register(STATS.write_trace, args.trace_json)
+
     if args.port:
         ASCII_XFER = True
         if args.buffer_size is None:
@@ -3169,10 +6853,14 @@ def real_main():
         autoscan()
     autoconnect()
 
+    if args.daemon:
+        run_daemon(args.socket, timing=args.timing)
+        return
+
     if args.filename:
         with open(args.filename) as cmd_file:
             shell = Shell(stdin=cmd_file, filename=args.filename, timing=args.timing)
-            shell.cmdloop('')
+            shell.run_script()
     else:
         cmd_line = ' '.join(args.cmd)
         if cmd_line == '':
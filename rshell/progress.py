@@ -0,0 +1,267 @@
+"""Reports the progress of file transfers, showing the number of bytes
+   transferred, the throughput and an estimate of the time remaining, both
+   for the current file and for the command as a whole.
+
+   Progress is either rendered as a single line bar (which is redrawn in
+   place), or written as JSON lines so that it can be parsed by other
+   programs. The transfer loops call update for every chunk, so update only
+   does some arithmetic unless it's time to render again.
+"""
+
+import contextlib
+import json
+import shutil
+import sys
+import time
+
+# Minimum time, in seconds, between renders of the progress bar or JSON lines
+RENDER_INTERVAL = 0.25
+# Width of the bar itself, when the terminal is wide enough to have one
+BAR_WIDTH = 20
+
+
+def format_eta(seconds):
+    """Formats a number of seconds as H:MM:SS or M:SS."""
+    if seconds is None:
+        return '--:--'
+    seconds = int(seconds + 0.5)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+    return '%d:%02d' % (minutes, seconds)
+
+
+def format_size(num_bytes):
+    """Formats a number of bytes using K or M when it's large."""
+    if num_bytes >= 1024 * 1024:
+        return '%.1fM' % (num_bytes / (1024.0 * 1024.0))
+    if num_bytes >= 1024:
+        return '%.1fK' % (num_bytes / 1024.0)
+    return '%d' % num_bytes
+
+
+class Counter(object):
+    """Keeps track of the bytes transferred for a file or a whole command."""
+
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.start_time = time.monotonic()
+
+    def rate(self, now):
+        """Returns the throughput in bytes per second."""
+        elapsed = now - self.start_time
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self, now):
+        """Returns the estimated number of seconds remaining, or None if it
+           can't be estimated.
+        """
+        rate = self.rate(now)
+        if not self.total or not rate:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def percent(self):
+        if not self.total:
+            return 100 if self.total == 0 else None
+        return min(self.done * 100 // self.total, 100)
+
+    def as_dict(self, now):
+        eta = self.eta(now)
+        return {
+            'name': self.name,
+            'bytes': self.done,
+            'total': self.total,
+            'kb_s': round(self.rate(now) / 1024.0, 2),
+            'eta_s': None if eta is None else round(eta, 1),
+        }
+
+
+class Progress(object):
+    """Renders the progress of the transfers made by a command.
+
+       mode is None (no progress is shown), 'bar' or 'json'. A job covers a
+       whole command, and is made up of a number of files. Files which are
+       transferred outside of a job are treated as a job of their own.
+    """
+
+    def __init__(self):
+        self.mode = None
+        self.job_counter = None
+        self.file_counter = None
+        self.implicit_job = False
+        self.files_done = 0
+        self.total_files = None
+        self.next_render = 0
+        self.bar_width = 0
+        self.suspend_count = 0
+
+    @property
+    def stream(self):
+        # Looked up each time, so that the daemon can send the output to the
+        # client which is running the command (see ThreadOutput)
+        return sys.stderr
+
+    @contextlib.contextmanager
+    def job(self, total_bytes=None, total_files=None):
+        """Context manager which wraps all of the transfers for a command.
+           total_bytes may be None if it isn't known up front, in which case
+           it can be filled in later using expect.
+        """
+        self.start_job(total_bytes, total_files)
+        try:
+            yield
+        finally:
+            self.end_job()
+
+    def start_job(self, total_bytes=None, total_files=None):
+        self.end_job()
+        self.job_counter = Counter('', total_bytes)
+        self.implicit_job = False
+        self.files_done = 0
+        self.total_files = total_files
+        self.next_render = 0
+
+    def end_job(self):
+        if self.job_counter is None:
+            return
+        self.end_file()
+        if self.mode == 'json':
+            self.write_json('done')
+        self.clear_bar()
+        self.job_counter = None
+
+    def expect(self, num_bytes, num_files=0):
+        """Adds to the number of bytes (and files) which the current job
+           expects to transfer.
+        """
+        if self.job_counter is None:
+            return
+        self.job_counter.total = (self.job_counter.total or 0) + num_bytes
+        if num_files:
+            self.total_files = (self.total_files or 0) + num_files
+
+    @contextlib.contextmanager
+    def file(self, name, size):
+        """Context manager which wraps the transfer of a single file."""
+        self.start_file(name, size)
+        try:
+            yield
+        finally:
+            self.end_file()
+
+    def start_file(self, name, size):
+        """Starts reporting on a new file, ending the current one (if any)."""
+        if self.file_counter is not None:
+            self.end_file()
+        if self.job_counter is None:
+            self.start_job(size, 1)
+            self.implicit_job = True
+        elif self.job_counter.done == 0:
+            # Don't count the time spent working out what to transfer
+            self.job_counter.start_time = time.monotonic()
+        self.file_counter = Counter(name, size)
+        if self.mode == 'json':
+            self.write_json('start')
+            self.next_render = time.monotonic() + RENDER_INTERVAL
+        else:
+            self.render(time.monotonic())
+
+    def end_file(self):
+        if self.file_counter is None:
+            return
+        self.files_done += 1
+        if self.mode == 'json':
+            self.write_json('end')
+        self.file_counter = None
+        if self.implicit_job:
+            self.end_job()
+
+    def update(self, num_bytes):
+        """Called by the transfer loops for each chunk which is sent or received."""
+        if self.file_counter is None:
+            return
+        self.file_counter.done += num_bytes
+        self.job_counter.done += num_bytes
+        if self.mode is None:
+            return
+        now = time.monotonic()
+        if now >= self.next_render:
+            self.render(now)
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """Stops anything from being rendered, for commands (like cat) whose
+           output would get mixed up with the progress bar.
+        """
+        self.suspend_count += 1
+        try:
+            yield
+        finally:
+            self.suspend_count -= 1
+
+    def render(self, now):
+        self.next_render = now + RENDER_INTERVAL
+        if self.suspend_count or self.file_counter is None:
+            return
+        if self.mode == 'json':
+            self.write_json('progress', now)
+        elif self.mode == 'bar':
+            self.write_bar(now)
+
+    def write_json(self, event, now=None):
+        if self.suspend_count:
+            return
+        if now is None:
+            now = time.monotonic()
+        record = {'event': event}
+        if self.file_counter is not None:
+            record['file'] = self.file_counter.as_dict(now)
+        record['overall'] = self.job_counter.as_dict(now)
+        record['overall']['files'] = self.files_done
+        record['overall']['total_files'] = self.total_files
+        del record['overall']['name']
+        self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+
+    def write_bar(self, now):
+        file_counter = self.file_counter
+        job_counter = self.job_counter
+        percent = file_counter.percent()
+        stats = ' {:>3}% {}/s ETA {}'.format(
+            '?' if percent is None else percent,
+            format_size(file_counter.rate(now)),
+            format_eta(file_counter.eta(now)))
+        if not self.implicit_job:
+            percent = job_counter.percent()
+            files = '' if self.total_files is None else ' {}/{}'.format(self.files_done + 1,
+                                                                       self.total_files)
+            stats += ' | total{} {} ETA {}'.format(
+                files,
+                format_size(job_counter.done) if percent is None else '{}%'.format(percent),
+                format_eta(job_counter.eta(now)))
+        columns = shutil.get_terminal_size().columns - 1
+        bar = ''
+        if columns - len(stats) - BAR_WIDTH - 3 >= 10:
+            filled = BAR_WIDTH * (file_counter.percent() or 0) // 100
+            bar = ' [' + '#' * filled + '.' * (BAR_WIDTH - filled) + ']'
+        name = file_counter.name
+        name_width = columns - len(stats) - len(bar)
+        if len(name) > name_width:
+            name = '...' + name[-(name_width - 3):] if name_width > 3 else ''
+        line = (name + bar + stats)[:columns]
+        self.stream.write('\r' + line.ljust(self.bar_width) + '\r')
+        self.stream.flush()
+        self.bar_width = len(line)
+
+    def clear_bar(self):
+        if self.bar_width and not self.suspend_count:
+            self.stream.write('\r' + ' ' * self.bar_width + '\r')
+            self.stream.flush()
+        self.bar_width = 0
+
+
+PROGRESS = Progress()
@@ -104,7 +104,8 @@ class TelnetToSerial:
         return data
 
     def write(self, data):
-        self.tn.write(data)
+        # telnetlib needs bytes rather than a memoryview
+        self.tn.write(bytes(data))
         return len(data)
 
     def inWaiting(self):
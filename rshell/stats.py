@@ -0,0 +1,98 @@
+"""Collects timing information and byte counts for the remote calls which
+   rshell makes, so that slow commands can be broken down into their phases.
+
+   The phases can also be recorded as a timeline in the Chrome trace event
+   format (load the file using chrome://tracing or https://ui.perfetto.dev).
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Stats(object):
+    """Accumulates counters and per-phase timings."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tracing = False
+        self.reset()
+
+    def reset(self):
+        """Clears all of the accumulated counters and timings."""
+        with self.lock:
+            self.counters = {}
+            self.phases = {}
+            self.events = []
+            self.start_time = time.perf_counter()
+
+    def add(self, name, value=1):
+        """Adds value to the counter called name."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        """Accumulates time spent in a phase without recording a trace event.
+           Used for things which happen for every chunk of a transfer.
+        """
+        with self.lock:
+            count, total, longest = self.phases.get(name, (0, 0.0, 0.0))
+            self.phases[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextlib.contextmanager
+    def phase(self, name, **args):
+        """Context manager which times the code which it wraps."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.add_time(name, end - start)
+            if self.tracing:
+                event = {
+                    'name': name,
+                    'cat': 'rshell',
+                    'ph': 'X',
+                    'ts': (start - self.start_time) * 1e6,
+                    'dur': (end - start) * 1e6,
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                }
+                if args:
+                    event['args'] = args
+                with self.lock:
+                    self.events.append(event)
+
+    def phase_rows(self):
+        """Returns (name, count, total_ms, avg_ms, max_ms) for each phase."""
+        with self.lock:
+            return [(name, count, total * 1000, total * 1000 / count, longest * 1000)
+                    for name, (count, total, longest) in sorted(self.phases.items())]
+
+    def counter_rows(self):
+        """Returns (name, value) for each counter."""
+        with self.lock:
+            return sorted(self.counters.items())
+
+    def num_events(self):
+        """Returns the number of trace events recorded so far."""
+        with self.lock:
+            return len(self.events)
+
+    def write_trace(self, filename, first_event=0):
+        """Writes the recorded phases as a Chrome trace event file, starting
+           from the event numbered first_event (see num_events).
+        """
+        with self.lock:
+            trace = {
+                'traceEvents': self.events[first_event:],
+                'displayTimeUnit': 'ms',
+                'otherData': dict(self.counters),
+            }
+        with open(filename, 'w') as trace_file:
+            json.dump(trace, trace_file)
+
+
+STATS = Stats()
@@ -0,0 +1,229 @@
+"""Watches a directory tree on the host for changes, for rsync --watch.
+
+   On Linux, inotify is used directly (through ctypes), so nothing needs to
+   be installed. Elsewhere, watchdog is used if it's installed, and
+   otherwise the tree is scanned periodically. Whichever is used, changes
+   are reported as paths relative to the root of the tree, with '' meaning
+   that the whole tree needs to be looked at again.
+"""
+
+import abc
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import sys
+import time
+
+# inotify event bits, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# How often PollingWatcher scans the tree, in seconds
+POLL_INTERVAL = 1.0
+
+
+class Watcher(abc.ABC):
+    """Base class for the watchers. Subclasses implement poll."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def relpath(self, path):
+        relpath = os.path.relpath(path, self.root)
+        return '' if relpath == '.' else relpath
+
+    @abc.abstractmethod
+    def poll(self, timeout):
+        """Waits for up to timeout seconds (forever if timeout is None) for
+           something to change, and returns a set containing the paths
+           which changed, which is empty if nothing did.
+        """
+
+    def wait_for_changes(self, debounce):
+        """Waits for something to change, and then carries on collecting
+           changes until nothing has changed for debounce seconds, so that
+           saving a bunch of files (or an editor writing a file in several
+           steps) is treated as a single change. Returns the set of paths
+           which changed.
+        """
+        changed = set()
+        while not changed:
+            changed = self.poll(None)
+        while True:
+            more = self.poll(debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    """Watches a tree using the Linux inotify API. Each directory needs a
+       watch of its own, so watches are added for directories as they're
+       created.
+    """
+
+    def __init__(self, root):
+        Watcher.__init__(self, root)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.epoll = select.epoll()
+        self.epoll.register(self.fd, select.POLLIN)
+        self.dirs = {}     # Maps watch descriptors to directories
+        self.add_tree(root)
+
+    def add_tree(self, dirname):
+        for subdir, _, _ in os.walk(dirname):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(subdir), INOTIFY_MASK)
+            if wd >= 0:
+                self.dirs[wd] = subdir
+
+    def poll(self, timeout):
+        changed = set()
+        try:
+            events = self.epoll.poll(-1 if timeout is None else timeout)
+        except InterruptedError:
+            return changed
+        if not events:
+            return changed
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so everything needs to be checked
+                changed.add('')
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            dirname = self.dirs.get(wd)
+            if dirname is None:
+                continue
+            path = os.path.join(dirname, name) if name else dirname
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            if not mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.add(self.relpath(path))
+        return changed
+
+    def close(self):
+        self.epoll.close()
+        os.close(self.fd)
+
+
+class WatchdogWatcher(Watcher):
+    """Watches a tree using watchdog, which supports macOS and Windows."""
+
+    def __init__(self, root):
+        import watchdog.events
+        import watchdog.observers
+        Watcher.__init__(self, root)
+        self.queue = queue.Queue()
+        watcher = self
+
+        class Handler(watchdog.events.FileSystemEventHandler):
+            def on_any_event(self, event):
+                watcher.queue.put(event.src_path)
+                dest_path = getattr(event, 'dest_path', None)
+                if dest_path:
+                    watcher.queue.put(dest_path)
+
+        self.observer = watchdog.observers.Observer()
+        self.observer.schedule(Handler(), root, recursive=True)
+        self.observer.start()
+
+    def poll(self, timeout):
+        changed = set()
+        try:
+            path = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return changed
+        while True:
+            changed.add(self.relpath(os.fsdecode(path)))
+            try:
+                path = self.queue.get_nowait()
+            except queue.Empty:
+                return changed
+
+    def close(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+class PollingWatcher(Watcher):
+    """Watches a tree by scanning it every POLL_INTERVAL seconds and
+       comparing the size and mtime of everything in it.
+    """
+
+    def __init__(self, root):
+        Watcher.__init__(self, root)
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for dirname, subdirs, filenames in os.walk(self.root):
+            for name in subdirs + filenames:
+                path = os.path.join(dirname, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[self.relpath(path)] = (stat.st_mode, stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = POLL_INTERVAL
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+            if delay > 0:
+                time.sleep(delay)
+            snapshot = self.scan()
+            changed = set(path for path in snapshot.keys() | self.snapshot.keys()
+                          if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+
+def create_watcher(root):
+    """Returns the best watcher available for watching root."""
+    if sys.platform.startswith('linux') and hasattr(select, 'epoll'):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError):
+            pass
+    try:
+        return WatchdogWatcher(root)
+    except ImportError:
+        pass
+    return PollingWatcher(root)
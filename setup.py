@@ -54,6 +54,8 @@ setup(
     },
     extras_require={
         ':sys_platform == "win32"': [
-            'pyreadline']
+            'pyreadline'],
+        'watch': [
+            'watchdog']
     }
 )
@@ -0,0 +1,69 @@
+"""Fixtures for the tests which run rshell against a simulated board
+   (see benchmarks/simboard.py), so they don't need any hardware.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rshell.main as rshell
+from benchmarks.simboard import SimBoard
+
+
+@pytest.fixture
+def board(monkeypatch, tmp_path):
+    """Starts a simulated board and connects rshell to it. The settings
+       which the tests change are put back afterwards.
+    """
+    monkeypatch.setattr(rshell, 'QUIET', True)
+    # These are only set by main
+    monkeypatch.setattr(rshell, 'ASCII_XFER', False, raising=False)
+    monkeypatch.setattr(rshell, 'EDITOR', 'true', raising=False)
+    monkeypatch.setattr(rshell, 'BUFFER_SIZE', rshell.BUFFER_SIZE)
+    monkeypatch.setattr(rshell, 'XFER_CHUNK_TIMEOUT', rshell.XFER_CHUNK_TIMEOUT)
+    monkeypatch.setattr(rshell, 'XFER_RETRIES', rshell.XFER_RETRIES)
+    monkeypatch.setattr(rshell, 'EDIT_CACHE_DIR', str(tmp_path / 'edit-cache'))
+    monkeypatch.setattr(rshell, 'cur_dir', str(tmp_path))
+    for name in ('DIR_COLOR', 'PROMPT_COLOR', 'PY_COLOR', 'END_COLOR'):
+        monkeypatch.setattr(rshell, name, '')
+    monkeypatch.setattr(rshell.PROGRESS, 'mode', None)
+    rshell.STATS.reset()
+    sim = SimBoard().start()
+    try:
+        assert rshell.connect_serial(sim.port)
+        yield sim
+    finally:
+        with rshell.DEV_LOCK:
+            for dev in rshell.DEVS:
+                dev.close()
+            del rshell.DEVS[:]
+            rshell.DEFAULT_DEV = None
+        sim.stop()
+
+
+@pytest.fixture
+def dev(board):
+    """The rshell Device for the simulated board."""
+    return rshell.DEFAULT_DEV
+
+
+@pytest.fixture
+def shell(board):
+    """Returns a function which runs a command line in a new Shell."""
+    def run(line):
+        rshell.Shell().cmdloop(line)
+    return run
+
+
+def write_file(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as out_file:
+        out_file.write(data)
+
+
+def read_file(filename):
+    with open(filename, 'rb') as in_file:
+        return in_file.read()
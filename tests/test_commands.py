@@ -0,0 +1,175 @@
+"""Tests for the shell commands, run against a simulated board."""
+
+import os
+
+import pytest
+
+import rshell.main as rshell
+from conftest import read_file, write_file
+
+
+@pytest.fixture
+def tree(board):
+    """Creates a small tree of files under /flash/t on the board."""
+    for name, size in [('a.py', 10), ('b.txt', 2000), ('sub/c.py', 300), ('sub/deep/d.py', 5)]:
+        write_file(board.host_path('/flash/t/' + name), b'x' * size)
+    return '/flash/t'
+
+
+def test_ls_recursive(tree, shell, capsys):
+    shell('ls -R ' + tree)
+    assert capsys.readouterr().out.split('\n') == [
+        '/flash/t:',
+        'a.py  b.txt sub/ ',
+        '',
+        '/flash/t/sub:',
+        'c.py  deep/',
+        '',
+        '/flash/t/sub/deep:',
+        'd.py',
+        '',
+    ]
+
+
+def test_ls_unsorted_long(tree, shell, capsys):
+    shell('ls -U -l ' + tree)
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(line.split()[-1] for line in lines) == ['a.py', 'b.txt', 'sub/']
+
+
+def test_ls_pattern_is_matched_on_the_board(tree, shell, capsys):
+    records = []
+    rshell.auto_stream(rshell.list_files, [(tree, '*.py')], records.append, False, False, True)
+    # The stat of the directory, the matching file and the end of the listing.
+    # The subdirectories aren't walked, even though recursive is True.
+    assert len(records) == 3
+    assert records[1][0] == 'a.py'
+    assert records[2] is None
+    shell('ls -R {}/*.py'.format(tree))
+    assert capsys.readouterr().out == 'a.py\n'
+
+
+def test_du(tree, shell, capsys):
+    shell('du ' + tree)
+    assert capsys.readouterr().out.splitlines() == [
+        '5\t/flash/t/sub/deep',
+        '305\t/flash/t/sub',
+        '2315\t/flash/t',
+    ]
+    shell('du -s ' + tree)
+    assert capsys.readouterr().out.splitlines() == ['2315\t/flash/t']
+
+
+def test_find(tree, shell, capsys):
+    shell('find {} -name *.py'.format(tree))
+    assert capsys.readouterr().out.splitlines() == [
+        '/flash/t/a.py',
+        '/flash/t/sub/c.py',
+        '/flash/t/sub/deep/d.py',
+    ]
+    shell('find {} -type d'.format(tree))
+    assert capsys.readouterr().out.splitlines() == [
+        '/flash/t',
+        '/flash/t/sub',
+        '/flash/t/sub/deep',
+    ]
+    shell('find /flash/nothere')
+    assert 'No such file or directory' in capsys.readouterr().err
+
+
+def run_script(script, tmp_path):
+    filename = str(tmp_path / 'script.rsh')
+    with open(filename, 'w') as script_file:
+        script_file.write(script)
+    with open(filename) as script_file:
+        rshell.Shell(stdin=script_file, filename=filename).run_script()
+
+
+def test_script_batches_mkdir_and_rm(board, monkeypatch, tmp_path):
+    batches = []
+    real_run_batch_fs_ops = rshell.Shell.run_batch_fs_ops
+
+    def run_batch_fs_ops(self, dev, ops):
+        batches.append([op[1] for _, op, _ in ops])
+        return real_run_batch_fs_ops(self, dev, ops)
+
+    monkeypatch.setattr(rshell.Shell, 'run_batch_fs_ops', run_batch_fs_ops)
+    run_script('mkdir /flash/s\n'
+               'mkdir /flash/s/a /flash/s/b\n'
+               'rm --recursive -f /flash/s/a\n', tmp_path)
+    assert batches == [['mkdir', 'mkdir', 'mkdir', 'rm']]
+    assert os.listdir(board.host_path('/flash/s')) == ['b']
+
+
+def test_script_batch_attempts_every_op(board, tmp_path, capsys):
+    run_script('mkdir /flash/s\n'
+               'rm /flash/s/nothere\n'
+               'mkdir /flash/s/after\n', tmp_path)
+    assert os.path.isdir(board.host_path('/flash/s/after'))
+    err = capsys.readouterr().err
+    assert "Unable to remove '/flash/s/nothere'" in err
+    assert 'errors on line(s) 2' in err
+
+
+def test_script_rm_options_use_rm_parser(board, tmp_path, capsys):
+    run_script('mkdir /flash/s\n'
+               'rm --bogus /flash/s\n', tmp_path)
+    assert 'unrecognized arguments: --bogus' in capsys.readouterr().err
+    assert os.path.isdir(board.host_path('/flash/s'))
+
+
+def test_redirect_to_board(board, shell):
+    write_file(board.host_path('/flash/a.py'), b'')
+    # ls uses the board, so its output is collected and copied at the end
+    shell('ls /flash > /flash/listing')
+    assert read_file(board.host_path('/flash/listing')) == b'a.py\n'
+    # echo doesn't, so its output is streamed
+    shell('echo hello >> /flash/listing')
+    assert read_file(board.host_path('/flash/listing')) == b'a.py\nhello\n'
+
+
+def test_fallback_redirect_failure_is_reported(board, shell, capsys):
+    """Output which can't be streamed is collected on the host and written
+       at the end of the command. If that fails, the shell carries on.
+    """
+    os.mkdir(board.host_path('/flash/adir'))
+    shell('ls /flash > /flash/adir')
+    assert 'during transfer' in capsys.readouterr().err
+    shell('ls /flash')
+    assert capsys.readouterr().out == 'adir/\n'
+
+
+def edit_hits():
+    return dict(rshell.STATS.counter_rows()).get('edit_cache_hits', 0)
+
+
+def test_edit_cache(board, shell):
+    filename = board.host_path('/flash/e.py')
+    write_file(filename, b'x = 1\n')
+    shell('edit /flash/e.py')
+    shell('edit /flash/e.py')
+    assert edit_hits() == 1
+    # Rewrite the file without changing its size or mtime, like a board
+    # without an RTC would. The sha256 no longer matches, so the copy is
+    # downloaded again.
+    stat = os.stat(filename)
+    write_file(filename, b'x = 2\n')
+    os.utime(filename, (stat.st_atime, stat.st_mtime))
+    shell('edit /flash/e.py')
+    assert edit_hits() == 1
+    local_filename, _ = rshell.edit_cache_filenames(rshell.DEFAULT_DEV, '/flash/e.py')
+    assert read_file(local_filename) == b'x = 2\n'
+
+
+def test_edit_uploads_changes(board, shell, monkeypatch, tmp_path):
+    editor = tmp_path / 'editor.sh'
+    editor.write_text('#!/bin/sh\necho "y = 3" >> "$1"\n')
+    editor.chmod(0o755)
+    monkeypatch.setattr(rshell, 'EDITOR', str(editor))
+    write_file(board.host_path('/flash/e.py'), b'x = 1\n')
+    shell('edit /flash/e.py')
+    assert read_file(board.host_path('/flash/e.py')) == b'x = 1\ny = 3\n'
+    # The copy which was uploaded is used the next time
+    monkeypatch.setattr(rshell, 'EDITOR', 'true')
+    shell('edit /flash/e.py')
+    assert edit_hits() == 1
@@ -0,0 +1,119 @@
+"""Tests for forwarding commands to an rshell daemon (see run_daemon)."""
+
+import io
+import os
+import sys
+import threading
+
+import pytest
+
+import rshell.main as rshell
+from conftest import write_file
+
+
+def text_stream():
+    return io.TextIOWrapper(io.BytesIO(), encoding='utf-8', write_through=True)
+
+
+def contents(stream):
+    return str(stream.buffer.getvalue(), encoding='utf-8')
+
+
+@pytest.fixture
+def daemon_output():
+    """The daemon's sys.stdout and sys.stderr (see run_daemon)."""
+    return rshell.ThreadOutput(text_stream()), rshell.ThreadOutput(text_stream())
+
+
+@pytest.fixture
+def daemon(board, daemon_output, monkeypatch, tmp_path):
+    """Runs a daemon in a thread and returns a function which forwards a
+       command line to it. The function returns the exit status along with
+       what the client got on stdout and stderr.
+    """
+    stdout, stderr = daemon_output
+    socket_path = str(tmp_path / 'daemon.sock')
+    server = rshell.DaemonServer(socket_path, stdout, stderr)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    def forward(line, **kwargs):
+        # pytest puts its own sys.stdout back before running the test, so
+        # this can't be done when the daemon is started.
+        monkeypatch.setattr(sys, 'stdout', stdout)
+        monkeypatch.setattr(sys, 'stderr', stderr)
+        out = text_stream()
+        err = text_stream()
+        with stdout.redirect(out), stderr.redirect(err):
+            status = rshell.forward_to_daemon(socket_path, line, **kwargs)
+        return status, contents(out), contents(err)
+
+    try:
+        yield forward
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_forward_command(board, daemon):
+    write_file(board.host_path('/flash/a.py'), b'')
+    assert daemon('ls /flash') == (0, 'a.py\n', '')
+    status, out, err = daemon('ls /flash/nothere')
+    assert status == 1
+    assert 'No such file or directory' in err
+
+
+def test_forward_script(board, daemon):
+    status, out, err = daemon('', script='mkdir /flash/s\necho done\n', filename='script')
+    assert (status, out, err) == (0, 'done\n', '')
+    assert os.path.isdir(board.host_path('/flash/s'))
+
+
+def test_no_daemon(tmp_path):
+    assert rshell.forward_to_daemon(str(tmp_path / 'nothere.sock'), 'ls') is None
+
+
+def spy_on_echo(monkeypatch, func):
+    """Calls func while the daemon is running an echo command."""
+    real_do_echo = rshell.DaemonShell.do_echo
+
+    def do_echo(self, line):
+        func()
+        return real_do_echo(self, line)
+
+    monkeypatch.setattr(rshell.DaemonShell, 'do_echo', do_echo)
+
+
+def test_options_only_apply_to_the_command(dev, daemon, monkeypatch):
+    buffer_size = rshell.BUFFER_SIZE
+    seen = []
+    spy_on_echo(monkeypatch, lambda: seen.append((rshell.BUFFER_SIZE, dev.has_buffer)))
+    assert daemon('echo hi', options={'buffer_size': 64, 'ascii_xfer': True}) == \
+        (0, 'hi\n', '')
+    assert seen == [(64, False)]
+    assert rshell.BUFFER_SIZE == buffer_size
+    assert dev.has_buffer
+
+
+def test_interactive_commands_are_refused(daemon):
+    for line in ('cat -', 'edit /flash/a.py', 'repl'):
+        status, out, err = daemon(line)
+        assert status == 1
+        assert "isn't available through the rshell daemon" in err
+
+
+def test_notifications_stay_out_of_client_output(daemon, daemon_output, monkeypatch):
+    """Output from other threads, like the one which connects boards as
+       they're plugged in, goes to the daemon's own stdout.
+    """
+    monkeypatch.setattr(rshell, 'NOTIFY_PROMPT', '')
+
+    def notify():
+        thread = threading.Thread(target=rshell.notify, args=('board plugged in',))
+        thread.start()
+        thread.join()
+
+    spy_on_echo(monkeypatch, notify)
+    assert daemon('echo hi') == (0, 'hi\n', '')
+    assert 'board plugged in' in contents(daemon_output[0].stream)
@@ -0,0 +1,161 @@
+"""Tests for the protocols used to copy files to and from a board."""
+
+import os
+
+import pytest
+
+import rshell.main as rshell
+from conftest import read_file, write_file
+
+
+def test_cp_upload_and_download(board, shell, tmp_path):
+    data = os.urandom(50000)
+    write_file(str(tmp_path / 'src.bin'), data)
+    shell('cp {} /flash/dst.bin'.format(tmp_path / 'src.bin'))
+    assert read_file(board.host_path('/flash/dst.bin')) == data
+    shell('cp /flash/dst.bin {}'.format(tmp_path / 'back.bin'))
+    assert read_file(str(tmp_path / 'back.bin')) == data
+    assert not os.path.exists(board.host_path('/flash/dst.bin' + rshell.TEMP_SUFFIX))
+
+
+def test_upload_is_only_kept_once_committed(board, dev, monkeypatch, tmp_path):
+    """The board only replaces the file once the host has sent the ACK which
+       commits the transfer (see host_committed).
+    """
+    write_file(board.host_path('/flash/dst.bin'), b'original')
+    write_file(str(tmp_path / 'src.bin'), os.urandom(5000))
+    real_write = dev.write
+
+    def write(data):
+        # Send a NAK instead of the ACK which commits the transfer
+        return real_write(b'\x15' if data == b'\x06' else data)
+
+    monkeypatch.setattr(dev, 'write', write)
+    with open(str(tmp_path / 'src.bin'), 'rb') as src_file:
+        assert not rshell.upload_file(dev, src_file, '/flash/dst.bin', 5000)
+    assert read_file(board.host_path('/flash/dst.bin')) == b'original'
+
+
+def test_upload_checksum_mismatch_is_rejected(board, dev, tmp_path):
+    """When resuming, the part of the temporary file which is already on the
+       board is included in the checksum, so a stale one is caught.
+    """
+    data = os.urandom(20000)
+    write_file(str(tmp_path / 'src.bin'), data)
+    write_file(board.host_path('/flash/dst.bin' + rshell.TEMP_SUFFIX), os.urandom(7000))
+    with open(str(tmp_path / 'src.bin'), 'rb') as src_file:
+        src_file.seek(7000)
+        assert not dev.remote_eval(rshell.recv_file_from_host, src_file, '/flash/dst.bin',
+                                   len(data), checksum=True, offset=7000,
+                                   xfer_func=rshell.send_file_to_remote)
+    assert not os.path.exists(board.host_path('/flash/dst.bin'))
+
+
+def test_upload_resumes_after_timeout(board, dev, monkeypatch, tmp_path):
+    """Data which gets lost makes the transfer time out, and it's retried
+       from the last chunk which the board acknowledged.
+    """
+    data = os.urandom(20000)
+    write_file(str(tmp_path / 'src.bin'), data)
+    monkeypatch.setattr(rshell, 'XFER_CHUNK_TIMEOUT', 0.5)
+    state = {'sent': 0, 'dropping': True}
+    real_write = dev.write
+    real_recover = dev.recover
+
+    def write(data):
+        state['sent'] += len(data)
+        if state['dropping'] and state['sent'] > 5000:
+            return len(data)
+        return real_write(data)
+
+    def recover(*args):
+        state['dropping'] = False
+        return real_recover(*args)
+
+    offsets = []
+    real_send = rshell.send_file_to_remote
+
+    def send_file_to_remote(*args, **kwargs):
+        offsets.append(kwargs['offset'])
+        return real_send(*args, **kwargs)
+
+    monkeypatch.setattr(dev, 'write', write)
+    monkeypatch.setattr(dev, 'recover', recover)
+    monkeypatch.setattr(rshell, 'send_file_to_remote', send_file_to_remote)
+    with open(str(tmp_path / 'src.bin'), 'rb') as src_file:
+        assert rshell.upload_file(dev, src_file, '/flash/dst.bin', len(data))
+    assert read_file(board.host_path('/flash/dst.bin')) == data
+    assert offsets[0] == 0
+    assert offsets[1] > 0
+    assert dict(rshell.STATS.counter_rows())['xfer_retries'] == 1
+
+
+@pytest.mark.parametrize('has_buffer', [True, False])
+def test_rsync_sends_a_bundle(board, dev, shell, monkeypatch, tmp_path, has_buffer):
+    monkeypatch.setattr(dev, 'has_buffer', has_buffer)
+    src_dir = tmp_path / 'src'
+    files = {'a.py': b'a = 1\n', 'sub/b.txt': os.urandom(3000), 'sub/deep/c': b'',
+             'd.bin': os.urandom(40000)}
+    for name, data in files.items():
+        write_file(str(src_dir / name), data)
+    os.mkdir(board.host_path('/flash/dst'))
+    funcs = []
+    real_remote_eval = dev.remote_eval
+
+    def remote_eval(func, *args, **kwargs):
+        funcs.append(func)
+        return real_remote_eval(func, *args, **kwargs)
+
+    monkeypatch.setattr(dev, 'remote_eval', remote_eval)
+    shell('rsync {} /flash/dst'.format(src_dir))
+    for name, data in files.items():
+        assert read_file(board.host_path('/flash/dst/' + name)) == data
+    # The whole tree goes in one bundle, rather than a call per file
+    assert funcs.count(rshell.recv_bundle_from_host) == 1
+    assert rshell.recv_file_from_host not in funcs
+
+
+def test_rsync_stage_leaves_no_temporary_files(board, shell, tmp_path):
+    src_dir = tmp_path / 'src'
+    write_file(str(src_dir / 'a.py'), b'new')
+    write_file(board.host_path('/flash/dst/a.py'), b'old')
+    os.utime(board.host_path('/flash/dst/a.py'), (0, 0))
+    shell('rsync --stage {} /flash/dst'.format(src_dir))
+    assert read_file(board.host_path('/flash/dst/a.py')) == b'new'
+    assert os.listdir(board.host_path('/flash/dst')) == ['a.py']
+
+
+@pytest.mark.parametrize('has_buffer', [True, False])
+def test_rsync_delta_only_sends_changed_blocks(board, dev, shell, monkeypatch, tmp_path,
+                                               has_buffer):
+    monkeypatch.setattr(dev, 'has_buffer', has_buffer)
+    src_dir = tmp_path / 'src'
+    old = os.urandom(200000)
+    new = bytearray(old)
+    new[1000:1010] = b'x' * 10
+    new = b'inserted' + bytes(new) + b'appended'
+    write_file(board.host_path('/flash/dst/big.bin'), old)
+    os.utime(board.host_path('/flash/dst/big.bin'), (0, 0))
+    write_file(str(src_dir / 'big.bin'), new)
+    rshell.STATS.reset()
+    shell('rsync --delta {} /flash/dst'.format(src_dir))
+    assert read_file(board.host_path('/flash/dst/big.bin')) == new
+    assert dict(rshell.STATS.counter_rows())['bytes_sent'] < len(new) // 2
+
+
+def test_cp_range(board, shell, tmp_path):
+    data = os.urandom(2000)
+    write_file(board.host_path('/flash/src.bin'), data)
+    shell('cp --range 3:8 /flash/src.bin {}'.format(tmp_path / 'middle'))
+    assert read_file(str(tmp_path / 'middle')) == data[3:8]
+    shell('cp --range=-5: /flash/src.bin {}'.format(tmp_path / 'tail'))
+    assert read_file(str(tmp_path / 'tail')) == data[-5:]
+    shell('cp --range :100 /flash/src.bin {}'.format(tmp_path / 'head'))
+    assert read_file(str(tmp_path / 'head')) == data[:100]
+
+
+def test_cp_range_rejects_bad_ranges(board, shell, tmp_path, capsys):
+    write_file(board.host_path('/flash/src.bin'), b'0123456789')
+    shell('cp --range 5 /flash/src.bin {}'.format(tmp_path / 'out'))
+    assert "Invalid range '5'" in capsys.readouterr().err
+    assert not os.path.exists(str(tmp_path / 'out'))